@@ -0,0 +1,438 @@
+"""Asynchronous A2S query client.
+
+This module implements the client side of the Source engine server query
+protocol (A2S) on top of :mod:`asyncio` datagram transports. Unlike
+:class:`valve.source.a2s.ServerQuerier`, which uses a blocking socket per
+server, a single :class:`Querier` shares one UDP socket between any number
+of concurrent queries. Responses are matched to outstanding requests by the
+address they were received from.
+
+Three queries are supported: ``A2S_INFO``, ``A2S_PLAYER`` and ``A2S_RULES``.
+Challenge numbers are handled transparently, as are split (multi-packet)
+responses, including those that are BZip2 compressed.
+
+The decoded responses are dictionaries that use the same field names as
+:mod:`valve.source.a2s` so that they can be passed straight through to
+:meth:`serverstf.tags.Tagger.evaluate`.
+"""
+
+import asyncio
+import bz2
+import logging
+import socket
+import struct
+import zlib
+
+
+log = logging.getLogger(__name__)
+
+
+#: Header for a response contained entirely within a single packet
+_HEADER_SIMPLE = b"\xFF\xFF\xFF\xFF"
+#: Header for one of the packets of a split response
+_HEADER_SPLIT = b"\xFE\xFF\xFF\xFF"
+#: Challenge sent when the server's challenge number is not yet known
+_NO_CHALLENGE = b"\xFF\xFF\xFF\xFF"
+#: The number of times to retry a request in response to a challenge
+_CHALLENGE_ATTEMPTS = 3
+#: Size of the socket's receive buffer; it must be able to hold the split
+#: responses to hundreds of concurrent requests that arrive at once
+_RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+_REQUEST_INFO = b"T"
+_REQUEST_PLAYERS = b"U"
+_REQUEST_RULES = b"V"
+_RESPONSE_CHALLENGE = b"A"
+_RESPONSE_INFO = b"I"
+_RESPONSE_PLAYERS = b"D"
+_RESPONSE_RULES = b"E"
+
+
+class A2SError(Exception):
+    """Base exception for all A2S query errors."""
+
+
+class NoResponseError(A2SError):
+    """Raised when a server doesn't respond before the timeout expires."""
+
+
+class BrokenMessageError(A2SError):
+    """Raised when a server responds with a malformed message."""
+
+
+class _Reader:
+    """Sequentially decode fields from a message body.
+
+    All integers are little-endian as per the A2S protocol. Strings are
+    null-terminated and decoded as UTF-8 with invalid sequences replaced.
+
+    :raises BrokenMessageError: if an attempt is made to read beyond the
+        end of the message.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    @property
+    def remaining(self):
+        """Get the number of unread bytes."""
+        return len(self._data) - self._offset
+
+    def _unpack(self, format_):
+        """Unpack a single fixed-width value."""
+        size = struct.calcsize(format_)
+        if self.remaining < size:
+            raise BrokenMessageError("Message truncated")
+        value, = struct.unpack_from(format_, self._data, self._offset)
+        self._offset += size
+        return value
+
+    def byte(self):
+        """Read an unsigned 8-bit integer."""
+        return self._unpack("<B")
+
+    def short(self):
+        """Read an unsigned 16-bit integer."""
+        return self._unpack("<H")
+
+    def long(self):
+        """Read a signed 32-bit integer."""
+        return self._unpack("<l")
+
+    def long_long(self):
+        """Read an unsigned 64-bit integer."""
+        return self._unpack("<Q")
+
+    def float(self):
+        """Read a 32-bit floating point number."""
+        return self._unpack("<f")
+
+    def string(self):
+        """Read a null-terminated string."""
+        end = self._data.find(b"\x00", self._offset)
+        if end == -1:
+            raise BrokenMessageError("Unterminated string")
+        value = self._data[self._offset:end].decode("utf-8", "replace")
+        self._offset = end + 1
+        return value
+
+
+def _decode_info(reader):
+    """Decode an ``A2S_INFO`` response body.
+
+    :param _Reader reader: a reader positioned after the response type.
+
+    :return: a dictionary containing the server info.
+    """
+    info = {
+        "response_type": ord(_RESPONSE_INFO),
+        "protocol": reader.byte(),
+        "server_name": reader.string(),
+        "map": reader.string(),
+        "folder": reader.string(),
+        "game": reader.string(),
+        "app_id": reader.short(),
+        "player_count": reader.byte(),
+        "max_players": reader.byte(),
+        "bot_count": reader.byte(),
+        "server_type": chr(reader.byte()),
+        "platform": chr(reader.byte()),
+        "password_protected": reader.byte(),
+        "vac_enabled": reader.byte(),
+    }
+    info["version"] = reader.string()
+    if reader.remaining:
+        edf = reader.byte()
+        if edf & 0x80:
+            info["port"] = reader.short()
+        if edf & 0x10:
+            info["steam_id"] = reader.long_long()
+        if edf & 0x40:
+            info["stv_port"] = reader.short()
+            info["stv_name"] = reader.string()
+        if edf & 0x20:
+            info["keywords"] = reader.string()
+        if edf & 0x01:
+            info["game_id"] = reader.long_long()
+    return info
+
+
+def _decode_players(reader):
+    """Decode an ``A2S_PLAYER`` response body.
+
+    :param _Reader reader: a reader positioned after the response type.
+
+    :return: a dictionary containing the player count and a list of players.
+    """
+    players = {
+        "response_type": ord(_RESPONSE_PLAYERS),
+        "player_count": reader.byte(),
+        "players": [],
+    }
+    for _ in range(players["player_count"]):
+        players["players"].append({
+            "index": reader.byte(),
+            "name": reader.string(),
+            "score": reader.long(),
+            "duration": reader.float(),
+        })
+    return players
+
+
+def _decode_rules(reader):
+    """Decode an ``A2S_RULES`` response body.
+
+    :param _Reader reader: a reader positioned after the response type.
+
+    :return: a dictionary containing the rule count and a dictionary of
+        rule names to values.
+    """
+    rules = {
+        "response_type": ord(_RESPONSE_RULES),
+        "rule_count": reader.short(),
+        "rules": {},
+    }
+    for _ in range(rules["rule_count"]):
+        name = reader.string()
+        rules["rules"][name] = reader.string()
+    return rules
+
+
+class _Exchange:
+    """A single outstanding request to a server.
+
+    Exchanges collect the packets received from a server until a complete
+    response message is available. At which point the :attr:`future` is
+    resolved with the message, stripped of its header.
+    """
+
+    def __init__(self, loop):
+        self.future = asyncio.Future(loop=loop)
+        self._fragments = {}
+        self._fragment_count = None
+        self._compression = None
+
+    def feed(self, packet):
+        """Add a received packet to the exchange.
+
+        :param bytes packet: the raw datagram as received from the server.
+
+        :raises BrokenMessageError: if the packet or the reassembled
+            message is malformed.
+        :return: the complete response message if one is available,
+            otherwise ``None``.
+        """
+        header = packet[:4]
+        if header == _HEADER_SIMPLE:
+            return packet[4:]
+        if header != _HEADER_SPLIT:
+            raise BrokenMessageError(
+                "Unexpected packet header {!r}".format(header))
+        reader = _Reader(packet[4:])
+        id_ = reader.long()
+        count = reader.byte()
+        number = reader.byte()
+        reader.short()  # maximum packet size
+        if id_ < 0 and number == 0:
+            self._compression = (reader.long(), reader.long())
+        if count == 0 or number >= count:
+            raise BrokenMessageError(
+                "Bad fragment {} of {}".format(number, count))
+        if self._fragment_count is None:
+            self._fragment_count = count
+        self._fragments[number] = packet[len(packet) - reader.remaining:]
+        if len(self._fragments) < self._fragment_count:
+            return None
+        message = b"".join(self._fragments[i]
+                           for i in range(self._fragment_count))
+        if self._compression:
+            message = self._decompress(message)
+        if message[:4] != _HEADER_SIMPLE:
+            raise BrokenMessageError("Split message has bad header")
+        return message[4:]
+
+    def _decompress(self, message):
+        """Decompress a reassembled BZip2 message.
+
+        :raises BrokenMessageError: if the message couldn't be decompressed
+            or doesn't match the advertised size and checksum.
+        """
+        size, checksum = self._compression
+        try:
+            message = bz2.decompress(message)
+        except (OSError, ValueError) as exc:
+            raise BrokenMessageError(
+                "Couldn't decompress message: {}".format(exc)) from exc
+        if (len(message) != size
+                or zlib.crc32(message) & 0xFFFFFFFF != checksum & 0xFFFFFFFF):
+            raise BrokenMessageError("Decompressed message failed checks")
+        return message
+
+
+class _Protocol(asyncio.DatagramProtocol):
+    """Dispatch received datagrams to their outstanding exchanges."""
+
+    def __init__(self, exchanges):
+        self._exchanges = exchanges
+
+    def datagram_received(self, data, addr):
+        exchange = self._exchanges.get(addr[:2])
+        if exchange is None or exchange.future.done():
+            log.debug("Dropping unsolicited datagram from %s", addr)
+            return
+        try:
+            message = exchange.feed(data)
+        except BrokenMessageError as exc:
+            exchange.future.set_exception(exc)
+        else:
+            if message is not None:
+                exchange.future.set_result(message)
+
+    def error_received(self, exc):
+        log.debug("Error received on A2S socket: %s", exc)
+
+
+class Querier:
+    """Issue A2S queries to any number of servers concurrently.
+
+    Do not instantiate this class directly. Instead use the :meth:`create`
+    coroutine.
+
+    Only one request may be in flight for any given address at a time.
+    Attempting to query an address which already has an outstanding request
+    will raise :exc:`A2SError`.
+    """
+
+    def __init__(self, transport, exchanges, loop, timeout):
+        self._transport = transport
+        self._exchanges = exchanges
+        self._loop = loop
+        self._timeout = timeout
+
+    def __repr__(self):
+        return ("<{0.__class__.__name__} with {1} "
+                "requests in flight>".format(self, len(self._exchanges)))
+
+    @classmethod
+    @asyncio.coroutine
+    def create(cls, loop, *, timeout=5.0):
+        """Create a querier bound to a new UDP socket.
+
+        :param loop: the :mod:`asyncio` event loop to use.
+        :param float timeout: the number of seconds to wait for each
+            response before giving up.
+
+        :return: a new :class:`Querier` which is also a context manager that
+            closes the socket when exited.
+        """
+        exchanges = {}
+        transport, _ = yield from loop.create_datagram_endpoint(
+            lambda: _Protocol(exchanges), local_addr=("0.0.0.0", 0))
+        # The kernel caps this at net.core.rmem_max, which may be smaller
+        transport.get_extra_info("socket").setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, _RECEIVE_BUFFER_SIZE)
+        return cls(transport, exchanges, loop, timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the underlying socket."""
+        self._transport.close()
+
+    @asyncio.coroutine
+    def _exchange(self, address, request):
+        """Send a request and wait for the complete response.
+
+        :param serverstf.cache.Address address: the server to send to.
+        :param bytes request: the request packet.
+
+        :raises NoResponseError: if the server doesn't respond in time.
+        :raises BrokenMessageError: if the response is malformed.
+        :return: the response message without its header.
+        """
+        key = (str(address.ip), address.port)
+        if key in self._exchanges:
+            raise A2SError("Request already in flight for {}".format(address))
+        exchange = _Exchange(self._loop)
+        self._exchanges[key] = exchange
+        try:
+            self._transport.sendto(request, key)
+            return (yield from asyncio.wait_for(
+                exchange.future, self._timeout, loop=self._loop))
+        except asyncio.TimeoutError as exc:
+            raise NoResponseError("Timed out waiting for "
+                                  "response from {}".format(address)) from exc
+        finally:
+            del self._exchanges[key]
+
+    @asyncio.coroutine
+    def _request(self, address, request, response_type, challenge=b""):
+        """Issue a request, answering any challenges the server makes.
+
+        :param serverstf.cache.Address address: the server to query.
+        :param bytes request: the request packet excluding the challenge.
+        :param bytes response_type: the expected response type byte.
+        :param bytes challenge: the initial challenge to send.
+
+        :raises BrokenMessageError: if the server responds with an
+            unexpected message type or keeps issuing challenges.
+        :return: a :class:`_Reader` positioned after the response type.
+        """
+        for _ in range(_CHALLENGE_ATTEMPTS):
+            response = yield from self._exchange(address, request + challenge)
+            type_ = response[:1]
+            if type_ == _RESPONSE_CHALLENGE and len(response) >= 5:
+                challenge = response[1:5]
+            elif type_ == response_type:
+                return _Reader(response[1:])
+            else:
+                raise BrokenMessageError(
+                    "Expected response type {!r} from {} "
+                    "but got {!r}".format(response_type, address, type_))
+        raise BrokenMessageError("Too many challenges from {}".format(address))
+
+    @asyncio.coroutine
+    def info(self, address):
+        """Query a server's info.
+
+        :return: a dictionary as described by :func:`_decode_info`.
+        """
+        reader = yield from self._request(
+            address,
+            _HEADER_SIMPLE + _REQUEST_INFO + b"Source Engine Query\x00",
+            _RESPONSE_INFO,
+        )
+        return _decode_info(reader)
+
+    @asyncio.coroutine
+    def players(self, address):
+        """Query the players on a server.
+
+        :return: a dictionary as described by :func:`_decode_players`.
+        """
+        reader = yield from self._request(
+            address,
+            _HEADER_SIMPLE + _REQUEST_PLAYERS,
+            _RESPONSE_PLAYERS,
+            _NO_CHALLENGE,
+        )
+        return _decode_players(reader)
+
+    @asyncio.coroutine
+    def rules(self, address):
+        """Query a server's rules.
+
+        :return: a dictionary as described by :func:`_decode_rules`.
+        """
+        reader = yield from self._request(
+            address,
+            _HEADER_SIMPLE + _REQUEST_RULES,
+            _RESPONSE_RULES,
+            _NO_CHALLENGE,
+        )
+        return _decode_rules(reader)
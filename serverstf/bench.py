@@ -0,0 +1,796 @@
+"""Microbenchmarks for the hot paths of the cache and websocket service.
+
+Specifically this module provides the ``bench-players``,
+``bench-statuses``, ``bench-get``, ``bench-dispatch`` and ``bench-a2s``
+subcommands. The first compares the compact binary encoding of server
+players with the JSON one that it replaced. The second measures the time
+and memory it takes to decode server statuses read from the cache. The
+third measures the latency of reading statuses from Redis under load. The
+fourth measures how quickly the websocket service can validate incoming
+messages. The last measures how quickly servers can be polled by the
+asynchronous A2S client.
+
+Apart from ``bench-get``, benchmarks don't need a Redis database or network
+access. The A2S servers polled by ``bench-a2s`` are faked by sockets bound
+to the loopback interface.
+"""
+
+import asyncio
+import bz2
+import contextlib
+import datetime
+import functools
+import ipaddress
+import json
+import resource
+import struct
+import time
+import timeit
+import zlib
+
+import voluptuous
+
+import serverstf
+import serverstf.a2s
+import serverstf.cache
+import serverstf.cli
+import serverstf.websocket
+
+
+def _players(count):
+    """Create players for a full server.
+
+    :param int count: the number of players on the server.
+
+    :return: a :class:`serverstf.cache.Players` with ``count`` scores. The
+        names, scores and durations vary like they would on a real server.
+    """
+    scores = []
+    for i in range(count):
+        scores.append((
+            "Player {}".format(i),
+            (i * 7) % 50,
+            datetime.timedelta(seconds=i * 97.5),
+        ))
+    return serverstf.cache.Players(
+        current=count, max_=count, bots=0, scores=scores)
+
+
+def _time(function, iterations):
+    """Time a function.
+
+    :param function: the callable to time.
+    :param int iterations: the number of times to call ``function``.
+
+    :return: the mean time per call in microseconds.
+    """
+    return timeit.timeit(function, number=iterations) / iterations * 1e6
+
+
+@serverstf.cli.subcommand("bench-players")
+@serverstf.cli.argument(
+    "--players",
+    type=int,
+    default=32,
+    help="The number of players on the benchmarked server. Default is 32.",
+)
+@serverstf.cli.argument(
+    "--iterations",
+    type=int,
+    default=10000,
+    help="The number of times to encode and decode. Default is 10000.",
+)
+def _bench_players_main(args):
+    """Compare the binary and JSON encodings of players.
+
+    This prints the mean time taken to encode and decode the players of a
+    full server in each encoding. It also prints the size of the encoded
+    players, which is the only part of the status hash that differs
+    between the two. Decoding is done with
+    :meth:`serverstf.cache.Players.from_bytes` as it is when reading from
+    the cache.
+    """
+    players = _players(args.players)
+    encodings = [
+        ("binary", players.to_bytes),
+        ("json", lambda: players.to_json().encode("utf-8")),
+    ]
+    print("Encoding  Encode (us)  Decode (us)  Bytes/status")
+    for name, encode in encodings:
+        encoded = encode()
+        decode = functools.partial(
+            serverstf.cache.Players.from_bytes, encoded)
+        print("{:8}  {:11.2f}  {:11.2f}  {:12}".format(
+            name,
+            _time(encode, args.iterations),
+            _time(decode, args.iterations),
+            len(encoded),
+        ))
+
+
+def _cached_statuses(count):
+    """Create server statuses as they're read from the cache.
+
+    :param int count: the number of servers.
+
+    :return: a list of tuples containing the UTF-8 encoded address, the
+        status hash, the tags and the interest of each server. These are
+        all as returned by Redis.
+    """
+    players = [_players(i).to_bytes() for i in range(33)]
+    base = int(ipaddress.IPv4Address("10.0.0.0"))
+    statuses = []
+    for i in range(count):
+        hash_ = {
+            b"name": "Server {}".format(i).encode("utf-8"),
+            b"map": b"cp_badlands",
+            b"application_id": b"440",
+            b"country": b"GB",
+            b"latitude": b"51.5",
+            b"longitude": b"-0.13",
+            b"sequence": str(i).encode("utf-8"),
+            b"players": players[i % len(players)],
+        }
+        statuses.append((
+            "{}:27015".format(ipaddress.IPv4Address(base + i)).encode("utf-8"),
+            hash_,
+            {b"tf2", b"mode:cp"},
+            i % 3,
+        ))
+    return statuses
+
+
+def _validate_status(raw_address, hash_, tags, interest):
+    """Decode a cached status with the validating constructors.
+
+    Unlike :meth:`serverstf.cache.AsyncCache.get` this doesn't trust the
+    cached status. The address is parsed, each player's score is checked
+    and the country is validated.
+
+    :return: a :class:`serverstf.cache.Status`.
+    """
+    players = serverstf.cache.Players.from_bytes(hash_[b"players"])
+    return serverstf.cache.Status(
+        serverstf.cache.Address.parse(raw_address.decode("utf-8")),
+        interest=interest,
+        sequence=hash_[b"sequence"].decode("utf-8"),
+        name=hash_[b"name"].decode("utf-8"),
+        map_=hash_[b"map"].decode("utf-8"),
+        application_id=hash_[b"application_id"].decode("utf-8"),
+        players=serverstf.cache.Players(
+            current=players.current,
+            max_=players.max,
+            bots=players.bots,
+            scores=players,
+        ),
+        country=hash_[b"country"].decode("utf-8"),
+        latitude=hash_[b"latitude"].decode("utf-8"),
+        longitude=hash_[b"longitude"].decode("utf-8"),
+        tags={tag.decode("utf-8") for tag in tags},
+    )
+
+
+@serverstf.cli.subcommand("bench-statuses")
+@serverstf.cli.argument(
+    "--servers",
+    type=int,
+    default=50000,
+    help="The number of server statuses to decode. Default is 50000.",
+)
+@serverstf.cli.argument(
+    "--validate",
+    action="store_true",
+    help=("When set the statuses are decoded with the validating "
+          "constructors rather than as the cache decodes them."),
+)
+def _bench_statuses_main(args):
+    """Measure the time and memory taken to decode cached statuses.
+
+    Statuses are decoded as :meth:`serverstf.cache.AsyncCache.get` does and
+    are all kept, as the websocket service and poller do for the servers
+    they track. This prints the mean time taken to decode each status and
+    the growth of the process's peak resident set size per status.
+
+    The peak resident set size never shrinks so only one way of decoding
+    is measured each time this is run. Run it again with ``--validate`` to
+    compare against decoding with the validating constructors.
+    """
+    cached = _cached_statuses(args.servers)
+    if args.validate:
+        name = "validated"
+        decode = _validate_status
+    else:
+        name = "cached"
+        cache = serverstf.cache.AsyncCache(
+            None, asyncio.get_event_loop(), options={})
+
+        def decode(raw_address, hash_, tags, interest):
+            """Decode a status as :meth:`AsyncCache.get` does."""
+            address = serverstf.cache.Address.from_cache(raw_address)
+            return cache._decode_status(  # pylint: disable=protected-access
+                address, hash_, tags, interest)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    statuses = {}
+    for entry in cached:
+        status = decode(*entry)
+        statuses[status.address] = status
+    elapsed = time.perf_counter() - start
+    # Linux reports the peak resident set size in kibibytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    print("Decoding   Servers  Decode (us/server)  RSS (bytes/server)")
+    print("{:9}  {:7}  {:18.2f}  {:18.0f}".format(
+        name,
+        len(statuses),
+        elapsed / len(statuses) * 1e6,
+        rss * 1024 / len(statuses),
+    ))
+
+
+def _percentile(latencies, percent):
+    """Get a percentile of sorted latencies.
+
+    :param list latencies: the latencies in ascending order.
+    :param float percent: the percentile to get.
+
+    :return: the nearest latency at or below the percentile.
+    """
+    return latencies[int(percent / 100 * (len(latencies) - 1))]
+
+
+@asyncio.coroutine
+def _get_client(cache, addresses, requests, latencies):
+    """Get statuses one after another as a websocket client would.
+
+    :param serverstf.cache.AsyncCache cache: the cache to get from.
+    :param list addresses: the addresses to get, in order.
+    :param int requests: the number of statuses to get.
+    :param list latencies: the list to append each get's latency to.
+    """
+    for i in range(requests):
+        start = time.perf_counter()
+        yield from cache.get(addresses[i % len(addresses)])
+        latencies.append(time.perf_counter() - start)
+
+
+@asyncio.coroutine
+def _bench_get(args, loop):
+    """Get statuses over a single connection and then over a pool.
+
+    :return: a list of tuples containing the name of each connection
+        strategy, the number of gets per second and the sorted latencies.
+    """
+    results = []
+    for name, pool_size in [("single", None),
+                            ("pool", args.redis_pool_size)]:
+        cache_context = yield from serverstf.cache.AsyncCache.connect(
+            args.redis, loop, pool_size=pool_size)
+        with cache_context as cache:
+            _, addresses = yield from cache.scan(count=args.servers)
+            if not addresses:
+                raise serverstf.FatalError(
+                    "There are no servers in the cache to get")
+            latencies = []
+            start = time.perf_counter()
+            yield from asyncio.gather(*[
+                _get_client(cache, addresses[i:] + addresses[:i],
+                            args.requests, latencies)
+                for i in range(args.clients)
+            ], loop=loop)
+            elapsed = time.perf_counter() - start
+        results.append((name, len(latencies) / elapsed, sorted(latencies)))
+    return results
+
+
+@serverstf.cli.subcommand("bench-get")
+@serverstf.cli.redis
+@serverstf.cli.redis_pool
+@serverstf.cli.argument(
+    "--clients",
+    type=int,
+    default=1000,
+    help="The number of concurrent clients. Default is 1000.",
+)
+@serverstf.cli.argument(
+    "--requests",
+    type=int,
+    default=20,
+    help="The number of statuses each client gets. Default is 20.",
+)
+@serverstf.cli.argument(
+    "--servers",
+    type=int,
+    default=200,
+    help=("The number of servers in the cache to spread "
+          "the gets across. Default is 200."),
+)
+def _bench_get_main(args):
+    """Measure the latency of getting statuses under load.
+
+    Each client gets statuses one after another, as the websocket service
+    does for each of its clients. All the clients share a single
+    :class:`serverstf.cache.AsyncCache`, first with a single connection as
+    before pooling was added and then with a pool of ``--redis-pool-size``
+    connections. The throughput and the median and 99th percentile get
+    latencies are printed for each.
+
+    Statuses are only read, never written, but the cache must already
+    contain some servers, e.g. from the synchroniser.
+    """
+    loop = asyncio.get_event_loop()
+    print("Connection  Gets/second  p50 (ms)  p99 (ms)")
+    for name, rate, latencies in loop.run_until_complete(
+            _bench_get(args, loop)):
+        print("{:10}  {:11.0f}  {:8.2f}  {:8.2f}".format(
+            name,
+            rate,
+            _percentile(latencies, 50) * 1000,
+            _percentile(latencies, 99) * 1000,
+        ))
+
+
+def _burst(servers, page_size):
+    """Create a burst of messages like those sent by the UI.
+
+    The UI batches its subscriptions into ``subscribe-many`` messages, one
+    for each page of search results that it shows. When it moves on to the
+    next page it unsubscribes from the last one with an
+    ``unsubscribe-many`` message.
+
+    :param int servers: the number of servers to subscribe to.
+    :param int page_size: the number of servers on each page.
+
+    :return: a list of JSON encoded message envelopes.
+    """
+    base = int(ipaddress.IPv4Address("10.0.0.0"))
+    addresses = [{"ip": str(ipaddress.IPv4Address(base + i)), "port": 27015}
+                 for i in range(servers)]
+    burst = []
+    for offset in range(0, servers, page_size):
+        page = addresses[offset:offset + page_size]
+        burst.append(
+            serverstf.websocket.encode_message("subscribe-many", page))
+        burst.append(
+            serverstf.websocket.encode_message("unsubscribe-many", page))
+    return burst
+
+
+def _validate(burst):
+    """Validate a burst of messages as the websocket service does.
+
+    Each message is decoded and then validated by the schema of the
+    :class:`serverstf.websocket.Client` method that handles it.
+
+    :param list burst: the JSON encoded messages to validate.
+    """
+    for raw_message in burst:
+        message = serverstf.websocket.decode_message(raw_message)
+        serverstf.websocket.Client.handler(
+            message["type"]).schema(message["entity"])
+
+
+class _Rebuilt:  # pylint: disable=too-few-public-methods
+    """A schema which is rebuilt every time it's used.
+
+    :param voluptuous.Schema compiled: the compiled schema to rebuild.
+    """
+
+    def __init__(self, compiled):
+        self.schema = compiled.schema
+
+    def __call__(self, value):
+        return voluptuous.Schema(self.schema)(value)
+
+
+@contextlib.contextmanager
+def _rebuilt(functions):
+    """Rebuild the schemas used by functions every time they're used.
+
+    This is how the websocket service used to validate messages. The
+    envelope and entity schemas were built for every message, and the
+    address schema for every address within them.
+
+    :param functions: the functions whose ``schema`` attribute should be
+        replaced by a :class:`_Rebuilt` schema until the context exits.
+    """
+    compiled = [function.schema for function in functions]
+    for function in functions:
+        function.schema = _Rebuilt(function.schema)
+    try:
+        yield
+    finally:
+        for function, schema in zip(functions, compiled):
+            function.schema = schema
+
+
+class _ReplayWebsocket:
+    """A websocket connection which replays recorded messages.
+
+    :ivar list sent: the messages sent to the peer.
+    """
+
+    def __init__(self, messages):
+        self._messages = iter(messages)
+        self.sent = []
+
+    @asyncio.coroutine
+    def recv(self):
+        """Receive the next recorded message or ``None`` after the last."""
+        yield from asyncio.sleep(0)
+        return next(self._messages, None)
+
+    @asyncio.coroutine
+    def send(self, message):
+        """Record a message sent to the peer."""
+        self.sent.append(json.loads(message))
+
+
+class _IdleNotifier:
+    """A notifier whose servers never change.
+
+    :param loop: the :mod:`asyncio` event loop to use.
+    """
+
+    SERVER = serverstf.cache.Notifier.SERVER
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    @asyncio.coroutine
+    def watch_servers(self, addresses):
+        """Watch servers; this does nothing."""
+
+    @asyncio.coroutine
+    def unwatch_servers(self, addresses):
+        """Stop watching servers; this does nothing."""
+
+    @asyncio.coroutine
+    def watch(self):
+        """Wait forever for a notification."""
+        yield from asyncio.Future(loop=self._loop)
+
+
+class _EmptySnapshots:  # pylint: disable=too-few-public-methods
+    """Snapshots of servers which have no status."""
+
+    @asyncio.coroutine
+    def statuses(self, addresses):
+        """Get a ``statuses`` message with an entity for each address."""
+        return serverstf.websocket.encode_message("statuses", [
+            {"ip": str(address.ip), "port": address.port}
+            for address in addresses
+        ])
+
+
+def _check_dispatch(burst, loop):
+    """Replay a burst of messages to a :class:`serverstf.websocket.Client`.
+
+    The client's notifier and snapshots don't touch Redis but otherwise
+    the messages are handled as they are by the websocket service. Every
+    ``subscribe-many`` message must be answered with a ``statuses``
+    message for the same number of servers.
+
+    :param list burst: the JSON encoded messages to replay.
+    :param loop: the :mod:`asyncio` event loop to use.
+
+    :raises serverstf.FatalError: if any of the messages was rejected or
+        not answered.
+    """
+    websocket = _ReplayWebsocket(burst)
+    client = serverstf.websocket.Client(
+        websocket,
+        serverstf.websocket.Shared(None, _EmptySnapshots(), None),
+        _IdleNotifier(loop),
+        serverstf.websocket.Outbox(
+            serverstf.websocket.OutboxPolicy(len(burst), 60.0), loop=loop),
+    )
+    loop.run_until_complete(client.process())
+    expected = [len(json.loads(raw_message)["entity"])
+                for raw_message in burst
+                if json.loads(raw_message)["type"] == "subscribe-many"]
+    replies = []
+    for message in websocket.sent:
+        if message["type"] != "statuses":
+            raise serverstf.FatalError(
+                "Unexpected {type} reply: {entity}".format(**message))
+        replies.append(len(message["entity"]))
+    if replies != expected:
+        raise serverstf.FatalError("Expected statuses replies for {} "
+                                   "but got {}".format(expected, replies))
+
+
+@serverstf.cli.subcommand("bench-dispatch")
+@serverstf.cli.argument(
+    "--servers",
+    type=int,
+    default=200,
+    help=("The number of servers subscribed to in each burst "
+          "of messages. Default is 200."),
+)
+@serverstf.cli.argument(
+    "--page-size",
+    type=int,
+    default=50,
+    help=("The number of servers subscribed to by each message. "
+          "Default is 50."),
+)
+@serverstf.cli.argument(
+    "--bursts",
+    type=int,
+    default=50,
+    help="The number of times to replay the burst. Default is 50.",
+)
+def _bench_dispatch_main(args):
+    """Measure how quickly incoming websocket messages are validated.
+
+    A burst of ``subscribe-many`` and ``unsubscribe-many`` messages is
+    first replayed to a client to check that they're all handled. It's
+    then replayed through the same decoding and validation as the
+    websocket service. This is done both with the compiled schemas and
+    with every schema rebuilt each time it's used, as the service used to
+    do. The number of messages validated per second is printed for each.
+    """
+    burst = _burst(args.servers, args.page_size)
+    _check_dispatch(burst, asyncio.get_event_loop())
+    functions = [
+        serverstf.websocket.decode_message,
+        serverstf.websocket.address_entity,
+        serverstf.websocket.Client.handler("subscribe-many"),
+        serverstf.websocket.Client.handler("unsubscribe-many"),
+    ]
+    print("Schemas     Messages/second")
+    for name, context in [("rebuilt", _rebuilt(functions)),
+                          ("compiled", contextlib.ExitStack())]:
+        with context:
+            start = time.perf_counter()
+            for _ in range(args.bursts):
+                _validate(burst)
+            elapsed = time.perf_counter() - start
+        print("{:10}  {:15.0f}".format(
+            name, len(burst) * args.bursts / elapsed))
+
+
+#: Size of the fragments that split responses from fake servers are sent in
+_A2S_FRAGMENT_SIZE = 256
+
+
+def _a2s_string(value):
+    """Encode a null-terminated A2S string."""
+    return value.encode("utf-8") + b"\x00"
+
+
+def _a2s_split(id_, message, compress):
+    """Split a response message into packets.
+
+    :param int id_: the ID of the split response.
+    :param bytes message: the message to split, without its header.
+    :param bool compress: whether or not to BZip2 compress the message
+        before splitting it.
+
+    :return: a list of the packets that make up the response, in reverse
+        order so that the client has to reassemble them.
+    """
+    message = b"\xFF\xFF\xFF\xFF" + message
+    data = bz2.compress(message) if compress else message
+    if compress:
+        id_ |= 0x80000000
+    fragments = [data[offset:offset + _A2S_FRAGMENT_SIZE]
+                 for offset in range(0, len(data), _A2S_FRAGMENT_SIZE)]
+    packets = []
+    for number, fragment in enumerate(fragments):
+        header = b"\xFE\xFF\xFF\xFF" + struct.pack(
+            "<LBBH", id_, len(fragments), number, _A2S_FRAGMENT_SIZE)
+        if compress and number == 0:
+            header += struct.pack(
+                "<LL", len(message), zlib.crc32(message) & 0xFFFFFFFF)
+        packets.append(header + fragment)
+    return packets[::-1]
+
+
+def _a2s_responses(players):
+    """Create the responses and decoded responses of a fake server.
+
+    The info response fits in a single packet. The players response is
+    split into multiple packets and the rules response is also BZip2
+    compressed.
+
+    :param int players: the number of players on the server.
+
+    :return: a dictionary that maps each request type to a tuple of the
+        response packets and the expected decoded response.
+    """
+    name = "Fake Server"
+    info = (b"I\x11" + _a2s_string(name) + _a2s_string("cp_badlands")
+            + _a2s_string("tf") + _a2s_string("Team Fortress")
+            + struct.pack("<HBBBBBBB", 440, players, players, 0,
+                          ord("d"), ord("l"), 0, 1)
+            + _a2s_string("1.0.0.0") + b"\x00")
+    scores = [(i, "Player {}".format(i), (i * 7) % 50, i * 97.5)
+              for i in range(players)]
+    players_message = b"D" + struct.pack("<B", players) + b"".join(
+        struct.pack("<B", index) + _a2s_string(player)
+        + struct.pack("<lf", score, duration)
+        for index, player, score, duration in scores)
+    rules = {"sv_rule_{}".format(i): str(i) for i in range(200)}
+    rules_message = b"E" + struct.pack("<H", len(rules)) + b"".join(
+        _a2s_string(rule) + _a2s_string(value)
+        for rule, value in sorted(rules.items()))
+    return {
+        b"T": ([b"\xFF\xFF\xFF\xFF" + info], name),
+        b"U": (_a2s_split(1, players_message, False),
+               [(player, score, duration)
+                for _, player, score, duration in scores]),
+        b"V": (_a2s_split(2, rules_message, True), rules),
+    }
+
+
+class _A2SResponder(asyncio.DatagramProtocol):
+    """A fake server which responds to A2S requests.
+
+    Every request must carry the server's challenge number. Requests that
+    don't are answered with a challenge. Responses are sent after a delay
+    which simulates the round trip time to a real server.
+
+    :param dict responses: the response packets for each request type, as
+        returned by :func:`_a2s_responses`.
+    :param float latency: the number of seconds to delay each response by.
+    :param loop: the :mod:`asyncio` event loop to use.
+
+    :ivar int challenges: the number of challenges issued.
+    """
+
+    def __init__(self, responses, latency, loop):
+        self._responses = responses
+        self._latency = latency
+        self._loop = loop
+        self._transport = None
+        self._challenge = None
+        self.challenges = 0
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._challenge = struct.pack(
+            "<L", transport.get_extra_info("sockname")[1])
+
+    def connection_lost(self, exc):
+        self._transport = None
+
+    def datagram_received(self, data, addr):
+        type_ = data[4:5]
+        if type_ == b"T":
+            challenge = data[25:29]
+        else:
+            challenge = data[5:9]
+        if challenge == self._challenge:
+            packets = self._responses[type_][0]
+        else:
+            self.challenges += 1
+            packets = [b"\xFF\xFF\xFF\xFFA" + self._challenge]
+        self._loop.call_later(self._latency, self._send, packets, addr)
+
+    def _send(self, packets, addr):
+        """Send response packets unless the server has been closed."""
+        if self._transport is not None:
+            for packet in packets:
+                self._transport.sendto(packet, addr)
+
+
+@asyncio.coroutine
+def _a2s_servers(count, responses, latency, loop):
+    """Start fake A2S servers on the loopback interface.
+
+    :param int count: the number of servers to start.
+    :param dict responses: the responses each server gives.
+    :param float latency: the number of seconds to delay responses by.
+    :param loop: the :mod:`asyncio` event loop to use.
+
+    :return: a list of tuples containing the address of each server, its
+        transport and its :class:`_A2SResponder`.
+    """
+    servers = []
+    for _ in range(count):
+        transport, responder = yield from loop.create_datagram_endpoint(
+            lambda: _A2SResponder(responses, latency, loop),
+            local_addr=("127.0.0.1", 0),
+        )
+        address = serverstf.cache.Address(
+            "127.0.0.1", transport.get_extra_info("sockname")[1])
+        servers.append((address, transport, responder))
+    return servers
+
+
+@asyncio.coroutine
+def _a2s_poll(querier, address, expected):
+    """Poll a fake server's info, players and rules.
+
+    :param serverstf.a2s.Querier querier: the querier to poll with.
+    :param serverstf.cache.Address address: the address of the server.
+    :param dict expected: the responses as returned by :func:`_a2s_responses`.
+
+    :raises serverstf.FatalError: if the decoded responses aren't those
+        that the server sent.
+    """
+    info = yield from querier.info(address)
+    players = yield from querier.players(address)
+    rules = yield from querier.rules(address)
+    scores = [(entry["name"], entry["score"], entry["duration"])
+              for entry in players["players"]]
+    if (info["server_name"] != expected[b"T"][1]
+            or scores != expected[b"U"][1]
+            or rules["rules"] != expected[b"V"][1]):
+        raise serverstf.FatalError(
+            "Responses from {} weren't decoded correctly".format(address))
+
+
+@asyncio.coroutine
+def _bench_a2s(args, loop):
+    """Poll fake servers one at a time and then all at once.
+
+    :return: a list of tuples containing the name of each polling strategy
+        and the number of polls per second it achieved.
+    """
+    expected = _a2s_responses(args.players)
+    servers = yield from _a2s_servers(
+        args.servers, expected, args.latency / 1000, loop)
+    querier = yield from serverstf.a2s.Querier.create(loop)
+    results = []
+    try:
+        start = time.perf_counter()
+        for address, _, _ in servers:
+            yield from _a2s_poll(querier, address, expected)
+        results.append(("sequential", time.perf_counter() - start))
+        start = time.perf_counter()
+        yield from asyncio.gather(
+            *[_a2s_poll(querier, address, expected)
+              for address, _, _ in servers], loop=loop)
+        results.append(("concurrent", time.perf_counter() - start))
+    finally:
+        querier.close()
+        for _, transport, _ in servers:
+            transport.close()
+    for address, _, responder in servers:
+        # Each of the three requests is challenged every time the server
+        # is polled, so the querier must've retried every one of them.
+        if responder.challenges != 3 * len(results):
+            raise serverstf.FatalError(
+                "Expected {} challenges from {} but it issued {}".format(
+                    3 * len(results), address, responder.challenges))
+    return [(name, len(servers) / elapsed) for name, elapsed in results]
+
+
+@serverstf.cli.subcommand("bench-a2s")
+@serverstf.cli.argument(
+    "--servers",
+    type=int,
+    default=200,
+    help="The number of fake servers to poll. Default is 200.",
+)
+@serverstf.cli.argument(
+    "--players",
+    type=int,
+    default=32,
+    help="The number of players on each fake server. Default is 32.",
+)
+@serverstf.cli.argument(
+    "--latency",
+    type=float,
+    default=5.0,
+    help=("The number of milliseconds each fake server delays its "
+          "responses by. Default is 5."),
+)
+def _bench_a2s_main(args):
+    """Measure how quickly servers are polled by the A2S client.
+
+    Fake servers are started on the loopback interface. Every request they
+    receive is challenged. Their players responses are split across
+    multiple packets and their rules responses are also BZip2 compressed.
+    Each server is polled for its info, players and rules, first one
+    server at a time as the poller used to and then all at once. The
+    number of servers polled per second is printed for each. The decoded
+    responses are checked against those sent.
+    """
+    loop = asyncio.get_event_loop()
+    print("Polling     Polls/second")
+    for name, rate in loop.run_until_complete(_bench_a2s(args, loop)):
+        print("{:10}  {:12.0f}".format(name, rate))
@@ -0,0 +1,175 @@
+"""Handles caching of server statuses.
+
+Server states are stored in Redis. It tracks their general info such as,
+the server name, map, player counts and scores. Additionally it maintains
+an index of all the tags applied to a server.
+
+Each server is uniquely identified by its address which is a combination of
+the IP address of the host and the port number -- these are represented by
+:class:`Address` objects. These address also act as Redis keys.
+
+
+Redis Schema:
+-------------
+
+Redis has a fairly limited type system meaning that the stored values are
+all UTF-8 encoded strings. The API provided by this module will transparently
+translate these strings to more appropriate Python types.
+
+All keys are UTF-8 encoded. When a server address is used in a conventional
+colon-separated IP-port form where the IP address it self is in the dotted
+decimal format. For example: ``0.0.0.0:8000``.
+
+Each key is prefixed by ``serverstf`` in order to act as a kind of namespace.
+Key *namespaces* are separated by forward slashes.
+
+``SET serverstf/servers``
+    A set containing the addresses of all the servers in the cache. This is
+    the authorative list of all servers tracked by the cache. The addresses
+    themselves are just UTF-8 encoded string representations of
+    :class:`Address`es.
+
+``HASH serverstf/servers/<ip>:<port>``
+    These hashes hold the current state of the server corresponding to the
+    key. Each hash has the following keys:
+
+    * ``name``
+    * ``map``
+    * ``application_id``
+    * ``players``
+    * ``fingerprint``
+    * ``sequence``
+
+    The ``players`` field tracks the players on the server. Include the
+    current number of players, the maximum allowed, how many are boths and
+    each individual player's name, score and connection time.
+
+    As this is a non-trivial structure it is stored in a compact binary
+    form, see :meth:`Players.to_bytes`. Older versions stored it as a JSON
+    object (still UTF-8 encoded) and these are still understood. The JSON
+    object contains four fields:
+
+    ``current``
+        The current number of players.
+
+    ``max``
+        The maximum number of players supported by the server.
+
+    ``bots``
+        The number of players that are bots.
+
+    ``scores``
+        An array of three-item arrays which contains (in the following order)
+        the player name as a string, their score as a number and their
+        connection duration in seconds as a float.
+
+    The ``fingerprint`` is a hex digest of all the other fields and the
+    server's tags. It is used to skip writes of statuses that haven't
+    changed since they were last committed.
+
+    The ``sequence`` is an integer that is incremented every time the status
+    changes. It's published along with the names of the changed fields so
+    that subscribers can apply partial updates and detect missed ones.
+
+    When one of these server status hashes is retrieved from the cache it
+    translated to a :class:`Status` object.
+
+``SET serverstf/servers/<ip>:<port>/tags``
+    A set containing all the tags currently applied to the server referenced
+    by the key. The tags themselves are UTF-8 encoded.
+
+``NUMBER serverstf/servers/<ip>:<port>/interest``
+    This is an integer key which is used to track how much interest there is
+    in a server. It is used by the interest queue to determine how frequently
+    the server should be polled.
+
+``SET serverstf/tags/<tag>``
+    These sets hold any number of server addresses (formatted as described
+    above and UTF-8 encoded). Server's who's addresses are contained in one
+    of these sets is understood to have the ``<tag>`` in their own
+    ``serverstf/servers/<ip>:<port>/tags`` set.
+
+``ZSET serverstf/ranks/players``
+    A sorted set of all server addresses scored by the current number of
+    players on the server.
+
+``ZSET serverstf/ranks/free``
+    A sorted set of all server addresses scored by the number of free
+    player slots on the server.
+
+``ZSET serverstf/ranks/location``
+    A Redis geospatial index (which is a sorted set scored by geohash) of
+    the addresses of all servers whose location is known.
+
+    The ranks are maintained alongside the server status hashes and are
+    used to sort search results. See :meth:`AsyncCache.query`.
+
+``HASH serverstf/searches``
+    The registry of cached search results. Each field is the ID of a
+    search, which is a hex digest of its sorted included and excluded tags.
+    The values are JSON arrays of two arrays: the included and excluded
+    tags.
+
+``SET serverstf/searches/<id>``
+    The cached addresses matching the search with the given ID. These
+    expire after a short time, after which the search is performed again
+    from scratch. Until then they're kept up to date incrementally as the
+    tags of servers change.
+
+``SET serverstf/searches/tags/<tag>``
+    The IDs of all the cached searches that include or exclude the tag.
+
+``SET serverstf/live``
+    The subset of the authorative set that isn't failing. Servers are added
+    when they're first added to the cache and whenever they're polled
+    successfully. They're removed when a poll fails. Pollers that poll
+    every server only scan this set; see :meth:`AsyncCache.scan`.
+
+``ZSET serverstf/seen``
+    A sorted set of server addresses scored by the UNIX timestamp at which
+    each was last successfully polled.
+
+``HASH serverstf/failures``
+    The number of consecutive failed polls for each unresponsive server,
+    keyed by address. A server's field is removed as soon as it is polled
+    successfully.
+
+``ZSET serverstf/failing``
+    A sorted set of the addresses of unresponsive servers, scored by the
+    UNIX timestamp of the first of their consecutive failed polls. Like the
+    failure counts, a server is removed as soon as it is polled
+    successfully.
+
+    Servers which have been failing for longer than a configurable *dead
+    period* are evicted from the cache entirely. See :meth:`AsyncCache.dead`
+    and :meth:`AsyncCache.evict`.
+
+``ZSET serverstf/interesting``
+    This is the *interest queue*. It is a sorted set of UTF-8 encoded
+    stringified :class:`Address`es, each scored by the UNIX timestamp at
+    which the server is next due to be polled.
+
+    Pollers pop batches of due addresses from the queue. Popping an address
+    atomically reschedules it based on the current interest in the server;
+    the more interest, the sooner it's due again. Addresses without any
+    interest are removed from the queue instead. Each address occurs in the
+    queue at most once regardless of how much interest there is in it.
+"""
+
+from serverstf.cache.asynchronous import (AsyncCache,
+                                          CacheError,
+                                          EmptyQueueError,
+                                          EndOfQueueError,
+                                          FiniteAsyncQueue)
+from serverstf.cache.local import LocalCache
+from serverstf.cache.notify import (Multiplexer,
+                                    MultiplexedNotifier,
+                                    Notification,
+                                    Notifier,
+                                    NotifierError)
+from serverstf.cache.status import (Address,
+                                    AddressError,
+                                    Players,
+                                    PlayersError,
+                                    Status)
+from serverstf.cache.synchronous import Cache, ThreadedCache
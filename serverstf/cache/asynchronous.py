@@ -0,0 +1,1173 @@
+"""Asynchronous access to the Redis state cache."""
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import time
+import uuid
+import urllib.parse
+
+import asyncio_redis
+import asyncio_redis.encoders
+
+from serverstf.cache import scripts
+from serverstf.cache.local import LocalCache
+from serverstf.cache.notify import Notifier
+from serverstf.cache.status import (Address,
+                                    AddressError,
+                                    Players,
+                                    PlayersError,
+                                    Status)
+
+
+log = logging.getLogger(__name__)
+
+
+class CacheError(Exception):
+    """Base exception for all cache related errors."""
+
+
+class EmptyQueueError(Exception):
+    """Raised when attempting to pop from an empty interest queue."""
+
+
+#: The in-process status cache along with the notifier and task which
+#: invalidate it; see :meth:`AsyncCache.cache_locally`
+_Local = collections.namedtuple("_Local", ("cache", "notifier", "invalidator"))
+
+
+class AsyncCache:
+    """Asynchronous access to a Redis state cache.
+
+    Do not instantiate this class directly. Instead use the :meth:`connect`
+    coroutine.
+    """
+    # :ivar _connection: the :class:`asyncio_redis.Connection` or
+    #   :class:`asyncio_redis.Pool` to use.
+    # :ivar _options: the keyword arguments used to create ``_connection``.
+    # :ivar _loop: the :mod:`asyncio` event loop to use.
+    # :ivar _transactions: a semaphore bounding concurrent transactions.
+    # :ivar _local: the :class:`_Local` cache state or ``None``.
+
+    #: The encoding to use for Unicode strings.
+    ENCODING = "utf-8"
+    #: The root key namespace
+    NAMESPACE = "serverstf"
+    #: Poll interval in seconds for servers with an interest of one
+    IQ_INTERVAL = 60.0
+    #: The shortest poll interval in seconds regardless of interest
+    IQ_INTERVAL_MIN = 5.0
+    #: The number of due addresses to pop from the interest queue at once
+    IQ_BATCH_SIZE = 64
+    #: Keys search results can be sorted by; see :meth:`query`
+    SORT_KEYS = ("players", "free", "latency")
+    #: Number of seconds search results are cached for
+    SEARCH_TTL = 10
+    #: Default SSCAN batch size hint; see :meth:`scan`
+    SCAN_COUNT = 1000
+    #: Number of times to read a server's tags and try again when they
+    #: change under :meth:`set` or :meth:`evict`
+    SNAPSHOT_ATTEMPTS = 8
+    #: Whether to store players in their binary form or as JSON. Both
+    #: forms can always be read.
+    BINARY_PLAYERS = True
+
+    def __init__(self, connection, loop, *, options, pool_size=None):
+        self._connection = connection
+        self._options = options
+        self._loop = loop
+        # Each transaction holds a pooled connection until it's executed.
+        # One connection is always left free for pipelining commands
+        # outside of transactions, as the pool refuses to queue commands
+        # when every connection is held. Without a pool transactions are
+        # serialised on the single connection.
+        self._transactions = asyncio.Semaphore(
+            pool_size - 1 if pool_size else 1, loop=loop)
+        self._scripts = {}
+        self._local = None
+        self._iq_buffer = collections.deque()
+
+    def __repr__(self):
+        return "<{0.__class__.__name__} using {0._connection}>".format(self)
+
+    @classmethod
+    @asyncio.coroutine
+    def connect(cls, url, loop, *, pool_size=None):
+        """Establish a connection to a Redis database.
+
+        :param str url: the URL of the Redis database to connect to.
+        :param loop: the :mod:`asyncio` event loop to use.
+        :param int pool_size: if given, a pool of this many connections is
+            used instead of a single connection. Independent commands are
+            pipelined over the pool's connections whereas each transaction
+            holds one of them for its duration. Pools must have at least
+            two connections so that one is always free for commands
+            outside of transactions.
+
+        :raises ValueError: if the pool size is less than two.
+        :return: a context manager that, when entered yields a newly
+            create :class:`AsyncCache` instance which is bound to a Redis
+            connection.
+        """
+        if pool_size is not None and pool_size < 2:
+            raise ValueError("Pools need at least two connections "
+                             "but got {}".format(pool_size))
+        log.info("Connecting to cache at %s", url)
+        url = urllib.parse.urlsplit(url)
+        options = {
+            "host": url.hostname,
+            "port": url.port,
+            "db": int(url.path.split("/")[1]),
+            "loop": loop,
+            "encoder": asyncio_redis.encoders.BytesEncoder(),
+        }
+        if pool_size is None:
+            connection = yield from asyncio_redis.Connection.create(**options)
+        else:
+            connection = yield from asyncio_redis.Pool.create(
+                poolsize=pool_size, **options)
+        return cls(connection, loop, options=options, pool_size=pool_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, value, type_, trace):
+        self.close()
+
+    @property
+    def loop(self):
+        """Get the event loop used by this cache."""
+        return self._loop
+
+    def close(self):
+        """Close the connection to Redis.
+
+        Once the connection is closed the object is invalidated and can no
+        longer be used.
+        """
+        if self._local:
+            self._local.invalidator.cancel()
+            self._local.notifier.close()
+        self._connection.close()
+        # Hack to work around the fact that closing the connection doesn't
+        # clean up tasks started by asyncio_redis. See:
+        # https://github.com/jonathanslenders/asyncio-redis/issues/56
+        if not self._loop.is_running():
+            self._loop.run_until_complete(asyncio.sleep(0))
+
+    @asyncio.coroutine
+    def __notifier(self):
+        """Get a notifier for the cache.
+
+        :return: a :class:`Notifier` object connected to the same Redis
+            database as the cache. The notifier always has a dedicated
+            connection, separate from any pool, as watching puts it into
+            pub/sub mode.
+        """
+        connection = \
+            yield from asyncio_redis.Connection.create(**self._options)
+        return Notifier(connection, self.ENCODING, self.NAMESPACE)
+
+    @property
+    def local_cache(self):
+        """Get the in-process status cache.
+
+        :return: the :class:`LocalCache` or ``None`` if it hasn't been
+            enabled with :meth:`cache_locally`.
+        """
+        return self._local and self._local.cache
+
+    @asyncio.coroutine
+    def cache_locally(self, size):
+        """Enable the in-process status cache.
+
+        Once enabled, :meth:`get` will serve statuses from memory when
+        possible. Up to ``size`` statuses are held. They are invalidated
+        when a server notification is published for them, which
+        :meth:`set` does for every change. A dedicated notifier is used to
+        watch for these notifications.
+
+        Anything else that caches statuses read through :meth:`get` on
+        receipt of notifications from another connection must invalidate
+        the local cache itself first, as the dedicated notifier may not
+        have received the notification yet.
+
+        Note that changes to a server's interest don't cause notifications
+        so :attr:`Status.interest` may be stale for cached statuses.
+
+        :param int size: the maximum number of statuses to hold in memory.
+
+        :return: the :class:`LocalCache`.
+        """
+        if self._local:
+            raise CacheError("Local cache already enabled")
+        notifier = yield from self.__notifier()
+        yield from notifier.watch_all_servers()
+        local = LocalCache(size)
+        self._local = _Local(local, notifier, asyncio.Task(
+            self._invalidate_local(local, notifier), loop=self._loop))
+        log.info("Caching up to %i statuses locally", size)
+        return local
+
+    @staticmethod
+    @asyncio.coroutine
+    def _invalidate_local(local, notifier):
+        """Continually invalidate locally cached statuses."""
+        while True:
+            notification = yield from notifier.watch()
+            local.invalidate(notification.address)
+
+    def _key(self, *parts):
+        """Construct a Redis key from contituent parts.
+
+        Each part of the key will be converted to a string before being
+        joined together separated by forward slashes. Each key has an
+        implicitly first part ``serverstf``. The key will be encoded as
+        UTF-8.
+
+        :return: a bytestring containing the encoded key.
+        """
+        key = [self.NAMESPACE]
+        for part in parts:
+            key.append(str(part))
+        return "/".join(key).encode(self.ENCODING)
+
+    @asyncio.coroutine
+    def _run_script(self, source, keys, args):
+        """Run a Lua script on the Redis server.
+
+        Scripts are loaded with ``SCRIPT LOAD`` the first time they're used
+        and then run with ``EVALSHA`` thereafter. If the server has lost the
+        script, e.g. due to a restart, then it is loaded again. Each
+        ``EVALSHA`` is issued through :attr:`_connection` so that pooled
+        caches spread script calls across connections.
+
+        ``asyncio_redis`` reports every ``EVALSHA`` error, including the
+        script having gone missing, as :exc:`asyncio_redis.ScriptKilledError`
+        so any error is treated as a missing script once.
+
+        :param str source: the Lua source of the script.
+        :param keys: a list of bytestrings for the script's ``KEYS``.
+        :param args: a list of bytestrings for the script's ``ARGV``.
+
+        :raises CacheError: if the script couldn't be run.
+        :return: the value returned by the script.
+        """
+        for _ in range(2):
+            if source not in self._scripts:
+                script = yield from self._connection.register_script(source)
+                self._scripts[source] = script.sha
+            try:
+                reply = yield from self._connection.evalsha(
+                    self._scripts[source], keys=keys, args=args)
+            except asyncio_redis.ScriptKilledError:
+                log.warning("Script failed or went missing; reloading it")
+                del self._scripts[source]
+            else:
+                return (yield from reply.return_value())
+        raise CacheError("Couldn't run script")
+
+    def _random_key(self):
+        """Construct a random Redis key.
+
+        This will create a normal key (see :meth:`_key`) using a random UUID
+        so it's safe to use for temporary usage.
+
+        :return: a bytestring containing the encoded key.
+        """
+        return self._key("random", uuid.uuid4())
+
+    def _tag_keys(self, tags):
+        """Construct the keys a script needs to index and search tags.
+
+        :param tags: a list of bytestring tags.
+
+        :return: a list of bytestrings containing the tag index key of each
+            tag followed by the search set key of each tag, in the same
+            order as the tags.
+        """
+        index = self._key("tags", "")
+        searches = self._key("searches", "tags", "")
+        return [index + tag for tag in tags] + [searches + tag for tag in tags]
+
+    def _results_keys(self, searches):
+        """Construct the result keys of cached searches.
+
+        :param searches: a list of bytestring search IDs.
+
+        :return: a list of bytestrings containing the key of each search's
+            results in the same order as the IDs.
+        """
+        prefix = self._key("searches", "")
+        return [prefix + search for search in searches]
+
+    @asyncio.coroutine
+    def _snapshot_tags(self, address, tags=frozenset()):
+        """Read a server's tags and the searches that depend on them.
+
+        Scripts which change a server's tags are given this snapshot so
+        that they can declare every key they access. They check it's still
+        accurate before writing anything.
+
+        :param Address address: the address of the server.
+        :param tags: a set of bytestring tags the server is to have.
+
+        :return: a tuple containing two sorted lists of bytestrings. The
+            server's current tags and the IDs of the searches that include
+            or exclude any tag which differs between the current tags and
+            ``tags``.
+        """
+        old_tags = yield from self._connection.smembers_asset(
+            self._key("servers", address, "tags"))
+        changed = old_tags ^ set(tags)
+        searches = set()
+        if changed:
+            prefix = self._key("searches", "tags", "")
+            reply = yield from self._connection.sunion(
+                [prefix + tag for tag in changed])
+            searches = yield from reply.asset()
+        return sorted(old_tags), sorted(searches)
+
+    @asyncio.coroutine
+    def _run_tag_script(self, source, address, keys, args, tags=None):
+        """Run a script which is given a snapshot of a server's tags.
+
+        The snapshot is taken by :meth:`_snapshot_tags`. The tag index and
+        search set keys of each tag and then the result keys of each search
+        are appended to the script's ``KEYS``. The number of tags the server
+        has, the number it's to have if ``tags`` is given, the tags and the
+        search IDs are appended to its ``ARGV``.
+
+        The script should return ``false`` if the snapshot is no longer
+        accurate, in which case it's taken and the script run again up to
+        :attr:`SNAPSHOT_ATTEMPTS` times.
+
+        :param str source: the Lua source of the script.
+        :param Address address: the address of the server.
+        :param keys: a list of bytestrings for the script's own ``KEYS``.
+        :param args: a list of bytestrings for the script's own ``ARGV``.
+        :param tags: a set of bytestring tags the server is to have, if
+            they're to change.
+
+        :raises CacheError: if the server's tags kept changing.
+        :return: the value returned by the script.
+        """
+        new_tags = sorted(tags or [])
+        for _ in range(self.SNAPSHOT_ATTEMPTS):
+            old_tags, searches = \
+                yield from self._snapshot_tags(address, new_tags)
+            counts = [len(old_tags)]
+            if tags is not None:
+                counts.append(len(new_tags))
+            all_tags = old_tags + new_tags
+            reply = yield from self._run_script(
+                source,
+                keys + self._tag_keys(all_tags) + self._results_keys(searches),
+                args + [str(count).encode(self.ENCODING) for count in counts]
+                + all_tags + searches)
+            if reply is not None:
+                return reply
+            log.debug("Tags of %s changed; reading them again", address)
+        raise CacheError("Tags of {} kept changing".format(address))
+
+    @asyncio.coroutine
+    def _forget_searches(self, searches):
+        """Remove expired searches from the search registry.
+
+        Each search is forgotten by :data:`serverstf.cache.scripts.FORGET`
+        unless it has been cached again in the meantime.
+
+        :param searches: an iterable of bytestring search IDs.
+        """
+        registry = self._key("searches")
+        prefix = self._key("searches", "tags", "")
+        for search in searches:
+            spec = yield from self._connection.hget(registry, search)
+            if spec is None:
+                continue
+            try:
+                include, exclude = json.loads(spec.decode(self.ENCODING))
+            except (ValueError, TypeError) as exc:
+                log.warning("Bad search registry entry %r: %s", search, exc)
+                continue
+            keys = [registry] + self._results_keys([search])
+            for tag in list(include) + list(exclude):
+                keys.append(prefix + tag.encode(self.ENCODING))
+            yield from self._run_script(scripts.FORGET, keys, [search, spec])
+
+    @asyncio.coroutine
+    def __ensure(self, address):
+        """Ensure the address exists in the authorative set.
+
+        The address is stringified and UTF-8 encoded before being added to
+        the authorative set. Unless the server is currently failing it's
+        also added to the live servers, so new servers are assumed to be
+        live until they're first polled.
+
+        :param Address address: the address to add to the cache.
+
+        :return: ``True`` if the address didn't already exist in the cache,
+            ``False`` otherwise.
+        """
+        added = yield from self._run_script(scripts.ENSURE, [
+            self._key("servers"),
+            self._key("live"),
+            self._key("failing"),
+        ], [str(address).encode(self.ENCODING)])
+        return added == 1
+
+    @asyncio.coroutine
+    def __get(self, address):
+        """Retrieve a server status from the cache.
+
+        If the local cache is enabled (see :meth:`cache_locally`) then the
+        status will be served from memory if possible.
+
+        :param Address address: the address of the server whose status is
+            to be retrieved.
+
+        :return: a :class:`Status` representing the current state of the
+            cache for the give address.
+        """
+        if not self._local:
+            return (yield from self.__read(address))
+        local = self._local.cache
+        status = local.get(address)
+        if status is None:
+            token = local.begin(address)
+            try:
+                status = yield from self.__read(address)
+            finally:
+                local.end(address, token, status)
+        return status
+
+    @asyncio.coroutine
+    def __get_many(self, addresses):
+        """Retrieve many server statuses from the cache at once.
+
+        All the statuses which aren't served from the local cache are read
+        in a single transaction, so this only takes one round trip to Redis
+        regardless of the number of addresses.
+
+        :param addresses: an iterable of :class:`Address`es.
+
+        :return: a dictionary mapping each of the given addresses to its
+            :class:`Status`.
+        """
+        addresses = set(addresses)
+        if not self._local:
+            return (yield from self.__read_many(addresses))
+        local = self._local.cache
+        statuses = {}
+        tokens = {}
+        for address in addresses:
+            status = local.get(address)
+            if status is None:
+                tokens[address] = local.begin(address)
+            else:
+                statuses[address] = status
+        read = {}
+        try:
+            read = yield from self.__read_many(tokens.keys())
+        finally:
+            for address, token in tokens.items():
+                local.end(address, token, read.get(address))
+        statuses.update(read)
+        return statuses
+
+    @asyncio.coroutine
+    def __read(self, address):
+        """Read a server status from Redis.
+
+        :param Address address: the address of the server whose status is
+            to be retrieved.
+
+        :return: a :class:`Status` for the given address.
+        """
+        return (yield from self.__read_many([address]))[address]
+
+    @asyncio.coroutine
+    def __read_many(self, addresses):
+        """Read many server statuses from Redis in a single transaction.
+
+        :param addresses: an iterable of :class:`Address`es.
+
+        :return: a dictionary mapping each address to its :class:`Status`.
+        """
+        addresses = list(addresses)
+        if not addresses:
+            return {}
+        futures = {}
+        with (yield from self._transactions):
+            transaction = yield from self._connection.multi()
+            for address in addresses:
+                log.debug("Get %s", address)
+                futures[address] = (
+                    (yield from transaction.hgetall_asdict(
+                        self._key("servers", address))),
+                    (yield from transaction.smembers_asset(
+                        self._key("servers", address, "tags"))),
+                    (yield from transaction.incrby(
+                        self._key("servers", address, "interest"), 0)),
+                )
+            yield from transaction.exec()
+        statuses = {}
+        for address, (f_hash, f_tags, f_interest) in futures.items():
+            statuses[address] = self._decode_status(
+                address,
+                (yield from f_hash),
+                (yield from f_tags),
+                (yield from f_interest),
+            )
+        return statuses
+
+    def _decode_status(self, address, hash_, tags, interest):
+        """Decode a server status read from the cache.
+
+        :param Address address: the address of the server.
+        :param dict hash_: the status hash with bytestring keys and values.
+        :param tags: a set of bytestring tags.
+        :param int interest: the server's interest.
+
+        :return: a :class:`Status`.
+        """
+        tags = {tag.decode(self.ENCODING) for tag in tags}
+        players = hash_.get(b"players", b"")
+        hash_ = {key.decode(self.ENCODING):
+                 value.decode(self.ENCODING) for
+                 key, value in hash_.items() if key != b"players"}
+        fields = {
+            "interest": interest,
+            "name": hash_.get("name"),
+            "map": hash_.get("map"),
+            "application_id": None,
+            "players": None,
+            "country": hash_.get("country"),
+            "latitude": None,
+            "longitude": None,
+            "tags": tags,
+            "sequence": None,
+        }
+        try:
+            fields["application_id"] = int(hash_.get("application_id"))
+        except (ValueError, TypeError) as exc:
+            log.warning("Could not convert application_id "
+                        "for %s to int: %s", address, exc)
+        try:
+            fields["sequence"] = int(hash_.get("sequence", 0))
+        except ValueError as exc:
+            log.warning("Could not convert sequence "
+                        "for %s to int: %s", address, exc)
+        for field in ("latitude", "longitude"):
+            try:
+                fields[field] = float(hash_.get(field))
+            except (ValueError, TypeError) as exc:
+                log.warning("Could not convert %s for %s "
+                            "to float: %s", field, address, exc)
+        try:
+            fields["players"] = Players.from_bytes(players)
+        except PlayersError as exc:
+            log.warning("Could not decode players "
+                        "for %s: %s", address, exc)
+        return Status.from_cache(address, fields)
+
+    def _encode_status(self, status):
+        """Encode a server status for storage in the cache.
+
+        All hash fields are converted to strings and encoded as UTF-8. If any
+        fields on the server status are ``None`` then they are omitted from
+        the hash. The tags are also UTF-8 encoded.
+
+        A ``fingerprint`` field is added to the hash. This is a digest of all
+        the other fields and the tags which can be compared to detect
+        unchanged statuses.
+
+        :param Status status: the status to encode.
+
+        :return: a tuple containing the encoded hash as a dictionary and the
+            encoded tags as a set.
+        """
+        hash_ = {}
+        for attribute in {"name", "map", "application_id",
+                          "country", "latitude", "longitude"}:
+            value = getattr(status, attribute)
+            if value is not None:
+                hash_[attribute] = str(value)
+        hash_ = {key.encode(self.ENCODING):
+                 value.encode(self.ENCODING) for key, value in hash_.items()}
+        if self.BINARY_PLAYERS:
+            hash_[b"players"] = status.players.to_bytes()
+        else:
+            hash_[b"players"] = \
+                status.players.to_json().encode(self.ENCODING)
+        tags = {tag.encode(self.ENCODING) for tag in status.tags}
+        fingerprint = hashlib.sha1()
+        for key, value in sorted(hash_.items()):
+            fingerprint.update(key + b"\x00" + value + b"\x00")
+        for tag in sorted(tags):
+            fingerprint.update(b"\x01" + tag)
+        hash_[b"fingerprint"] = fingerprint.hexdigest().encode(self.ENCODING)
+        return hash_, tags
+
+    @asyncio.coroutine
+    def __set(self, status):
+        """Commit a server status to the cache.
+
+        This sets the primary server state HASH key and the tags SET for the
+        server. Both the HASH and SET are completely overridden. It also
+        ensures the address is in the authorative set.
+
+        As well as updating server-specific keys this will update the global
+        tag SETs. The UTF-8 encoded stringified address is added to the
+        global tag SETs for all the server's tags and removed from those
+        of tags the server no longer has.
+
+        The server's player count, free slots and location are recorded in
+        the ranks used to sort :meth:`query` results. The ranks are kept up
+        to date even if the rest of the status is unchanged, as are the
+        server's last seen time and failure count (see :meth:`fail`). If
+        the server's tags change then any cached search results that include
+        or exclude those tags are updated.
+
+        Finally, notifications are published for the server and for each tag
+        that has been applied to or removed from it. The server's sequence
+        number is incremented and the server notification lists the fields
+        that have changed. The tag notifications describe how the server's
+        tags changed, see :meth:`Notifier.watch`.
+
+        If the status is identical to the one already in the cache, as
+        determined by comparing fingerprints, then nothing is written and no
+        notifications are sent.
+
+        The commit is done by a Lua script (see
+        :data:`serverstf.cache.scripts.SET`) so it's atomic. As scripts must
+        be given every key they access, the server's current tags and the
+        searches that depend on the changed ones are read beforehand. If
+        either changes before the script runs then nothing is committed and
+        they're read again. Any cached searches which turn out to have
+        expired are forgotten afterwards.
+
+        Note that the :attr:`Status.interest` field is ignored when setting
+        the state.
+
+        :param Status status: the new status for the server.
+
+        :raises CacheError: if the server's tags kept changing.
+        :return: a tuple containing two frozensets: the tags that were added
+            to the server and those that were removed. Both will be empty if
+            the status was unchanged.
+        """
+        address = str(status.address).encode(self.ENCODING)
+        hash_, tags = self._encode_status(status)
+        keys = [
+            self._key("servers"),
+            self._key("servers", status.address),
+            self._key("servers", status.address, "tags"),
+            self._key("ranks", "players"),
+            self._key("ranks", "free"),
+            self._key("ranks", "location"),
+            self._key("searches"),
+            self._key("seen"),
+            self._key("failures"),
+            self._key("failing"),
+            self._key("live"),
+        ]
+        args = [
+            address,
+            self._key("channels", Notifier.SERVER, status.address),
+            self._key("channels", Notifier.TAG, ""),
+            hash_[b"fingerprint"],
+            repr(time.time()).encode(self.ENCODING),
+            str(len(hash_)).encode(self.ENCODING),
+        ]
+        for field, value in hash_.items():
+            args.extend([field, value])
+        added, removed, expired = yield from self._run_tag_script(
+            scripts.SET, status.address, keys, args, tags)
+        yield from self._forget_searches(expired)
+        log.debug("Set %s with %i tags (%i removed)",
+                  status.address, len(tags), len(removed))
+        return (frozenset(tag.decode(self.ENCODING) for tag in added),
+                frozenset(tag.decode(self.ENCODING) for tag in removed))
+
+    @asyncio.coroutine
+    def __set_many(self, statuses):
+        """Commit a batch of server statuses to the cache.
+
+        Each status is committed as per :meth:`set`. The commits are made
+        concurrently so the whole batch costs about as many round trips as
+        a single commit.
+
+        If the same address occurs more than once in the batch then only the
+        last status for it is committed.
+
+        :param statuses: an iterable of :class:`Status`es to commit.
+
+        :return: a dictionary mapping each committed :class:`Address` to the
+            added and removed tags as returned by :meth:`set`.
+        """
+        statuses = {status.address: status for status in statuses}
+        results = yield from asyncio.gather(
+            *[self.__set(status) for status in statuses.values()],
+            loop=self._loop
+        )
+        return dict(zip(statuses.keys(), results))
+
+    @asyncio.coroutine
+    def subscribe(self, address):
+        """Increase the interest in an address.
+
+        This will increase the interest for a server and schedule it to be
+        polled immediately by adding it to the interest queue.
+
+        :param Address address: the address of the server to increase the
+            interest for.
+        """
+        key_interest = self._key("servers", address, "interest")
+        interest = yield from self._connection.incr(key_interest)
+        yield from self._connection.zadd(
+            self._key("interesting"),
+            {str(address).encode(self.ENCODING): time.time()})
+        log.debug("Interest in %s now %i", address, interest)
+
+    @asyncio.coroutine
+    def _pop_iq(self, count):
+        """Pop due addresses from the interest queue.
+
+        Due addresses are found by :data:`serverstf.cache.scripts.IQ_DUE`
+        and then claimed by :data:`serverstf.cache.scripts.IQ_POP`, which
+        needs their interest keys. Claiming and rescheduling a batch of
+        addresses is atomic, so addresses claimed by another poller in
+        between are skipped rather than popped twice.
+
+        :param int count: the maximum number of addresses to pop.
+
+        :return: a list of due :class:`Address`es.
+        """
+        queue = self._key("interesting")
+        now = repr(time.time()).encode(self.ENCODING)
+        candidates = yield from self._run_script(scripts.IQ_DUE, [queue], [
+            now,
+            str(int(count)).encode(self.ENCODING),
+        ])
+        if not candidates:
+            return []
+        prefix = self._key("servers", "")
+        keys = [queue]
+        keys.extend(prefix + address + b"/interest" for address in candidates)
+        due = yield from self._run_script(scripts.IQ_POP, keys, [
+            now,
+            repr(self.IQ_INTERVAL).encode(self.ENCODING),
+            repr(self.IQ_INTERVAL_MIN).encode(self.ENCODING),
+        ] + candidates)
+        addresses = []
+        for raw_address in due:
+            try:
+                addresses.append(Address.from_cache(raw_address))
+            except AddressError as exc:
+                log.warning("Bad interest queue item: %s", exc)
+        return addresses
+
+    @asyncio.coroutine
+    def interesting_many(self, count):
+        """Get a batch of due addresses from the interest queue.
+
+        Unlike :meth:`interesting` this doesn't raise an exception when
+        there are no due addresses.
+
+        :param int count: the maximum number of addresses to get.
+
+        :return: a list of up to ``count`` :class:`Address`es.
+        """
+        addresses = []
+        while self._iq_buffer and len(addresses) < count:
+            addresses.append(self._iq_buffer.popleft())
+        if len(addresses) < count:
+            addresses.extend(
+                (yield from self._pop_iq(count - len(addresses))))
+        return addresses
+
+    @asyncio.coroutine
+    def interesting(self):
+        """Get a due address from the interest queue.
+
+        Due addresses are popped from the queue in batches of
+        :attr:`IQ_BATCH_SIZE` and then handed out one at a time. Popped
+        addresses are rescheduled automatically so there is no need to
+        re-enqueue them.
+
+        :raises EmptyQueueError: if there are no due addresses in the
+            interest queue.
+        :return: a :class:`Address` from the interest queue.
+        """
+        if not self._iq_buffer:
+            self._iq_buffer.extend((yield from self._pop_iq(
+                self.IQ_BATCH_SIZE)))
+        if not self._iq_buffer:
+            raise EmptyQueueError
+        return self._iq_buffer.popleft()
+
+    @asyncio.coroutine
+    def fail(self, address):
+        """Record a failed attempt to poll a server.
+
+        This increments the server's count of consecutive failures, which
+        is reset by the next successful :meth:`set`. If this is the first
+        of the consecutive failures then its time is recorded so that
+        :meth:`dead` can find servers that have been failing for too long.
+        The server is also removed from the live servers until it's next
+        set; see :meth:`scan`.
+
+        Failures aren't recorded for servers which aren't in the cache,
+        e.g. because they've been evicted.
+
+        :param Address address: the address of the server that failed.
+
+        :return: the number of consecutive failures for the server, or
+            ``None`` if it isn't in the cache.
+        """
+        failures = yield from self._run_script(scripts.FAIL, [
+            self._key("servers"),
+            self._key("live"),
+            self._key("failures"),
+            self._key("failing"),
+        ], [
+            str(address).encode(self.ENCODING),
+            repr(time.time()).encode(self.ENCODING),
+        ])
+        if not failures:
+            log.debug("%s failed but isn't in the cache", address)
+            return None
+        log.debug("%s has failed %i times", address, failures)
+        return failures
+
+    @asyncio.coroutine
+    def dead(self, before, count=None):
+        """Find servers that have been failing since before a given time.
+
+        Only servers that are currently failing are considered dead. A
+        server that simply hasn't been polled for a long time is not. The
+        servers which have been failing the longest are returned first.
+
+        :param float before: the UNIX timestamp that servers must have been
+            failing since.
+        :param int count: the maximum number of addresses to return.
+            Defaults to :attr:`SCAN_COUNT`.
+
+        :return: a list of dead :class:`Address`es.
+        """
+        raw_addresses = yield from self._run_script(scripts.DEAD, [
+            self._key("failing"),
+        ], [
+            repr(float(before)).encode(self.ENCODING),
+            str(int(count or self.SCAN_COUNT)).encode(self.ENCODING),
+        ])
+        return self._decode_addresses(raw_addresses)
+
+    @asyncio.coroutine
+    def evict(self, address):
+        """Remove a server from the cache.
+
+        The server is removed from the authorative set, the live servers,
+        the tag indexes, the ranks, cached search results and the interest
+        queue. Its
+        status, tags, interest, last seen time and failure records are all
+        deleted. Tag notifications are published as if all the server's
+        tags were removed so that live searches stop matching it.
+
+        This is done by a Lua script (see
+        :data:`serverstf.cache.scripts.EVICT`) which is given the server's
+        tags and the searches that depend on them, as read beforehand. They
+        are read again if they change before the script runs.
+
+        :param Address address: the address of the server to evict.
+
+        :raises CacheError: if the server's tags kept changing.
+        :return: a frozenset of the tags the server had.
+        """
+        keys = [
+            self._key("servers"),
+            self._key("servers", address),
+            self._key("servers", address, "tags"),
+            self._key("servers", address, "interest"),
+            self._key("ranks", "players"),
+            self._key("ranks", "free"),
+            self._key("ranks", "location"),
+            self._key("searches"),
+            self._key("interesting"),
+            self._key("seen"),
+            self._key("failures"),
+            self._key("failing"),
+            self._key("live"),
+        ]
+        args = [
+            str(address).encode(self.ENCODING),
+            self._key("channels", Notifier.TAG, ""),
+        ]
+        tags = yield from self._run_tag_script(
+            scripts.EVICT, address, keys, args)
+        log.info("Evicted %s with %i tags", address, len(tags))
+        return frozenset(tag.decode(self.ENCODING) for tag in tags)
+
+    @asyncio.coroutine
+    def scan(self, cursor=0, count=None, *, live=False):
+        """Fetch a batch of addresses from the authorative set.
+
+        This wraps ``SSCAN``. Starting with a cursor of zero, each call
+        returns the cursor for the next call. Once the returned cursor is
+        ``None`` all the addresses in the cache have been returned. As per
+        ``SSCAN``, addresses added or removed during the scan may or may not
+        be returned and addresses may be returned more than once.
+
+        :param int cursor: the cursor returned by the previous call, or zero
+            to start a new scan.
+        :param int count: the number of addresses to ask Redis for per
+            batch. This is only a hint; batches may be larger or smaller,
+            including empty. Defaults to :attr:`SCAN_COUNT`.
+        :param bool live: if set then only the live servers are scanned.
+            These are the servers that aren't failing; see :meth:`fail`.
+
+        :return: a tuple containing the next cursor and a list of
+            :class:`Address`es.
+        """
+        cursor, raw_addresses = yield from self._run_script(
+            scripts.SCAN, [self._key("live" if live else "servers")], [
+                str(int(cursor)).encode(self.ENCODING),
+                str(int(count or self.SCAN_COUNT)).encode(self.ENCODING),
+            ])
+        cursor = int(cursor)
+        addresses = []
+        for raw_address in raw_addresses:
+            try:
+                addresses.append(Address.from_cache(raw_address))
+            except AddressError as exc:
+                log.warning("Bad address in server set: %s", exc)
+        return (cursor or None), addresses
+
+    @asyncio.coroutine
+    def __scan_into(self, queue, count):
+        """Scan all addresses into a queue.
+
+        :param FiniteAsyncQueue queue: the queue to place :class:`Address`es
+            in.
+        :param int count: the ``SSCAN`` batch size hint.
+        """
+        with queue:
+            cursor = 0
+            while cursor is not None:
+                cursor, addresses = yield from self.scan(cursor, count)
+                for address in addresses:
+                    yield from queue.put(address)
+
+    @asyncio.coroutine
+    def all(self, count=None):
+        """Get all the addresses in the cache.
+
+        This returns a queue which will be populated by addresses that are
+        held by the cache. The addresses are fetched in batches, see
+        :meth:`scan`. Use :meth:`scan` directly to process addresses a
+        batch at a time.
+
+        :param int count: the ``SSCAN`` batch size hint.
+
+        :return: a :class:`FiniteAsyncQueue` containing :class:`Address`es.
+        """
+        queue = FiniteAsyncQueue(loop=self._loop)
+        asyncio.Task(self.__scan_into(queue, count), loop=self._loop)
+        return queue
+
+    def _search_args(self, include, exclude):
+        """Build the keys and arguments that identify a search to a script.
+
+        Searches are normalised by sorting their tags, so that the same
+        search will always be given the same ID regardless of the order
+        the tags are given in. See :data:`serverstf.cache.scripts.SEARCH`.
+
+        :param include: a set of tags that addresses must have.
+        :param exclude: a set of tags that addresses must not have.
+
+        :return: a tuple containing three lists of bytestrings. The search's
+            keys, the arguments which come before any script-specific ones
+            and the excluded tags which come last.
+        """
+        include = sorted(tag.encode(self.ENCODING) for tag in include)
+        exclude = sorted(tag.encode(self.ENCODING) for tag in exclude)
+        id_ = hashlib.sha1()
+        for tag in include:
+            id_.update(b"\x01" + tag)
+        for tag in exclude:
+            id_.update(b"\x02" + tag)
+        id_ = id_.hexdigest().encode(self.ENCODING)
+        keys = [self._key("searches")] + self._results_keys([id_])
+        keys.extend(self._tag_keys(include + exclude))
+        args = [
+            id_,
+            str(self.SEARCH_TTL).encode(self.ENCODING),
+            str(len(include)).encode(self.ENCODING),
+        ]
+        args.extend(include)
+        return keys, args, exclude
+
+    def _decode_addresses(self, raw_addresses):
+        """Decode search results, skipping any malformed addresses.
+
+        :return: a list of :class:`Address`es.
+        """
+        addresses = []
+        for raw_address in raw_addresses:
+            try:
+                addresses.append(Address.from_cache(raw_address))
+            except AddressError:
+                log.warning("Bad address in search results: %r", raw_address)
+        return addresses
+
+    @asyncio.coroutine
+    def search(self, *, include=None, exclude=None):
+        """Search for addresses by tags.
+
+        Search results are cached for :attr:`SEARCH_TTL` seconds. Whilst
+        cached they're kept up to date as servers' tags change, so repeated
+        searches only cost a single read.
+
+        :param include: a sequence of tags that addresses must have.
+        :param exclude: a sequence of tags that will be used to filter the
+            the set of addresses.
+
+        :return: a set of :class:`Address`es that match the query.
+        """
+        include = set(include or [])
+        exclude = set(exclude or [])
+        if not include:
+            return set()
+        keys, args, args_exclude = self._search_args(include, exclude)
+        raw_addresses = yield from self._run_script(
+            scripts.SEARCH, keys, args + args_exclude)
+        return set(self._decode_addresses(raw_addresses))
+
+    @asyncio.coroutine
+    def query(self, *, include, exclude=None,
+              sort=None, offset=0, limit=50, origin=None):
+        """Find a page of servers matching a tag query.
+
+        Unlike :meth:`search` the matching servers are sorted and only a
+        slice of them is returned. The sorting and slicing happens within
+        Redis so it doesn't matter how many servers match. The matching
+        servers are cached in the same way as for :meth:`search`.
+
+        Servers can be sorted by the following keys:
+
+        ``players``
+            The number of players on the server, most first. Servers with
+            an unknown number of players are sorted last.
+
+        ``free``
+            The number of free player slots, most first. Servers with an
+            unknown number of slots are sorted last.
+
+        ``latency``
+            The estimated latency to the server from the ``origin``, lowest
+            first. As latency is approximately proportional to distance, it
+            is estimated using the distance between the origin and the
+            server. Servers with an unknown location are sorted last.
+
+        If no sort key is given the servers are sorted by address.
+
+        :param include: a sequence of tags that addresses must have.
+        :param exclude: a sequence of tags that addresses must not have.
+        :param str sort: one of :attr:`SORT_KEYS` or ``None``.
+        :param int offset: the number of servers to skip.
+        :param int limit: the maximum number of servers to return.
+        :param origin: a two-tuple containing the latitude and longitude
+            to estimate latencies from. Required when sorting by latency.
+
+        :raises ValueError: if the sort key is not recognised or latency
+            sorting is requested without an origin.
+        :return: a tuple containing the total number of matching servers
+            and a list of the :class:`Address`es on the page.
+        """
+        if sort is not None and sort not in self.SORT_KEYS:
+            raise ValueError("Unknown sort key {!r}".format(sort))
+        if sort == "latency" and origin is None:
+            raise ValueError("Sorting by latency requires an origin")
+        include = set(include)
+        exclude = set(exclude or [])
+        if not include:
+            return 0, []
+        rank = "location" if sort == "latency" else sort or "players"
+        keys, args, args_exclude = self._search_args(include, exclude)
+        keys = [self._random_key(), self._key("ranks", rank)] + keys
+        latitude, longitude = origin or (0, 0)
+        args.extend(str(arg).encode(self.ENCODING) for arg in [
+            sort or "",
+            offset,
+            limit,
+            longitude,
+            latitude,
+        ])
+        total, raw_addresses = yield from self._run_script(
+            scripts.QUERY, keys, args + args_exclude)
+        return total, self._decode_addresses(raw_addresses)
+
+    notifier = __notifier
+    ensure = __ensure
+    get = __get
+    get_many = __get_many
+    set = __set
+    set_many = __set_many
+
+
+class EndOfQueueError(Exception):
+    """Raised when the end of a :class:`FiniteAsyncQueue` is reached."""
+
+
+class FiniteAsyncQueue(asyncio.Queue):
+    """A finite/closable asynchronous queue.
+
+    This is the exact same as :class:`asyncio.Queue` except that the queue
+    can be *closed*. When the queue is closed and exhausted and further
+    attempts to get items from the queue will raise an exception.
+
+    Instances of this class are context managers. When exited the queue
+    is closed meaning that once all items have been removed from the
+    queue future calls to :meth:`get` or :meth:`get_nowait` raise
+    :exc:`EndOfQueueError`.
+    """
+
+    def __init__(self, *, loop=None):
+        super().__init__(loop=loop)
+        self._closed = False
+        self._end_of_queue = object()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type_, value, traceback):
+        self.put_nowait(self._end_of_queue)
+        self._closed = True
+
+    def _check_end_of_queue(self, item):
+        """Check if an object is the special end-of-queue marker.
+
+        :param item: the object to check.
+
+        :raises EndOfQueueError: if the item is the end-of-queue marker.
+        :return: the given ``item``.
+        """
+        if item is self._end_of_queue:
+            raise EndOfQueueError
+        return item
+
+    @asyncio.coroutine
+    def get(self):
+        return self._check_end_of_queue((yield from super().get()))
+
+    def get_nowait(self):
+        return self._check_end_of_queue(super().get_nowait())
+
+    @asyncio.coroutine
+    def put(self, item):
+        if self._closed:
+            raise EndOfQueueError
+        yield from super().put(item)
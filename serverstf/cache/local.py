@@ -0,0 +1,78 @@
+"""In-process caching of server statuses."""
+
+import collections
+
+
+class LocalCache:
+    """Bounded, in-process cache of :class:`Status`es.
+
+    This is used by :class:`AsyncCache` to serve repeat reads from memory.
+    When full the least recently used status is discarded.
+
+    Reads that miss must be bracketed by calls to :meth:`begin` and
+    :meth:`end`. If the status is invalidated in between then it isn't
+    stored, as it may already be stale.
+
+    :ivar size: the maximum number of statuses held.
+    :ivar hits: the number of reads served from memory.
+    :ivar misses: the number of reads that weren't.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._statuses = collections.OrderedDict()
+        self._pending = {}
+
+    def __repr__(self):
+        return ("<{0.__class__.__name__} {1}/{0.size} "
+                "({0.hits} hits, {0.misses} misses)>".format(self, len(self)))
+
+    def __len__(self):
+        return len(self._statuses)
+
+    def get(self, address):
+        """Get a status from memory.
+
+        :param Address address: the address of the server.
+
+        :return: the :class:`Status` or ``None`` if it's not held.
+        """
+        status = self._statuses.get(address)
+        if status is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._statuses.move_to_end(address)
+        return status
+
+    def begin(self, address):
+        """Start reading a status that missed.
+
+        :return: a token to pass to :meth:`end`.
+        """
+        token = object()
+        self._pending[address] = token
+        return token
+
+    def end(self, address, token, status=None):
+        """Finish reading a status that missed.
+
+        :param Address address: the address of the server.
+        :param token: the token returned by :meth:`begin`.
+        :param Status status: the status that was read or ``None`` if the
+            read failed.
+        """
+        if self._pending.get(address) is not token:
+            return
+        del self._pending[address]
+        if status is not None:
+            self._statuses[address] = status
+            while len(self._statuses) > self.size:
+                self._statuses.popitem(last=False)
+
+    def invalidate(self, address):
+        """Discard a status and abandon any reads of it in progress."""
+        self._statuses.pop(address, None)
+        self._pending.pop(address, None)
@@ -0,0 +1,557 @@
+"""Notifications of server status changes."""
+
+import asyncio
+import collections
+import json
+import logging
+
+from serverstf.cache.status import Address
+
+
+log = logging.getLogger(__name__)
+
+
+class NotifierError(Exception):
+    """Exception raised for all errors stemming from :class:`Notifier`s."""
+
+
+Notification = collections.namedtuple(
+    "Notification",
+    (
+        "type",
+        "address",
+        "tag",
+        "sequence",
+        "fields",
+        "added",
+        "removed",
+        "tags",
+    )
+)
+Notification.__new__.__defaults__ = (None, None, None)
+Notification.__doc__ = """\
+A notification received by a :class:`Notifier`.
+
+:ivar type: the type of notification; either :attr:`Notifier.SERVER` or
+    :attr:`Notifier.TAG`.
+:ivar address: the :class:`Address` the notification is for.
+:ivar tag: for :attr:`Notifier.TAG` notifications this is the tag that was
+    applied to or removed from the server. ``None`` for other types of
+    notification.
+:ivar sequence: the status sequence number the notification corresponds to
+    as an integer. ``None`` if not known.
+:ivar fields: a frozenset of the names of the status hash fields that
+    changed, with ``tags`` included if the tags changed. ``None`` if not
+    known, in which case any field may have changed.
+:ivar added: for :attr:`Notifier.TAG` notifications, a frozenset of the
+    tags that were added to the server. ``None`` if not known.
+:ivar removed: for :attr:`Notifier.TAG` notifications, a frozenset of the
+    tags that were removed from the server. ``None`` if not known.
+:ivar tags: for :attr:`Notifier.TAG` notifications, a frozenset of all
+    the server's tags after the change. ``None`` if not known.
+"""
+
+
+class Notifier:
+    """Send and receive notifications about cache state changes.
+
+    This class wraps the Redis pub/sub subsystem to provide a method for
+    signaling when the cache's state changes. It also allows other services
+    to listen for these changes.
+
+    You should never instantiate this class directly, instead use
+    :meth:`AsyncCache.notifier`. These notifier objects are strictly
+    asynchronous and therefore public use of them is not possible with
+    synchronous caches.
+
+    When a notifier is used to listen for notifications it enters the
+    *watching* state. In this state it is not possible to use the same
+    notifier to send notifications. This is a limitation of the Redis
+    pub/sub system. Any attempts to send notifcations whilst in this state
+    will result in :exc:`NotifierError`.
+    """
+
+    SERVER = "servers"
+    TAG = "tags"
+
+    def __init__(self, connection, encoding, namespace):
+        self._connection = connection
+        self._encoding = encoding
+        self._namespace = namespace
+        self._subscriber = None
+
+    @property
+    def watching(self):
+        """Determine if the notifier is in watching mode."""
+        return self._subscriber is not None
+
+    def close(self):
+        """Close the Redis connection."""
+        self._connection.close()
+
+    def _channel(self, *parts):
+        """Construct a Redis pub/sub channel name from contituent parts.
+
+        :return: a bytestring containing the encoded channel name.
+        """
+        channel = [self._namespace, "channels"]
+        for part in parts:
+            channel.append(str(part))
+        return "/".join(channel).encode(self._encoding)
+
+    @asyncio.coroutine
+    def _get_subscriber(self):
+        """Get the :mod:`asyncio_redis` subscriber.
+
+        This will put the Redis connection in pub/sub mode making it
+        impossible send most commands and hence the notifier enteres the
+        *watching* state.
+
+        :return: a :class:`asyncio_redis.Subscription`.
+        """
+        if not self._subscriber:
+            self._subscriber = yield from self._connection.start_subscribe()
+        return self._subscriber
+
+    @asyncio.coroutine
+    def notify_server(self, address):
+        """Send a notification of server status update.
+
+        This publishes a UTF-8 encoded stringified version of the given
+        address to a channel dedicated to that address.
+
+        :param Address address: the address to send the notification for.
+
+        :raises NotifierError: if the notifier has entered watching mode.
+        """
+        if self.watching:
+            raise NotifierError(
+                "Notifier in watch mode; cannot send notifications")
+        channel_server = self._channel(self.SERVER, address)
+        log.debug("Publish %s", channel_server)
+        yield from self._connection.publish(
+            channel_server, str(address).encode(self._encoding))
+
+    @asyncio.coroutine
+    def notify_tag(self, tag, address):
+        """Send a notification of a server being added to a tag.
+
+        This publishes a UTF-8 encoded stringified version of the given
+        address to a channel dedicated to the tag.
+        """
+        if self.watching:
+            raise NotifierError(
+                "Notifier in watch mode; cannot send notifications")
+        channel_server = self._channel(self.TAG, tag)
+        log.debug("Publish %s", channel_server)
+        yield from self._connection.publish(
+            channel_server, str(address).encode(self._encoding))
+
+    @asyncio.coroutine
+    def watch_server(self, address):
+        """Watch for server status updates.
+
+        :param Address address: the address of the server to subscribe to
+            updates for.
+        """
+        yield from self.watch_servers([address])
+
+    @asyncio.coroutine
+    def watch_servers(self, addresses):
+        """Watch for status updates of many servers.
+
+        All the channels are subscribed to with a single command.
+
+        :param addresses: an iterable of :class:`Address`es.
+        """
+        channels = [self._channel(self.SERVER, address)
+                    for address in addresses]
+        if channels:
+            subscriber = yield from self._get_subscriber()
+            yield from subscriber.subscribe(channels)
+            log.debug("Subscribed to %i server channels", len(channels))
+
+    @asyncio.coroutine
+    def watch_all_servers(self):
+        """Watch for status updates for all servers.
+
+        This uses a pattern subscription that matches the channels of every
+        server.
+        """
+        channel_pattern = self._channel(self.SERVER, "*")
+        subscriber = yield from self._get_subscriber()
+        yield from subscriber.psubscribe([channel_pattern])
+        log.debug("Subscribed to %s", channel_pattern)
+
+    @asyncio.coroutine
+    def unwatch_server(self, address):
+        """Stop watching for server status updates.
+
+        This is the inverse of :meth:`watch_server`.
+        """
+        yield from self.unwatch_servers([address])
+
+    @asyncio.coroutine
+    def unwatch_servers(self, addresses):
+        """Stop watching for status updates of many servers.
+
+        This is the inverse of :meth:`watch_servers`.
+        """
+        channels = [self._channel(self.SERVER, address)
+                    for address in addresses]
+        if channels:
+            subscriber = yield from self._get_subscriber()
+            yield from subscriber.unsubscribe(channels)
+            log.debug("Unsubscribed from %i server channels", len(channels))
+
+    @asyncio.coroutine
+    def watch_tag(self, tag):
+        """Watch a tag for updates."""
+        channel_server = self._channel(self.TAG, tag)
+        subscriber = yield from self._get_subscriber()
+        yield from subscriber.subscribe([channel_server])
+        log.debug("Subscribed to %s", channel_server)
+
+    @asyncio.coroutine
+    def unwatch_tag(self, tag):
+        """Stop watching a tag for updates."""
+        channel_server = self._channel(self.TAG, tag)
+        subscriber = yield from self._get_subscriber()
+        yield from subscriber.unsubscribe([channel_server])
+        log.debug("Unsubscribed from %s", channel_server)
+
+    @asyncio.coroutine
+    def watch(self):
+        """Wait for server status or tag updates.
+
+        This coroutine will block until a notification has been published
+        for a server or tag that is being actively watched. If the notifier
+        is not currently watching any servers (e.g. no calls
+        :meth:`watch_server` of :meth:`watch_tag` have been made) then the
+        coroutine will wait indefinately.
+
+        Notifications are usually just a stringified :class:`Address`.
+        However, server notifications published by :meth:`AsyncCache.set`
+        are JSON objects with three fields: ``address``, ``sequence`` and
+        ``fields``. Tag notifications published by it are also JSON objects
+        with ``address``, ``sequence``, ``added``, ``removed`` and ``tags``
+        fields. These correspond to the fields of :class:`Notification`.
+
+        :return: a :class:`Notification`.
+        """
+        subscriber = yield from self._get_subscriber()
+        notification = None
+        while not notification:
+            message = yield from subscriber.next_published()
+            try:
+                notification = self._decode(message.channel, message.value)
+            except (UnicodeDecodeError, TypeError, ValueError) as exc:
+                log.error("Malformed notification on channel "
+                          "%s: %s: %s", message.channel, message.value, exc)
+        return notification
+
+    def _decode(self, channel, value):
+        """Decode a published notification.
+
+        :param bytes channel: the channel the message was published to.
+        :param bytes value: the published message.
+
+        :raises TypeError: if the message is malformed.
+        :raises ValueError: if the message is malformed.
+        :return: a :class:`Notification`.
+        """
+        type_, tag = channel.decode(self._encoding).split("/")[-2:]
+        if type_ != self.TAG:
+            tag = None
+        if not value.startswith(b"{"):
+            return Notification(
+                type_, Address.from_cache(value), tag, None, None)
+        decoded = json.loads(value.decode(self._encoding))
+        if not isinstance(decoded, dict):
+            raise ValueError("Expected a JSON object")
+
+        def strings(name):  # pylint: disable=missing-docstring
+            strings = decoded.get(name)
+            if not isinstance(strings, list):
+                # Lua's cjson encodes empty arrays as objects
+                strings = []
+            return frozenset(str(string) for string in strings)
+
+        address = Address.from_cache(
+            str(decoded.get("address")).encode(self._encoding))
+        sequence = int(decoded.get("sequence"))
+        if type_ == self.TAG:
+            return Notification(
+                type_,
+                address,
+                tag,
+                sequence,
+                None,
+                strings("added"),
+                strings("removed"),
+                strings("tags"),
+            )
+        return Notification(type_, address, tag, sequence, strings("fields"))
+
+
+class Multiplexer:
+    """Share a single watching :class:`Notifier` between many consumers.
+
+    Each consumer gets its own :class:`MultiplexedNotifier` from
+    :meth:`notifier`, which has the same watching interface as a
+    :class:`Notifier`. However, rather than each one using its own Redis
+    connection, they all share the multiplexer's.
+
+    The multiplexer keeps track of which consumers are watching which
+    channels. Redis is only subscribed to a channel whilst at least one
+    consumer is watching it. Each notification received is dispatched to
+    the queue of every consumer watching the channel it was published on.
+
+    Additionally, listeners can be registered with :meth:`listen` which are
+    called for every notification received regardless of the channel.
+
+    :param Notifier notifier: the notifier to share. It must not be used
+        by anything else.
+    :param loop: the :mod:`asyncio` event loop to use.
+    """
+
+    def __init__(self, notifier, loop):
+        self._notifier = notifier
+        self._loop = loop
+        self._channels = {}
+        self._listeners = []
+        self._dispatcher = None
+
+    def __repr__(self):
+        return ("<{0.__class__.__name__} watching "
+                "{1} channels>".format(self, len(self._channels)))
+
+    def close(self):
+        """Stop dispatching notifications and close the notifier."""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+        self._notifier.close()
+
+    def notifier(self):
+        """Create a new consumer of the multiplexer.
+
+        :return: a :class:`MultiplexedNotifier`.
+        """
+        if not self._dispatcher:
+            self._dispatcher = asyncio.Task(self._dispatch(), loop=self._loop)
+        return MultiplexedNotifier(self, self._loop)
+
+    def listen(self, listener):
+        """Register a listener for all notifications.
+
+        Listeners are called with each :class:`Notification` before it is
+        dispatched to consumers. When the multiplexer stops watching a server
+        listeners are also called with a notification for it that has
+        neither a sequence number nor fields, as further changes to the
+        server will go unseen.
+
+        :param listener: a callable which accepts a :class:`Notification`.
+        """
+        self._listeners.append(listener)
+
+    def watching(self, type_, key):
+        """Check if any consumers are watching a channel.
+
+        :param str type_: either :attr:`Notifier.SERVER` or
+            :attr:`Notifier.TAG`.
+        :param key: the :class:`Address` or tag.
+
+        :return: ``True`` if the channel is being watched.
+        """
+        return (type_, key) in self._channels
+
+    def _call_listeners(self, notification):
+        """Call every listener with a notification.
+
+        Errors raised by listeners are logged so that one broken listener
+        can't stop notifications being dispatched.
+        """
+        for listener in self._listeners:
+            try:
+                listener(notification)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Error in notification listener %r", listener)
+
+    @asyncio.coroutine
+    def _dispatch(self):
+        """Continually dispatch notifications to consumers."""
+        while True:
+            notification = yield from self._notifier.watch()
+            self._call_listeners(notification)
+            if notification.type == Notifier.TAG:
+                channel = (notification.type, notification.tag)
+            else:
+                channel = (notification.type, notification.address)
+            for consumer in self._channels.get(channel, ()):
+                consumer.queue.put_nowait(notification)
+
+    @asyncio.coroutine
+    def watch(self, consumer, type_, key):
+        """Add a consumer to a channel.
+
+        :param MultiplexedNotifier consumer: the consumer to add.
+        :param str type_: either :attr:`Notifier.SERVER` or
+            :attr:`Notifier.TAG`.
+        :param key: the :class:`Address` or tag to watch.
+        """
+        yield from self.watch_many(consumer, type_, [key])
+
+    @asyncio.coroutine
+    def watch_many(self, consumer, type_, keys):
+        """Add a consumer to many channels of the same type.
+
+        Server channels which weren't already being watched are subscribed
+        to with a single command.
+
+        :param MultiplexedNotifier consumer: the consumer to add.
+        :param str type_: either :attr:`Notifier.SERVER` or
+            :attr:`Notifier.TAG`.
+        :param keys: an iterable of :class:`Address`es or tags to watch.
+        """
+        new = []
+        for key in set(keys):
+            consumers = self._channels.setdefault((type_, key), set())
+            consumers.add(consumer)
+            if len(consumers) == 1:
+                new.append(key)
+        if type_ == Notifier.TAG:
+            for tag in new:
+                yield from self._notifier.watch_tag(tag)
+        else:
+            yield from self._notifier.watch_servers(new)
+
+    @asyncio.coroutine
+    def unwatch(self, consumer, type_, key):
+        """Remove a consumer from a channel.
+
+        This is the inverse of :meth:`watch`.
+        """
+        yield from self.unwatch_many(consumer, type_, [key])
+
+    @asyncio.coroutine
+    def unwatch_many(self, consumer, type_, keys):
+        """Remove a consumer from many channels of the same type.
+
+        This is the inverse of :meth:`watch_many`.
+        """
+        old = []
+        for key in set(keys):
+            consumers = self._channels.get((type_, key), set())
+            consumers.discard(consumer)
+            if not consumers and (type_, key) in self._channels:
+                del self._channels[(type_, key)]
+                old.append(key)
+        if type_ == Notifier.TAG:
+            for tag in old:
+                yield from self._notifier.unwatch_tag(tag)
+        else:
+            yield from self._notifier.unwatch_servers(old)
+            for address in old:
+                self._call_listeners(
+                    Notification(type_, address, None, None, None))
+
+
+class MultiplexedNotifier:
+    """A consumer of a :class:`Multiplexer`.
+
+    This implements the watching half of the :class:`Notifier` interface.
+    Never instantiate this class directly, instead use
+    :meth:`Multiplexer.notifier`.
+
+    :ivar queue: an :class:`asyncio.Queue` of :class:`Notification`s for
+        the channels being watched.
+    """
+
+    SERVER = Notifier.SERVER
+    TAG = Notifier.TAG
+
+    def __init__(self, multiplexer, loop):
+        self._multiplexer = multiplexer
+        self._loop = loop
+        self._watching = set()
+        self.queue = asyncio.Queue(loop=loop)
+
+    @asyncio.coroutine
+    def close(self):
+        """Stop watching all channels.
+
+        The consumer is always removed from the multiplexer's channels.
+        Failures to unsubscribe from them are logged rather than raised.
+        """
+        watching = collections.defaultdict(list)
+        for type_, key in self._watching:
+            watching[type_].append(key)
+        self._watching = set()
+        for type_, keys in watching.items():
+            try:
+                yield from self._multiplexer.unwatch_many(self, type_, keys)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Couldn't unwatch %i channels of type %r",
+                              len(keys), type_)
+
+    @asyncio.coroutine
+    def _watch(self, type_, key):
+        """Start watching a channel, if not already."""
+        if (type_, key) not in self._watching:
+            self._watching.add((type_, key))
+            yield from self._multiplexer.watch(self, type_, key)
+
+    @asyncio.coroutine
+    def _unwatch(self, type_, key):
+        """Stop watching a channel, if watching."""
+        if (type_, key) in self._watching:
+            self._watching.remove((type_, key))
+            yield from self._multiplexer.unwatch(self, type_, key)
+
+    @asyncio.coroutine
+    def watch_server(self, address):
+        """See :meth:`Notifier.watch_server`."""
+        yield from self._watch(self.SERVER, address)
+
+    @asyncio.coroutine
+    def watch_servers(self, addresses):
+        """See :meth:`Notifier.watch_servers`."""
+        addresses = {address for address in addresses
+                     if (self.SERVER, address) not in self._watching}
+        self._watching.update((self.SERVER, address) for address in addresses)
+        yield from self._multiplexer.watch_many(self, self.SERVER, addresses)
+
+    @asyncio.coroutine
+    def unwatch_server(self, address):
+        """See :meth:`Notifier.unwatch_server`."""
+        yield from self._unwatch(self.SERVER, address)
+
+    @asyncio.coroutine
+    def unwatch_servers(self, addresses):
+        """See :meth:`Notifier.unwatch_servers`."""
+        addresses = {address for address in addresses
+                     if (self.SERVER, address) in self._watching}
+        self._watching.difference_update(
+            (self.SERVER, address) for address in addresses)
+        yield from self._multiplexer.unwatch_many(
+            self, self.SERVER, addresses)
+
+    @asyncio.coroutine
+    def watch_tag(self, tag):
+        """See :meth:`Notifier.watch_tag`."""
+        yield from self._watch(self.TAG, tag)
+
+    @asyncio.coroutine
+    def unwatch_tag(self, tag):
+        """See :meth:`Notifier.unwatch_tag`."""
+        yield from self._unwatch(self.TAG, tag)
+
+    @asyncio.coroutine
+    def watch(self):
+        """Wait for server status or tag updates.
+
+        :return: a :class:`Notification`.
+        """
+        return (yield from self.queue.get())
@@ -0,0 +1,508 @@
+"""Lua scripts run by :class:`serverstf.cache.AsyncCache`.
+
+Each script is run atomically by Redis. The comment above each one
+describes its ``KEYS`` and ``ARGV``.
+"""
+
+# Find due addresses in the interest queue.
+#
+# KEYS[1] is the interest queue. ARGV is the current time and the
+# maximum number of addresses to return.
+IQ_DUE = """
+return redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1],
+                  "LIMIT", 0, ARGV[2])
+"""
+
+# Claim due addresses from the interest queue and reschedule them.
+#
+# KEYS[1] is the interest queue and the following keys are the interest
+# of each candidate address. ARGV is the current time and the base and
+# minimum poll intervals followed by the candidate addresses, in the
+# same order as their interest keys.
+#
+# Candidates are found by IQ_DUE beforehand. Those which are no longer
+# due, e.g. because another poller claimed them in the meantime, are
+# skipped. Returns the addresses that were claimed.
+IQ_POP = """
+local now = tonumber(ARGV[1])
+local claimed = {}
+for i = 4, #ARGV do
+    local address = ARGV[i]
+    local due = tonumber(redis.call("ZSCORE", KEYS[1], address))
+    if due and due <= now then
+        local interest = tonumber(redis.call("GET", KEYS[i - 2])) or 0
+        if interest > 0 then
+            local interval = math.max(
+                tonumber(ARGV[3]), tonumber(ARGV[2]) / interest)
+            redis.call("ZADD", KEYS[1], tostring(now + interval), address)
+        else
+            redis.call("ZREM", KEYS[1], address)
+        end
+        table.insert(claimed, address)
+    end
+end
+return claimed
+"""
+
+# Commit a server status, returning the tags that were added and removed
+# and the IDs of any cached searches found to have expired.
+#
+# KEYS[1] is the authorative set, KEYS[2] the status hash, KEYS[3]
+# the server's tag set, KEYS[4] to KEYS[6] the players, free slots
+# and location ranks, KEYS[7] the search registry, KEYS[8] to
+# KEYS[10] the last seen times, failure counts and failing servers
+# and KEYS[11] the live servers. ARGV is the address, the server
+# notification channel, the prefix for the tag notification channels,
+# the status fingerprint, the current time and the number of hash
+# fields, followed by the hash fields and values. Next come the number
+# of tags the server had when they were read, the number it's to have
+# and then those tags, old ones first. The tags are followed by the
+# IDs of the searches that depend on any of the changed tags.
+#
+# The remaining KEYS are the tag index of each of the tags in ARGV,
+# then the search set of each of those tags and finally the results of
+# each of the searches in ARGV, all in the same order as in ARGV.
+#
+# The ranks, last seen time, failure count and liveness are always
+# updated. If the fingerprint matches the stored one then nothing else
+# is written. Otherwise the server's sequence number is incremented and
+# the names of the changed fields are published along with it. If the
+# server's tags changed then any cached search results that depend on
+# them are updated.
+#
+# Only the ranks, last seen time, failure count and liveness are
+# written if the server's tags or the searches depending on them are
+# no longer those given, in which case false is returned. The caller
+# should read them again and retry.
+SET = """
+local address = ARGV[1]
+local fields_end = 6 + tonumber(ARGV[6]) * 2
+local n_old = tonumber(ARGV[fields_end + 1])
+local n_tags = n_old + tonumber(ARGV[fields_end + 2])
+local tags_start = fields_end + 2
+local new_hash = {}
+for i = 7, fields_end, 2 do
+    new_hash[ARGV[i]] = ARGV[i + 1]
+end
+local raw_players = new_hash["players"] or ""
+local decoded, version, current, max
+if string.byte(raw_players, 1) == 1 then
+    decoded, version, current, max =
+        pcall(struct.unpack, ">BHH", raw_players)
+else
+    local players
+    decoded, players = pcall(cjson.decode, raw_players)
+    if decoded and type(players) == "table" then
+        current = tonumber(players["current"])
+        max = tonumber(players["max"])
+    end
+end
+if decoded and current and max then
+    redis.call("ZADD", KEYS[4], current, address)
+    redis.call("ZADD", KEYS[5], math.max(max - current, 0), address)
+end
+local latitude = tonumber(new_hash["latitude"])
+local longitude = tonumber(new_hash["longitude"])
+if latitude and longitude and math.abs(latitude) <= 85.05112878
+        and math.abs(longitude) <= 180 then
+    redis.call("GEOADD", KEYS[6], longitude, latitude, address)
+else
+    redis.call("ZREM", KEYS[6], address)
+end
+redis.call("ZADD", KEYS[8], ARGV[5], address)
+redis.call("HDEL", KEYS[9], address)
+redis.call("ZREM", KEYS[10], address)
+redis.call("SADD", KEYS[11], address)
+local old_hash = {}
+local old_hash_raw = redis.call("HGETALL", KEYS[2])
+for i = 1, #old_hash_raw, 2 do
+    old_hash[old_hash_raw[i]] = old_hash_raw[i + 1]
+end
+if old_hash["fingerprint"] == ARGV[4] then
+    return {{}, {}, {}}
+end
+local old_tags = {}
+local new_tags = {}
+local index_keys = {}
+local search_keys = {}
+for i = 1, n_tags do
+    local tag = ARGV[tags_start + i]
+    if i <= n_old then
+        old_tags[tag] = true
+    else
+        new_tags[tag] = true
+    end
+    index_keys[tag] = KEYS[11 + i]
+    search_keys[tag] = KEYS[11 + n_tags + i]
+end
+local current_tags = redis.call("SMEMBERS", KEYS[3])
+if #current_tags ~= n_old then
+    return false
+end
+for _, tag in ipairs(current_tags) do
+    if not old_tags[tag] then
+        return false
+    end
+end
+local results_keys = {}
+for i = tags_start + n_tags + 1, #ARGV do
+    results_keys[ARGV[i]] = KEYS[11 + n_tags + i - tags_start]
+end
+local added = {}
+local removed = {}
+for tag in pairs(new_tags) do
+    if not old_tags[tag] then
+        table.insert(added, tag)
+    end
+end
+for tag in pairs(old_tags) do
+    if not new_tags[tag] then
+        table.insert(removed, tag)
+    end
+end
+local searches = {}
+for _, tags in ipairs({added, removed}) do
+    for _, tag in ipairs(tags) do
+        for _, search in ipairs(redis.call("SMEMBERS", search_keys[tag])) do
+            if not results_keys[search] then
+                return false
+            end
+            searches[search] = true
+        end
+    end
+end
+local sequence = (tonumber(old_hash["sequence"]) or 0) + 1
+old_hash["fingerprint"] = nil
+old_hash["sequence"] = nil
+local changed = {}
+for i = 7, fields_end, 2 do
+    local field = ARGV[i]
+    if field ~= "fingerprint" and old_hash[field] ~= ARGV[i + 1] then
+        table.insert(changed, field)
+    end
+    old_hash[field] = nil
+end
+for field in pairs(old_hash) do
+    table.insert(changed, field)
+end
+redis.call("SADD", KEYS[1], address)
+redis.call("DEL", KEYS[2], KEYS[3])
+redis.call("HMSET", KEYS[2], "sequence", sequence,
+           unpack(ARGV, 7, fields_end))
+for tag in pairs(new_tags) do
+    redis.call("SADD", KEYS[3], tag)
+    redis.call("SADD", index_keys[tag], address)
+end
+for _, tag in ipairs(removed) do
+    redis.call("SREM", index_keys[tag], address)
+end
+local expired = {}
+if #added > 0 or #removed > 0 then
+    table.insert(changed, "tags")
+    for search in pairs(searches) do
+        local spec = redis.call("HGET", KEYS[7], search)
+        local results = results_keys[search]
+        if spec and redis.call("EXISTS", results) == 1 then
+            spec = cjson.decode(spec)
+            local match = true
+            for _, tag in ipairs(spec[1]) do
+                match = match and new_tags[tag] ~= nil
+            end
+            for _, tag in ipairs(spec[2]) do
+                match = match and new_tags[tag] == nil
+            end
+            if match then
+                redis.call("SADD", results, address)
+            else
+                redis.call("SREM", results, address)
+            end
+        elseif spec then
+            table.insert(expired, search)
+        end
+    end
+end
+redis.call("PUBLISH", ARGV[2], cjson.encode({
+    address = address,
+    sequence = sequence,
+    fields = changed,
+}))
+if #added > 0 or #removed > 0 then
+    local tags = {}
+    for tag in pairs(new_tags) do
+        table.insert(tags, tag)
+    end
+    local message = cjson.encode({
+        address = address,
+        sequence = sequence,
+        added = added,
+        removed = removed,
+        tags = tags,
+    })
+    for _, changed_tags in ipairs({added, removed}) do
+        for _, tag in ipairs(changed_tags) do
+            redis.call("PUBLISH", ARGV[3] .. tag, message)
+        end
+    end
+end
+return {added, removed, expired}
+"""
+
+# Scan the authorative set or the live servers. asyncio_redis's own
+# SSCAN cursors don't allow the COUNT to be set and fetch addresses one
+# at a time.
+#
+# KEYS[1] is the set to scan. ARGV is the cursor and batch size.
+SCAN = """
+return redis.call("SSCAN", KEYS[1], ARGV[1], "COUNT", ARGV[2])
+"""
+
+# Add a server to the authorative set, returning 1 if it's new.
+#
+# KEYS[1] is the authorative set, KEYS[2] the live servers and KEYS[3]
+# the failing servers. ARGV is the address.
+#
+# Servers are live unless they're failing, so new servers are assumed
+# to be live until they're first polled.
+ENSURE = """
+local added = redis.call("SADD", KEYS[1], ARGV[1])
+if not redis.call("ZSCORE", KEYS[3], ARGV[1]) then
+    redis.call("SADD", KEYS[2], ARGV[1])
+end
+return added
+"""
+
+# Record a failed poll, returning the number of consecutive failures.
+#
+# KEYS[1] is the authorative set, KEYS[2] the live servers, KEYS[3] the
+# failure counts and KEYS[4] the failing servers. ARGV is the address
+# and the current time.
+#
+# The server is no longer live. Failures of servers which aren't in the
+# authorative set, e.g. because they've been evicted, aren't recorded
+# and zero is returned instead.
+FAIL = """
+if redis.call("SISMEMBER", KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call("SREM", KEYS[2], ARGV[1])
+if not redis.call("ZSCORE", KEYS[4], ARGV[1]) then
+    redis.call("ZADD", KEYS[4], ARGV[2], ARGV[1])
+end
+return redis.call("HINCRBY", KEYS[3], ARGV[1], 1)
+"""
+
+# Find servers that have been failing since before a given time.
+#
+# KEYS[1] is the failing servers. ARGV is the time and the maximum
+# number of addresses to return.
+DEAD = """
+return redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", "(" .. ARGV[1],
+                  "LIMIT", 0, ARGV[2])
+"""
+
+# Remove a server from the cache entirely, returning its tags.
+#
+# KEYS[1] is the authorative set, KEYS[2] the status hash, KEYS[3] the
+# server's tag set, KEYS[4] its interest, KEYS[5] to KEYS[7] the ranks,
+# KEYS[8] the search registry, KEYS[9] the interest queue, KEYS[10]
+# to KEYS[12] the last seen times, failure counts and failing servers
+# and KEYS[13] the live servers. ARGV is the address, the prefix for
+# the tag notification channels and the number of tags the server had
+# when they were read, followed by those tags and then the IDs of the
+# searches that depend on any of them.
+#
+# The remaining KEYS are the tag index of each of the tags in ARGV,
+# then the search set of each of those tags and finally the results of
+# each of the searches in ARGV, all in the same order as in ARGV.
+#
+# The server is removed from every cached search result it could be in;
+# those are the ones that include one of its tags. Tag notifications
+# are published as if every tag had been removed from the server.
+#
+# Nothing is written if the server's tags or the searches depending on
+# them are no longer those given, in which case false is returned. The
+# caller should read them again and retry.
+EVICT = """
+local address = ARGV[1]
+local n_tags = tonumber(ARGV[3])
+local tags = {unpack(ARGV, 4, 3 + n_tags)}
+local snapshot = {}
+for _, tag in ipairs(tags) do
+    snapshot[tag] = true
+end
+local current_tags = redis.call("SMEMBERS", KEYS[3])
+if #current_tags ~= n_tags then
+    return false
+end
+for _, tag in ipairs(current_tags) do
+    if not snapshot[tag] then
+        return false
+    end
+end
+local results_keys = {}
+for i = 4 + n_tags, #ARGV do
+    results_keys[ARGV[i]] = KEYS[10 + n_tags + i]
+end
+for i = 1, n_tags do
+    for _, search in ipairs(redis.call("SMEMBERS", KEYS[13 + n_tags + i])) do
+        if not results_keys[search] then
+            return false
+        end
+    end
+end
+local sequence = (tonumber(redis.call("HGET", KEYS[2], "sequence")) or 0) + 1
+for i = 1, n_tags do
+    redis.call("SREM", KEYS[13 + i], address)
+end
+for _, results in pairs(results_keys) do
+    redis.call("SREM", results, address)
+end
+redis.call("SREM", KEYS[1], address)
+redis.call("DEL", KEYS[2], KEYS[3], KEYS[4])
+for i = 5, 7 do
+    redis.call("ZREM", KEYS[i], address)
+end
+redis.call("ZREM", KEYS[9], address)
+redis.call("ZREM", KEYS[10], address)
+redis.call("HDEL", KEYS[11], address)
+redis.call("ZREM", KEYS[12], address)
+redis.call("SREM", KEYS[13], address)
+if #tags > 0 then
+    local message = cjson.encode({
+        address = address,
+        sequence = sequence,
+        added = {},
+        removed = tags,
+        tags = {},
+    })
+    for _, tag in ipairs(tags) do
+        redis.call("PUBLISH", ARGV[2] .. tag, message)
+    end
+end
+return tags
+"""
+
+# Forget a cached search which has expired, returning 1 if it was.
+#
+# KEYS[1] is the search registry, KEYS[2] the search's results and the
+# following keys are the search sets of each of its tags. ARGV is the
+# search ID and its registered specification.
+#
+# Nothing is done, and zero is returned, if the search has been cached
+# again or re-registered since its specification was read.
+FORGET = """
+if redis.call("EXISTS", KEYS[2]) == 1
+        or redis.call("HGET", KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+for i = 3, #KEYS do
+    redis.call("SREM", KEYS[i], ARGV[1])
+end
+redis.call("HDEL", KEYS[1], ARGV[1])
+return 1
+"""
+
+# Define a Lua function which finds the addresses matching a search.
+#
+# The function takes the index of the first of the search's keys, the
+# search ID and the included and excluded tags as tables. The search's
+# keys are the search registry, the search's results, the tag index of
+# each included and then excluded tag and finally the search set of
+# each of those tags, in the same order. It returns the key of the set
+# containing the matching addresses, which is cached for SEARCH_TTL
+# seconds (the last argument) and registered so that SET can keep it up
+# to date.
+SEARCH_FUNCTION = """
+local function search(first, id, include, exclude, ttl)
+    local registry = KEYS[first]
+    local results = KEYS[first + 1]
+    if redis.call("EXISTS", results) == 1 then
+        return results
+    end
+    local n_include = #include
+    local n_tags = n_include + #exclude
+    redis.call("SINTERSTORE", results,
+               unpack(KEYS, first + 2, first + 1 + n_include))
+    if #exclude > 0 then
+        redis.call("SDIFFSTORE", results, results,
+                   unpack(KEYS, first + 2 + n_include, first + 1 + n_tags))
+    end
+    if redis.call("EXISTS", results) == 1 then
+        redis.call("EXPIRE", results, ttl)
+        redis.call("HSET", registry, id, cjson.encode({include, exclude}))
+        for i = first + 2 + n_tags, first + 1 + 2 * n_tags do
+            redis.call("SADD", KEYS[i], id)
+        end
+    end
+    return results
+end
+"""
+
+# Find the addresses matching a search.
+#
+# KEYS are the search's keys as described for SEARCH_FUNCTION. ARGV is
+# the search ID, the cache TTL, the number of included tags and then
+# the included tags followed by the excluded ones.
+SEARCH = SEARCH_FUNCTION + """
+local n_include = tonumber(ARGV[3])
+local results = search(1, ARGV[1], {unpack(ARGV, 4, 3 + n_include)},
+                       {unpack(ARGV, 4 + n_include)}, ARGV[2])
+return redis.call("SMEMBERS", results)
+"""
+
+# Find a page of servers matching a search.
+#
+# KEYS[1] is a temporary key and KEYS[2] is the rank to sort by. The
+# search's keys follow, as described for SEARCH_FUNCTION. ARGV starts
+# as for SEARCH which is followed by the sort key, the offset and limit
+# of the page and, for latency sorting, the longitude and latitude of
+# the origin. The excluded tags come last.
+#
+# Servers that aren't in the rank are sorted after all those that are,
+# e.g. those without a location when sorting by latency. Returns the
+# total number of matching servers and the addresses on the page.
+QUERY = SEARCH_FUNCTION + """
+local n_include = tonumber(ARGV[3])
+local sort = ARGV[4 + n_include]
+local offset = tonumber(ARGV[5 + n_include])
+local limit = tonumber(ARGV[6 + n_include])
+local longitude = ARGV[7 + n_include]
+local latitude = ARGV[8 + n_include]
+local results = search(3, ARGV[1], {unpack(ARGV, 4, 3 + n_include)},
+                       {unpack(ARGV, 9 + n_include)}, ARGV[2])
+local total = redis.call("SCARD", results)
+local page = {}
+if sort == "players" or sort == "free" then
+    redis.call("ZINTERSTORE", KEYS[1], 2,
+               results, KEYS[2], "WEIGHTS", 0, 1)
+    redis.call("ZUNIONSTORE", KEYS[1], 2, KEYS[1], results,
+               "WEIGHTS", 1, -1, "AGGREGATE", "MAX")
+    page = redis.call("ZREVRANGE", KEYS[1],
+                      offset, offset + limit - 1)
+elseif sort == "latency" then
+    local located = redis.call("ZINTERSTORE", KEYS[1], 2,
+                               results, KEYS[2], "WEIGHTS", 0, 1)
+    if offset < located then
+        local nearest = redis.call(
+            "GEORADIUS", KEYS[1], longitude, latitude,
+            20038, "km", "ASC", "COUNT", offset + limit)
+        for i = offset + 1, #nearest do
+            table.insert(page, nearest[i])
+        end
+    end
+    if #page < limit then
+        redis.call("ZUNIONSTORE", KEYS[1], 2,
+                   results, KEYS[1], "WEIGHTS", 0, 1)
+        local unlocated = redis.call(
+            "ZRANGEBYSCORE", KEYS[1], 0, 0, "LIMIT",
+            math.max(offset - located, 0), limit - #page)
+        for _, address in ipairs(unlocated) do
+            table.insert(page, address)
+        end
+    end
+else
+    page = redis.call("SORT", results, "ALPHA", "LIMIT", offset, limit)
+end
+redis.call("DEL", KEYS[1])
+return {total, page}
+"""
@@ -0,0 +1,580 @@
+"""Server addresses and statuses."""
+
+import datetime
+import ipaddress
+import json
+import logging
+import socket
+import struct
+import weakref
+
+import iso3166  # pylint: disable=wrong-import-order
+
+
+log = logging.getLogger(__name__)
+
+
+class AddressError(ValueError):
+    """Exception for all errors related to :class:`Address`es."""
+
+
+class PlayersError(ValueError):
+    """Exception raised for invalid :class:`Players` objects."""
+
+
+class Address:
+    """Represents a server address.
+
+    Each server address is comprised of an IPv4 address and a port number.
+    Addresses are hashable and immutable.
+
+    Internally addresses are represented by a packed six byte key made up
+    of the IP address and port number. The hash and string forms are
+    computed once on construction. The :class:`ipaddress.IPv4Address` is
+    only created when it's first accessed.
+
+    :ivar ip: the :class:`ipaddress.IPv4Address` of the address.
+    :ivar port: the port number for the address as an integer.
+    :ivar packed: the packed six byte key for the address.
+
+    :raises AddressError: if either the given IP address or port is invalid.
+    """
+
+    __slots__ = ("_key", "_hash", "_str", "_ip", "_port", "__weakref__")
+
+    _PORT = struct.Struct(">H")
+    #: Process-wide intern table of encoded addresses to canonical
+    #: instances. Entries are evicted once nothing else references them.
+    _interned = weakref.WeakValueDictionary()
+
+    def __init__(self, ip, port):
+        try:
+            ip = ipaddress.IPv4Address(ip)
+        except ipaddress.AddressValueError as exc:
+            raise AddressError("Malformed IP address") from exc
+        try:
+            port = int(port)
+        except (TypeError, ValueError) as exc:
+            raise AddressError("Port number is not an integer") from exc
+        if port < 1 or port > 65535:
+            raise AddressError("Port number is out of range")
+        self._init(ip.packed, port, "{}:{}".format(ip, port))
+        self._ip = ip
+
+    def _init(self, packed_ip, port, string):
+        """Initialise the address's slots."""
+        self._key = packed_ip + self._PORT.pack(port)
+        self._hash = hash(self._key)
+        self._str = string
+        self._ip = None
+        self._port = port
+
+    def __repr__(self):
+        return "<{0.__class__.__name__} {0}>".format(self)
+
+    def __str__(self):
+        return self._str
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        """Check another :class:`Address` for equality.
+
+        The other address is only considered equal if both the IP address
+        and port match.
+        """
+        if self is other:
+            return True
+        if not isinstance(other, self.__class__):
+            return NotImplemented
+        return self._key == other._key  # pylint: disable=protected-access
+
+    @classmethod
+    def parse(cls, address):
+        """Parse an address from a string.
+
+        This is effectively the inverse of :meth:`__str__`. The given address
+        is expected to be in the ``<ip>:<port>`` form.
+
+        :param str address: the address to parse.
+
+        :raises AddressError: if the string is not formatted correctly or the
+            address is in any other way invalid.
+        :return: a new :class:`Address` instance.
+        """
+        split = address.split(":", 1)
+        if len(split) != 2:
+            raise AddressError("Addresses must be in the form <ip/host>"
+                               ":<port> but got {!r}".format(address))
+        return cls(*split)
+
+    @classmethod
+    def from_cache(cls, raw):
+        """Parse an address read from the cache.
+
+        This is a faster version of :meth:`parse` for addresses which were
+        written to the cache by :meth:`__str__`. As such it trusts that the
+        address is already in its canonical form and only does enough
+        validation to be sure it can be packed.
+
+        Addresses are interned so that parsing the same address again is
+        just a dictionary lookup and returns the same instance for as long
+        as it's in use.
+
+        :param bytes raw: the UTF-8 encoded address.
+
+        :raises AddressError: if the address can't be parsed.
+        :return: an :class:`Address` instance.
+        """
+        address = cls._interned.get(raw)
+        if address is not None:
+            return address
+        try:
+            ip, port = raw.split(b":")
+            string = raw.decode("ascii")
+            packed_ip = socket.inet_aton(ip.decode("ascii"))
+            port = int(port)
+        except (ValueError, OSError) as exc:
+            raise AddressError(
+                "Malformed cached address {!r}".format(raw)) from exc
+        if port < 1 or port > 65535:
+            raise AddressError("Port number is out of range")
+        address = cls.__new__(cls)
+        cls._init(address, packed_ip, port, string)
+        return cls._interned.setdefault(raw, address)
+
+    @classmethod
+    def intern(cls, address):
+        """Get the canonical instance of an address.
+
+        :param Address address: the address to intern.
+
+        :return: the interned :class:`Address` that's equal to the given
+            one. This is the same instance as returned by :meth:`from_cache`
+            for the address.
+        """
+        return cls._interned.setdefault(str(address).encode("ascii"), address)
+
+    @property
+    def ip(self):
+        """Get the IP of the address."""
+        if self._ip is None:
+            self._ip = ipaddress.IPv4Address(self._key[:4])
+        return self._ip
+
+    @property
+    def port(self):
+        """Get the port number of the address."""
+        return self._port
+
+    @property
+    def packed(self):
+        """Get the packed six byte key for the address."""
+        return self._key
+
+
+def _clamp(value, minimum, maximum):
+    """Clamp a value to a range."""
+    return max(minimum, min(value, maximum))
+
+
+class Players:
+    """Immutable representation of the server players at a point in time.
+
+    :ivar current: the current number of players as an integer.
+    :ivar max: the maximum number of players supported by the server as an
+        integer.
+    :ivar bots: the current number of players that are bots as an integer.
+
+    :param scores: an iterable of three-item tuples containing the player's
+        name as a string, their score as an integer and their connection
+        duration as a :class:`datetime.timedelta`.
+    """
+
+    __slots__ = ("_current", "_max", "_bots", "_scores")
+
+    # Binary encoding version, header, name length prefix and score.
+    _BINARY_VERSION = 1
+    _BINARY_HEADER = struct.Struct(">BHHHH")
+    _BINARY_NAME = struct.Struct(">H")
+    _BINARY_SCORE = struct.Struct(">if")
+
+    def __init__(self, *, current, max_, bots, scores):
+        normalised_scores = []
+        for name, score, duration in scores:
+            name = str(name)
+            score = int(score)
+            if not isinstance(duration, datetime.timedelta):
+                raise PlayersError("Player connection duration must "
+                                   "be a {} object".format(datetime.timedelta))
+            normalised_scores.append((name, score, duration))
+        self._init(int(current), int(max_),
+                   int(bots), tuple(normalised_scores))
+
+    def _init(self, current, max_, bots, scores):
+        """Initialise the players' slots."""
+        self._current = current
+        self._max = max_
+        self._bots = bots
+        self._scores = scores
+
+    @classmethod
+    def _trusted(cls, current, max_, bots, scores):
+        """Create players without normalising or checking the scores.
+
+        :param int current: the current number of players.
+        :param int max_: the maximum number of players.
+        :param int bots: the number of bots.
+        :param tuple scores: a tuple of name, integer score and duration
+            :class:`datetime.timedelta` tuples.
+        """
+        players = cls.__new__(cls)
+        cls._init(players, current, max_, bots, scores)
+        return players
+
+    def __repr__(self):
+        return ("<{0.__class__.__name__} "
+                "{0.current}/{0.max} ({0.bots} bots)>".format(self))
+
+    def __iter__(self):
+        """Iterate over players and scores.
+
+        When iterated on this yields a tuple for each connected player
+        containing their name, score and connection duration. The players
+        themselves should never be considered to be in any particular order.
+
+        .. note::
+            It's possible for the number of players returned by this iterator
+            to be less than or greater than that of the :attr:`current`
+            players.
+        """
+        return iter(self._scores)
+
+    @property
+    def current(self):
+        """Get the current number of players."""
+        return self._current
+
+    @property
+    def max(self):
+        """Get the maximum number of players."""
+        return self._max
+
+    @property
+    def bots(self):
+        """Get the current number of NPC players."""
+        return self._bots
+
+    @classmethod
+    def from_json(cls, encoded):
+        """Parse a JSON-encoded object.
+
+        This is effectively the inverse of :meth:`to_json`.
+
+        :raises PlayersError: if the JSON or the structure of the JSON object
+            is invalid in any way.
+        :return: a new :class:`Players`.
+        """
+        try:
+            decoded = json.loads(encoded)
+        except ValueError as exc:
+            raise PlayersError("Bad JSON: {}".format(exc)) from exc
+        for field in ["current", "max", "bots", "scores"]:
+            if field not in decoded:
+                raise PlayersError("Missing field {!r}".format(field))
+        try:
+            current = int(decoded["current"])
+            max_ = int(decoded["max"])
+            bots = int(decoded["bots"])
+        except (ValueError, TypeError) as exc:
+            raise PlayersError(
+                "Malformed integer fields: {}".format(exc)) from exc
+        else:
+            scores = []
+            for entry in decoded["scores"]:
+                if not isinstance(entry, list) or len(entry) != 3:
+                    raise PlayersError(
+                        "Malformed scores; expected list "
+                        "of length 3 but got: {!r}".format(entry))
+                if not isinstance(entry[0], str):
+                    raise PlayersError("First item must be a string "
+                                       "for but got: {!r}".format(entry[0]))
+                if not all(isinstance(i, (int, float)) for i in entry[1:]):
+                    raise PlayersError("Last two items must be numbers "
+                                       "but got: {!r}".format(entry[1:]))
+                scores.append((entry[0], int(entry[1]),
+                               datetime.timedelta(seconds=entry[2])))
+            return cls._trusted(current, max_, bots, tuple(scores))
+
+    def to_json(self):
+        """Convert the players to a JSON-encoded object.
+
+        The JSON object will have four fields: ``current``, ``max``, ``bots``
+        and ``scores``. The first three are just plain numbers corresponding
+        to the attributes of the same names. ``scores`` is an array of
+        arrays which contain the name, score and duration (in seconds) of
+        each player.
+
+        :return: a string containing the JSON-encoded object.
+        """
+        object_ = {
+            "current": self.current,
+            "max": self.max,
+            "bots": self.bots,
+            "scores": [],
+        }
+        for name, score, duration in self:
+            object_["scores"].append([name, score, duration.total_seconds()])
+        return json.dumps(object_)
+
+    @classmethod
+    def from_bytes(cls, encoded):
+        """Parse players encoded by either :meth:`to_bytes` or :meth:`to_json`.
+
+        The encoding is determined by the first byte. If it's the version
+        byte of a known binary encoding then the players are decoded as
+        such. Otherwise they're assumed to be UTF-8 encoded JSON.
+
+        :param bytes encoded: the encoded players.
+
+        :raises PlayersError: if the encoded players are malformed.
+        :return: a new :class:`Players`.
+        """
+        if not encoded or encoded[0] != cls._BINARY_VERSION:
+            try:
+                return cls.from_json(encoded.decode("utf-8"))
+            except UnicodeDecodeError as exc:
+                raise PlayersError("Bad UTF-8: {}".format(exc)) from exc
+        try:
+            _, current, max_, bots, count = \
+                cls._BINARY_HEADER.unpack_from(encoded)
+            offset = cls._BINARY_HEADER.size
+            scores = []
+            for _ in range(count):
+                length, = cls._BINARY_NAME.unpack_from(encoded, offset)
+                offset += cls._BINARY_NAME.size
+                name = encoded[offset:offset + length].decode("utf-8")
+                offset += length
+                score, duration = cls._BINARY_SCORE.unpack_from(
+                    encoded, offset)
+                offset += cls._BINARY_SCORE.size
+                scores.append(
+                    (name, score, datetime.timedelta(seconds=duration)))
+        except (struct.error, UnicodeDecodeError) as exc:
+            raise PlayersError(
+                "Malformed binary players: {}".format(exc)) from exc
+        if offset != len(encoded):
+            raise PlayersError("Unexpected {} trailing bytes".format(
+                len(encoded) - offset))
+        return cls._trusted(current, max_, bots, tuple(scores))
+
+    def to_bytes(self):
+        """Convert the players to a compact binary form.
+
+        The encoding starts with a version byte, currently ``1``, followed
+        by the current, maximum and bot player counts and the number of
+        scores; each as a big-endian unsigned short. Then for each score
+        there is the length of the UTF-8 encoded player name as an
+        unsigned short, the name itself, the score as a signed 32-bit
+        integer and the connection duration in seconds as a 32-bit float.
+
+        Counts and scores which are out of range are clamped.
+
+        :return: a bytestring containing the encoded players.
+        """
+        scores = list(self)
+        parts = [self._BINARY_HEADER.pack(
+            self._BINARY_VERSION,
+            _clamp(self.current, 0, 0xFFFF),
+            _clamp(self.max, 0, 0xFFFF),
+            _clamp(self.bots, 0, 0xFFFF),
+            _clamp(len(scores), 0, 0xFFFF),
+        )]
+        for name, score, duration in scores[:0xFFFF]:
+            name = name.encode("utf-8")[:0xFFFF]
+            parts.append(self._BINARY_NAME.pack(len(name)))
+            parts.append(name)
+            parts.append(self._BINARY_SCORE.pack(
+                _clamp(score, -0x80000000, 0x7FFFFFFF),
+                duration.total_seconds(),
+            ))
+        return b"".join(parts)
+
+
+#: Shared empty players for statuses that don't have any
+_NO_PLAYERS = Players(current=0, max_=0, bots=0, scores=[])
+
+
+class Status:  # pylint: disable=too-many-instance-attributes
+    """Immutable representation of the state of a server at a point in time.
+
+    :ivar address: the :class:`Address` that identifies the server.
+    :ivar interest: this is ammount of *interest* in the server's state as
+        expressed as an integer. The interest correlates to the number of
+        clients subscribed to the servers state. High interest levels means
+        the state is updated more frequently.
+    :ivar name: the display name of the server. Note that it may contain
+        non-printable characters.
+    :ivar map: the name of the map being played by the server.
+    :ivar application_id: the Steam application ID of the game being played
+        by the server. Note that this is the Steam application ID of the
+        game's client not the server. For example, in the case of TF2 it is
+        440 not 232250.
+    :ivar players: a :class:`Players` instance containing all the players
+        currently on the server. Defaults to an empty :class:`Players` object
+        if not set.
+    :ivar country: the country of server as an ISO 3166 two-letter
+        country identifier string.
+    :ivar latitude: the latitude for the location of the server as a float.
+    :ivar longitude: the longitude for the location of the server as a float.
+    :ivar tags: a frozen set of all the tags applied to the server.
+    :ivar sequence: the number of times the status has changed as an
+        integer. Defaults to zero if not set.
+    """
+
+    __slots__ = (
+        "_address",
+        "_interest",
+        "_sequence",
+        "_name",
+        "_map",
+        "_application_id",
+        "_players",
+        "_country",
+        "_latitude",
+        "_longitude",
+        "_tags",
+    )
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, address, *, interest, name,
+            map_, application_id, players,
+            country, latitude, longitude, tags, sequence=None):
+        if application_id is not None:
+            application_id = int(application_id)
+        if players is not None and not isinstance(players, Players):
+            raise TypeError("Status players must be "
+                            "a {} instance or None".format(Players))
+        if country is not None and country not in iso3166.countries_by_alpha2:
+            raise TypeError("{!r} is not a valid ISO "
+                            "3166 country code".format(country))
+        self._init({
+            "address": address,
+            "interest": 0 if interest is None else int(interest),
+            "sequence": 0 if sequence is None else int(sequence),
+            "name": name if name is None else str(name),
+            "map": map_ if map_ is None else str(map_),
+            "application_id": application_id,
+            "players": players,
+            "country": country,
+            "latitude": latitude if latitude is None else float(latitude),
+            "longitude": longitude if longitude is None else float(longitude),
+            "tags": frozenset(tags),
+        })
+
+    def _init(self, fields):
+        """Initialise the status's slots.
+
+        :param dict fields: the value of each field, keyed by the name of
+            the corresponding attribute.
+        """
+        self._address = fields["address"]
+        self._interest = fields["interest"]
+        self._sequence = fields["sequence"]
+        self._name = fields["name"]
+        self._map = fields["map"]
+        self._application_id = fields["application_id"]
+        players = fields["players"]
+        self._players = _NO_PLAYERS if players is None else players
+        self._country = fields["country"]
+        self._latitude = fields["latitude"]
+        self._longitude = fields["longitude"]
+        self._tags = fields["tags"]
+
+    @classmethod
+    def from_cache(cls, address, fields):
+        """Create a status from values read from the cache.
+
+        Unlike the constructor this trusts that the values are already of
+        the correct types, e.g. that the country was validated when the
+        status was written. The only conversions done are defaulting
+        ``None`` interest, sequence and players.
+
+        :param Address address: the address of the server.
+        :param dict fields: the ``interest``, ``sequence``, ``name``,
+            ``map``, ``application_id``, ``players``, ``country``,
+            ``latitude``, ``longitude`` and ``tags`` of the server, keyed by
+            attribute name.
+
+        :return: a new :class:`Status`.
+        """
+        fields = dict(
+            fields,
+            address=address,
+            interest=fields["interest"] or 0,
+            sequence=fields["sequence"] or 0,
+            tags=frozenset(fields["tags"]),
+        )
+        status = cls.__new__(cls)
+        cls._init(status, fields)
+        return status
+
+    def __repr__(self):
+        return ("<{0.__class__.__name__} {0.address} "
+                "({1} tags)>".format(self, len(self.tags)))
+
+    @property
+    def address(self):
+        """Get the address of the server."""
+        return self._address
+
+    @property
+    def interest(self):
+        """Get the current interest in the server."""
+        return self._interest
+
+    @property
+    def sequence(self):
+        """Get the status sequence number."""
+        return self._sequence
+
+    @property
+    def name(self):
+        """Get the server name."""
+        return self._name
+
+    @property
+    def map(self):
+        """Get the server map."""
+        return self._map
+
+    @property
+    def application_id(self):
+        """Get the server Steam application ID."""
+        return self._application_id
+
+    @property
+    def players(self):
+        """Get the current players."""
+        return self._players
+
+    @property
+    def country(self):
+        """Get the country of the server as a ISO 3166 identifier."""
+        return self._country
+
+    @property
+    def latitude(self):
+        """Get the latitude for the server's location."""
+        return self._latitude
+
+    @property
+    def longitude(self):
+        """get the longitude for the server's location."""
+        return self._longitude
+
+    @property
+    def tags(self):
+        """Get the tags applied to the server."""
+        return self._tags
@@ -0,0 +1,287 @@
+"""Synchronous access to the Redis state cache."""
+
+import asyncio
+import functools
+import inspect
+import threading
+
+from serverstf.cache.asynchronous import AsyncCache
+
+
+class _Synchronous(type):
+    """A metaclass for making an asynchronous API synchronous.
+
+    A class using this metaclass must inherit from a base class which exposes
+    a number of :mod:`asyncio.coroutine` methods. The baseclass, when
+    instantiated should expose a ``loop`` attribute which is a reference to
+    the :mod:`asyncio` event loop being used by that object.
+
+    This metaclass will override the asynchronous methods so that they are
+    synchronous such that their execution will block until the underlying
+    asynchronous method has completed. The arguments the method accepts and
+    its return value will be unmodified.
+
+    The subclass may still explicitly override a method if needs be. In which
+    case the metaclass will not override it implicitly.
+
+    As this metaclass depends on the aforementioned ``loop`` attribute it is
+    only possible for this metaclass to make instance methods synchronous
+    automatically. If any asynchronous class methods are not explicitly
+    overridden then a :exc:`TypeError` will be raised.
+
+    Additionally, private and name mangled methods are not overridden. This
+    is useful if you need to call the asynchronous method from inside another
+    method as you can expose a synchronous public API (just alias the
+    dunder-method) but still call the asynchronous API internally.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        for base in bases:
+            for attr, member in inspect.getmembers(base):
+                if asyncio.iscoroutinefunction(member):
+                    if attr not in attrs and not attr.startswith("_"):
+                        # Check if the member is a class method
+                        if getattr(member, "__self__", None) is base:
+                            raise TypeError("The class method {!r} from {} "
+                                            "must be explicitly overriden in "
+                                            "{!r}".format(attr, base, name))
+                        attrs[attr] = mcs._make_synchronous(member)
+        return super().__new__(mcs, name, bases, attrs)
+
+    @staticmethod
+    def _make_synchronous(function):
+        """Make a :mod:`asyncio.coroutine` wrapped function synchronous.
+
+        Given a would-be coroutine instance method this will wrap the call in
+        ``run_until_complete`` using the event loop of the object exposed as
+        the ``loop`` attribute. All arguments and the return value are
+        propagated.
+
+        :param function: the coroutine function to wrap.
+
+        :return: a synchronous wrapper around ``function``.
+        """
+
+        @functools.wraps(function)
+        def synchronous(self, *args, **kwargs):  # pylint: disable=missing-docstring
+            return self.loop.run_until_complete(
+                function(self, *args, **kwargs))
+
+        return synchronous
+
+
+class Cache(AsyncCache, metaclass=_Synchronous):
+    """A synchronous layer on top of :class:`AsyncCache`.
+
+    This effectively implements the exact same API as :class:`AsyncCache`.
+    Each instance should be bound to an :mod:`asyncio` event loop which will
+    be used for executing the underlying asynchronous operations but will
+    block until they complete.
+
+    As with :class:`AsyncCache` this class should not be instantiated
+    directly. Instead, :meth:`connect` must be used.
+    """
+
+    @classmethod
+    def connect(cls, url, loop, *, pool_size=None):
+        return loop.run_until_complete(
+            super().connect(url, loop, pool_size=pool_size))
+
+    def notifier(self):
+        """Notifiers not available for synchronous caches.
+
+        :raises NotImplementedError:
+        """
+        raise NotImplementedError(
+            "Notifiers not available for synchronous caches.")
+
+    def cache_locally(self, size):
+        """Local caching not available for synchronous caches.
+
+        Invalidating the local cache requires the event loop to be running
+        continuously.
+
+        :raises NotImplementedError:
+        """
+        raise NotImplementedError(
+            "Local caching not available for synchronous caches.")
+
+    def all(self, count=None):
+        """Use :meth:`all_iterator` for the synchronous implementation."""
+        raise NotImplementedError("Use all_iterator instead")
+
+    def all_chunks(self, count=None):
+        """Get an iterator of batches of all addresses in the cache.
+
+        This is a synchronous version of :meth:`all` which yields each
+        non-empty batch returned by :meth:`scan` as a list. Each batch is
+        fetched when the previous one has been consumed.
+
+        :param int count: the ``SSCAN`` batch size hint.
+
+        :return: an iterator of lists of :class:`Address`es.
+        """
+        cursor = 0
+        while cursor is not None:
+            cursor, addresses = self.scan(cursor, count)
+            if addresses:
+                yield addresses
+
+    def all_iterator(self, count=None):
+        """Get an iterator of all addresses in the cache.
+
+        See :meth:`all_chunks`.
+
+        :param int count: the ``SSCAN`` batch size hint.
+
+        :return: an iterator of :class:`Address`es.
+        """
+        for addresses in self.all_chunks(count):
+            yield from addresses
+
+
+class _Threaded(_Synchronous):
+    """A metaclass for making an asynchronous API thread-safe and synchronous.
+
+    This is like :class:`_Synchronous` except that the underlying coroutines
+    are not run by blocking on the object's ``loop``. Instead, that loop is
+    expected to be running forever in another thread and the coroutines are
+    submitted to it with :func:`asyncio.run_coroutine_threadsafe`. Callers
+    block until the coroutine has completed but because the loop is never
+    driven by the caller any number of threads may call methods on the
+    object concurrently.
+    """
+
+    @staticmethod
+    def _make_synchronous(function):
+        """Make a :mod:`asyncio.coroutine` wrapped function thread-safe.
+
+        :param function: the coroutine function to wrap.
+
+        :return: a synchronous wrapper around ``function`` that runs it on
+            the event loop of the object exposed as the ``loop`` attribute.
+        """
+
+        @functools.wraps(function)
+        def synchronous(self, *args, **kwargs):  # pylint: disable=missing-docstring
+            return asyncio.run_coroutine_threadsafe(
+                function(self, *args, **kwargs), self.loop).result()
+
+        return synchronous
+
+
+class ThreadedCache(AsyncCache, metaclass=_Threaded):
+    """A thread-safe synchronous layer on top of :class:`AsyncCache`.
+
+    This implements the same API as :class:`Cache` but rather than each
+    instance being bound to an event loop that the caller drives, it owns a
+    private event loop which runs continuously in a background thread. All
+    calls, from whichever thread, are dispatched to that loop. This means a
+    single instance -- and its connections -- can be shared by a whole
+    thread pool, with concurrent commands being pipelined over the same
+    connections.
+
+    In addition to the blocking API there are batch methods, such as
+    :meth:`get_many_future`, which return a :class:`concurrent.futures.Future`
+    immediately so that callers can overlap requests to Redis with other
+    work.
+
+    Instances should be created with :meth:`connect` and must be closed
+    when finished with so that the background thread is stopped.
+    """
+
+    @classmethod
+    def connect(cls, url, *, pool_size=4):  # pylint: disable=arguments-differ
+        """Establish a connection to a Redis database.
+
+        This starts the event loop thread for the cache.
+
+        :param str url: the URL of the Redis database to connect to.
+        :param int pool_size: the number of connections to share between
+            all calling threads.
+
+        :return: a new :class:`ThreadedCache`.
+        """
+        loop = asyncio.new_event_loop()
+
+        def run():  # pylint: disable=missing-docstring
+            asyncio.set_event_loop(loop)
+            loop.run_forever()
+
+        thread = threading.Thread(target=run, name="cache-loop", daemon=True)
+        thread.start()
+        try:
+            cache = asyncio.run_coroutine_threadsafe(
+                super().connect(url, loop, pool_size=pool_size),
+                loop,
+            ).result()
+        except BaseException:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+            raise
+        cache._thread = thread  # pylint: disable=protected-access
+        return cache
+
+    @asyncio.coroutine
+    def __close(self):
+        """Close the connection from within the event loop thread."""
+        super().close()
+        yield from asyncio.sleep(0, loop=self._loop)
+
+    def close(self):
+        """Close the connection to Redis and stop the event loop thread.
+
+        Once closed the object is invalidated and can no longer be used.
+        """
+        asyncio.run_coroutine_threadsafe(self.__close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def _submit(self, function, *args, **kwargs):
+        """Schedule a coroutine method on the event loop thread.
+
+        :param function: an unbound :class:`AsyncCache` coroutine method.
+
+        :return: a :class:`concurrent.futures.Future` for the result of
+            calling ``function`` with the given arguments.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            function(self, *args, **kwargs), self._loop)
+
+    def get_many_future(self, addresses):
+        """Retrieve many server statuses without blocking.
+
+        See :meth:`AsyncCache.get_many`.
+
+        :return: a :class:`concurrent.futures.Future` for the dictionary of
+            addresses to :class:`Status`es.
+        """
+        return self._submit(AsyncCache.get_many, list(addresses))
+
+    def set_many_future(self, statuses):
+        """Commit a batch of server statuses without blocking.
+
+        See :meth:`AsyncCache.set_many`.
+
+        :return: a :class:`concurrent.futures.Future` for the dictionary of
+            addresses to added and removed tags.
+        """
+        return self._submit(AsyncCache.set_many, list(statuses))
+
+    def scan_future(self, cursor=0, count=None):
+        """Fetch a batch of addresses without blocking.
+
+        See :meth:`AsyncCache.scan`.
+
+        :return: a :class:`concurrent.futures.Future` for the next cursor
+            and list of addresses.
+        """
+        return self._submit(AsyncCache.scan, cursor, count)
+
+    notifier = Cache.notifier
+    cache_locally = Cache.cache_locally
+    all = Cache.all
+    all_chunks = Cache.all_chunks
+    all_iterator = Cache.all_iterator
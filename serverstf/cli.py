@@ -201,3 +201,41 @@ def redis(function):
         default="//localhost",
         help="The URL of the Redis database to use."
     )
+
+
+def _pool_size(raw_size):
+    """Parse the size of a Redis connection pool.
+
+    Pools need at least two connections, as each transaction holds one of
+    them and one is always left free for other commands.
+
+    :param str raw_size: the size to parse.
+
+    :return: the pool size as an integer.
+    """
+    try:
+        size = int(raw_size)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(
+            "Pool size must be an integer") from exc
+    if size < 2:
+        raise argparse.ArgumentTypeError(
+            "Pool size must be at least two but got {}".format(size))
+    return size
+
+
+def redis_pool(function):
+    """Add an argument for the size of a Redis connection pool.
+
+    This adds an optional ``--redis-pool-size`` argument to the subcommand
+    which sets the number of connections to pool. It defaults to four and
+    must be at least two. It should be used alongside :func:`redis` but
+    only by subcommands which use a pooled cache.
+    """
+    return _add_argument(
+        function,
+        "--redis-pool-size",
+        type=_pool_size,
+        default=4,
+        help="The number of Redis connections to pool. Default is four."
+    )
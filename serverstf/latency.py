@@ -9,9 +9,7 @@ The former collects the raw data by pinging every server in the given cache
 and writes it to file. The latter plots this data using Bokeh.
 """
 
-import asyncio
 import concurrent.futures
-import contextlib
 import functools
 import json
 import logging
@@ -19,7 +17,6 @@ import math
 import multiprocessing
 import pathlib
 import tempfile
-import threading
 
 import bokeh.plotting
 import valve.source.a2s
@@ -99,7 +96,8 @@ def _poll(address, *, cache, origin, samples):
     are not set then no results will be returned.
 
     :param serverstf.cache.Address address: the address of the server to ping.
-    :param cache: see :func:`_thread_local_cache`.
+    :param serverstf.cache.ThreadedCache cache: the cache to read the server
+        from. This is shared by all threads.
     :param origin: a two-tuple containing latitude and longitude of the
         'current' position.
     :param samples int: the number of times to ping the server.
@@ -108,38 +106,21 @@ def _poll(address, *, cache, origin, samples):
         between the origin and server and the ping.
     """
     results = []
-    with cache() as cache_i:
-        status = cache_i.get(address)
-        if (status.latitude is not None
-                and status.longitude is not None):
-            results.extend(_sample(
-                address,
-                origin,
-                (status.latitude, status.longitude),
-                samples,
-            ))
+    status = cache.get(address)
+    if (status.latitude is not None
+            and status.longitude is not None):
+        results.extend(_sample(
+            address,
+            origin,
+            (status.latitude, status.longitude),
+            samples,
+        ))
     return results
 
 
-def _thread_local_cache(local, redis_url):
-    """Create thread-local caches.
-
-    :return: a context manager factory that when entered return a
-        :class:`serverstf.cache.Cache` that is local to the current thread.
-    """
-
-    @contextlib.contextmanager
-    def context():  # pylint: disable=missing-docstring
-        if not hasattr(local, "cache"):
-            local.cache = serverstf.cache.Cache.connect(
-                redis_url, asyncio.new_event_loop())
-        yield local.cache
-
-    return context
-
-
 @serverstf.cli.subcommand("latency")
 @serverstf.cli.redis
+@serverstf.cli.redis_pool
 @serverstf.cli.argument("longitude", type=float)
 @serverstf.cli.argument("latitude", type=float)
 @serverstf.cli.argument(
@@ -163,14 +144,14 @@ def _thread_local_cache(local, redis_url):
 )
 def _ping_all(args):
     """Ping all servers in the cache."""
-    loop = asyncio.get_event_loop()
     with args.output.open("a") as output:
-        with serverstf.cache.Cache.connect(args.redis, loop) as i_cache:
+        with serverstf.cache.ThreadedCache.connect(
+                args.redis, pool_size=args.redis_pool_size) as i_cache:
             with concurrent.futures.ThreadPoolExecutor(
                 max_workers=args.threads) as executor:
                 poll_bound = functools.partial(
                     _poll,
-                    cache=_thread_local_cache(threading.local(), args.redis),
+                    cache=i_cache,
                     origin=(args.latitude, args.longitude),
                     samples=args.samples,
                 )
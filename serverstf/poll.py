@@ -3,31 +3,40 @@
 This module implements the ``poll`` subcommand which is a simple service
 that takes responsibility for keeping the server state cache up to date.
 
-It watches a Redis list for :class:`serverstf.cache.Address`es to poll.
+It watches Redis for :class:`serverstf.cache.Address`es to poll.
 When a server is polled A2S requests are issued to it and the tags are
-re-evaluated. This updated state is then comitted to the cache.
+re-evaluated. This updated state is then comitted to the cache. Many servers
+are polled concurrently using the asynchronous :mod:`serverstf.a2s` client
+so that a single unresponsive server doesn't hold up the others.
 
 The poller has two modes: normal and passive. In the normal mode the poller
 watches the so-called 'interest queue'. The interest queue is a kind of
-priority queue where the ammount of *interest* in an address determines how
-many occurrences of it there is the queue and hence controls how frequently
-it gets polled.
+schedule where the ammount of *interest* in an address determines when it's
+next due and hence controls how frequently it gets polled.
 
 In passive mode the poller simply polls all servers known to the cache.
 This is done in an attempt to prevent cache states becoming too stale if
-they're not in the interest queue.
+they're not in the interest queue. How often each server is polled in this
+mode adapts to how often its state is observed to change; see
+:class:`Intervals`.
+
+Servers which repeatedly fail to respond have their failures recorded in the
+cache. The ``reaper`` subcommand evicts servers which have been failing for
+longer than a configurable period so they don't accumulate forever.
 """
 
 import asyncio
+import collections
 import datetime
+import functools
 import logging
+import time
 
 import geoip2.database
 import maxminddb
-import valve.source.a2s
-import valve.source.messages
 
 import serverstf
+import serverstf.a2s
 import serverstf.cache
 import serverstf.cli
 import serverstf.tags
@@ -40,35 +49,138 @@ class PollError(Exception):
     """Exception raised for all polling errors."""
 
 
-def _query_server(address):
+class Responses:
+    """Remembers the slowly changing A2S responses of servers.
+
+    Server info is cheap to query and is fetched on every poll. The players
+    response is only needed for the individual players' scores as the
+    player counts are taken from the info, so it's refreshed at a moderate
+    rate. The rules response is the largest, often being split across
+    packets and compressed, yet it rarely changes other than when the map
+    does. So it's only refreshed at a slow rate or when the map changes.
+    The players are refreshed on map changes too.
+
+    :param loop: the :mod:`asyncio` event loop whose clock to use.
+    :param float players_interval: the number of seconds to reuse a players
+        response for.
+    :param float rules_interval: the number of seconds to reuse a rules
+        response for.
+    """
+
+    _Entry = collections.namedtuple(
+        "_Entry", ("map", "players", "players_due", "rules", "rules_due"))
+
+    def __init__(self, *, loop, players_interval, rules_interval):
+        self._loop = loop
+        self._players_interval = players_interval
+        self._rules_interval = rules_interval
+        self._entries = {}
+
+    def __repr__(self):
+        return "<{0.__class__.__name__} for {1} addresses>".format(
+            self, len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, address, info):
+        """Get the reusable responses for a server.
+
+        :param serverstf.cache.Address address: the address of the server.
+        :param dict info: the server's current info response.
+
+        :return: a tuple of the players and rules responses. Either will be
+            ``None`` if it needs to be fetched again.
+        """
+        entry = self._entries.get(address)
+        if entry is None or entry.map != info["map"]:
+            return None, None
+        now = self._loop.time()
+        return (entry.players if entry.players_due > now else None,
+                entry.rules if entry.rules_due > now else None)
+
+    def update(self, address, info, players=None, rules=None):
+        """Remember freshly fetched responses for a server.
+
+        :param serverstf.cache.Address address: the address of the server.
+        :param dict info: the server's current info response.
+        :param dict players: the players response if it was fetched.
+        :param dict rules: the rules response if it was fetched.
+        """
+        now = self._loop.time()
+        entry = self._entries.get(address)
+        if entry is None:
+            entry = self._Entry(None, None, 0.0, None, 0.0)
+        entry = entry._replace(map=info["map"])
+        if players is not None:
+            entry = entry._replace(
+                players=players, players_due=now + self._players_interval)
+        if rules is not None:
+            entry = entry._replace(
+                rules=rules, rules_due=now + self._rules_interval)
+        self._entries[address] = entry
+
+    def forget(self, address):
+        """Forget the responses for a server."""
+        self._entries.pop(address, None)
+
+    def expire(self):
+        """Forget the servers whose responses are all due to be refetched.
+
+        The remembered map is all that's left of these servers' entries,
+        and that's only used to decide whether to reuse the responses.
+        """
+        now = self._loop.time()
+        for address, entry in list(self._entries.items()):
+            if entry.players_due <= now and entry.rules_due <= now:
+                del self._entries[address]
+
+
+@asyncio.coroutine
+def _query_server(querier, address, responses=None):
     """Query the server info, players and rules.
 
     This issues a number of A2S queries to server identified by the given
-    address.
+    address. If a :class:`Responses` is given then the players and rules
+    responses remembered by it are reused where possible rather than being
+    queried again.
 
+    :param serverstf.a2s.Querier querier: the querier to issue requests with.
     :param servers.cache.Address address: the address of the server to query.
+    :param Responses responses: remembered responses to reuse and update.
 
     :raise PollError: if the server is unreachable or does not return a
         valid response.
     :return: a tuple containing the server info, players and rules as returned
-        by a :class:`valve.source.a2s.ServerQuerier`.
+        by a :class:`serverstf.a2s.Querier`.
     """
-    query = valve.source.a2s.ServerQuerier(
-        (str(address.ip), address.port), timeout=5)
     try:
-        return query.get_info(), query.get_players(), query.get_rules()
-    except valve.source.a2s.NoResponseError as exc:
+        info = yield from querier.info(address)
+        players, rules = None, None
+        if responses is not None:
+            players, rules = responses.get(address, info)
+        fetched_players = fetched_rules = None
+        if players is None:
+            players = fetched_players = yield from querier.players(address)
+        if rules is None:
+            rules = fetched_rules = yield from querier.rules(address)
+    except serverstf.a2s.NoResponseError as exc:
+        if responses is not None:
+            responses.forget(address)
         raise PollError("Timed out waiting for "
                         "response from {}".format(address)) from exc
-    except NotImplementedError as exc:
-        raise PollError("Compressed fragments; "
-                        "couldn't poll {}".format(address)) from exc
-    except valve.source.messages.BrokenMessageError as exc:
-        raise PollError(
-            "Seemingly broken response from {}".format(address)) from exc
-
-
-def poll(tagger, geoip, address):
+    except serverstf.a2s.A2SError as exc:
+        if responses is not None:
+            responses.forget(address)
+        raise PollError("Seemingly broken response "
+                        "from {}: {}".format(address, exc)) from exc
+    if responses is not None:
+        responses.update(address, info, fetched_players, fetched_rules)
+    return info, players, rules
+
+
+@asyncio.coroutine
+def poll(querier, tagger, geoip, address, responses=None):
     """Poll the state of a server.
 
     This will issue a number of requests to the server at the given address
@@ -76,17 +188,22 @@ def poll(tagger, geoip, address):
     tags that should be applied to the server. The location of the server is
     also looked up in a GeoIP database.
 
+    :param serverstf.a2s.Querier querier: the querier to issue requests with.
     :param serverstf.tags.Tagger tagger: the tagger used to determine server
         tags.
     :param geoip2.database.Reader geoip: the MaxMind GeoIP2 database used to
         determine the geographic location of the server.
     :param servers.cache.Address address: the address of the server to poll.
+    :param Responses responses: remembered players and rules responses to
+        reuse, see :func:`_query_server`. If not given then every response
+        is queried.
 
     :return: a :class:`serverstf.cache.Status` containing the up-to-date
         state of the server.
     """
     log.debug("Polling %s", address)
-    info, players, rules = _query_server(address)
+    info, players, rules = \
+        yield from _query_server(querier, address, responses)
     tags = tagger.evaluate(info, players, rules)
     location = geoip.city(str(address.ip))
     scores = []
@@ -116,75 +233,684 @@ def poll(tagger, geoip, address):
     )
 
 
-def _interest_queue_iterator(cache):
-    """Expose a cache's interest queue as an iterator.
+class _Subnets:
+    """Per-subnet concurrency limits for a :class:`Scheduler`.
+
+    A semaphore is kept for each subnet only whilst there are invocations
+    waiting on or holding it.
+
+    :param loop: the :mod:`asyncio` event loop to use.
+    :param int concurrency: the maximum number of invocations that may run
+        at once for addresses within the same subnet.
+    :param int prefix: the prefix length used to group addresses into
+        subnets.
+    """
+
+    def __init__(self, *, loop, concurrency, prefix):
+        self._loop = loop
+        self._concurrency = concurrency
+        self._shift = 32 - prefix
+        self._subnets = {}
+
+    def __len__(self):
+        return len(self._subnets)
+
+    def _subnet(self, address):
+        """Get the subnet identifier for an address."""
+        return int(address.ip) >> self._shift
+
+    def enter(self, address):
+        """Get the semaphore for an address's subnet.
+
+        Every call must be paired with a call to :meth:`leave`.
+
+        :return: the :class:`asyncio.Semaphore` limiting invocations for
+            the subnet.
+        """
+        subnet = self._subnet(address)
+        if subnet not in self._subnets:
+            self._subnets[subnet] = [asyncio.Semaphore(
+                self._concurrency, loop=self._loop), 0]
+        self._subnets[subnet][1] += 1
+        return self._subnets[subnet][0]
+
+    def leave(self, address):
+        """Release the semaphore for an address's subnet if it's unused."""
+        subnet = self._subnet(address)
+        self._subnets[subnet][1] -= 1
+        if not self._subnets[subnet][1]:
+            del self._subnets[subnet]
+
+
+SchedulerLimits = collections.namedtuple(
+    "SchedulerLimits",
+    (
+        "concurrency",
+        "subnet_concurrency",
+        "subnet_prefix",
+        "backlog",
+    )
+)
+SchedulerLimits.__doc__ = """\
+Limits on how many invocations a :class:`Scheduler` may run at once.
+
+:ivar int concurrency: the maximum number of invocations that may run at
+    once.
+:ivar int subnet_concurrency: the maximum number of invocations that may
+    run at once for addresses within the same subnet.
+:ivar int subnet_prefix: the prefix length used to group addresses into
+    subnets.
+:ivar int backlog: the maximum number of scheduled invocations, including
+    those waiting for a slot. If ``None`` then it's four times the
+    ``concurrency``.
+"""
+
+
+class Scheduler:
+    """Bounded-concurrency poll scheduler.
+
+    Schedulers run a coroutine function for each address submitted to them
+    whilst limiting how many are running at once. There are two limits: a
+    global one and one per destination subnet. The latter prevents a single
+    host or provider with many servers being flooded with queries.
 
-    .. note::
-        It is possible the generator returned by function can never be
-        exhausted.
+    Submissions for an address that is already scheduled are coalesced; the
+    caller is given the future of the existing invocation rather than a new
+    one being started. This is important as the interest queue deliberately
+    contains many copies of popular addresses.
+
+    :param function: a coroutine function which is called with each
+        submitted :class:`serverstf.cache.Address`.
+    :param SchedulerLimits limits: the limits on the number of invocations
+        of ``function``.
+    :param loop: the :mod:`asyncio` event loop to use.
+    """
+
+    def __init__(self, function, limits, *, loop):
+        self._function = function
+        self._loop = loop
+        self._subnets = _Subnets(loop=loop,
+                                 concurrency=limits.subnet_concurrency,
+                                 prefix=limits.subnet_prefix)
+        self._slots = asyncio.Semaphore(limits.concurrency, loop=loop)
+        self._backlog = asyncio.Semaphore(
+            limits.backlog or limits.concurrency * 4, loop=loop)
+        self._scheduled = {}
+
+    def __repr__(self):
+        return ("<{0.__class__.__name__} {1} scheduled "
+                "across {2} subnets>".format(
+                    self, len(self._scheduled), len(self._subnets)))
+
+    @asyncio.coroutine
+    def _run(self, address):
+        """Invoke the function once slots are available for the address.
+
+        The per-subnet slot is acquired first so that addresses waiting on a
+        busy subnet don't hold on to global slots.
+        """
+        subnet_slots = self._subnets.enter(address)
+        try:
+            with (yield from subnet_slots):
+                with (yield from self._slots):
+                    return (yield from self._function(address))
+        finally:
+            self._subnets.leave(address)
+
+    def _finished(self, address, future):  # pylint: disable=unused-argument
+        """Clean up after an invocation has completed."""
+        del self._scheduled[address]
+        self._backlog.release()
+
+    @asyncio.coroutine
+    def submit(self, address):
+        """Schedule the function to be called for an address.
+
+        If the address is already scheduled then this returns immediately.
+        Otherwise this blocks until there is room in the backlog.
+
+        :param serverstf.cache.Address address: the address to schedule.
+
+        :return: a future for the result of the function call.
+        """
+        if address in self._scheduled:
+            log.debug("Coalescing duplicate poll for %s", address)
+            return self._scheduled[address]
+        yield from self._backlog.acquire()
+        if address in self._scheduled:
+            self._backlog.release()
+            return self._scheduled[address]
+        task = asyncio.Task(self._run(address), loop=self._loop)
+        task.add_done_callback(functools.partial(self._finished, address))
+        self._scheduled[address] = task
+        return task
+
+
+class Intervals:
+    """Adaptive per-server poll intervals.
+
+    This keeps a short history for each address of whether its state changed
+    between consecutive polls. The history drives the interval until the
+    address is next due to be polled:
+
+    * When a poll observes a change the interval is halved.
+    * When nothing has changed for the whole history the interval is
+      doubled. A server that changes only occasionally therefore holds its
+      current interval rather than oscillating.
+    * When a poll fails the interval is doubled, so unresponsive servers
+      back off exponentially. If the number of consecutive failures
+      recorded in the cache is known then the interval is at least the
+      minimum doubled for each of them, so the back off survives restarts.
+
+    Intervals are always kept within the given bounds. Addresses which
+    haven't been seen before are due immediately and start at the minimum
+    interval.
+
+    Failing addresses are remembered so that they can be retried once due,
+    see :meth:`retries`, as they're no longer in the cache's live servers.
+    Everything else is forgotten when :meth:`retain` isn't given it.
+
+    :param loop: the :mod:`asyncio` event loop whose clock to use.
+    :param float minimum: the shortest interval in seconds.
+    :param float maximum: the longest interval in seconds.
+    :param int history: the number of polls to remember per address.
+    """
+
+    # Per-address state: interval, next due time, the fingerprint of the
+    # last observed state and a deque of whether each poll saw a change.
+    _Entry = collections.namedtuple(
+        "_Entry", ("interval", "due", "fingerprint", "changes"))
+
+    def __init__(self, *, loop, minimum, maximum, history=8):
+        if minimum <= 0 or maximum < minimum:
+            raise ValueError("Invalid interval bounds "
+                             "{!r} to {!r}".format(minimum, maximum))
+        self._loop = loop
+        self._minimum = minimum
+        self._maximum = maximum
+        self._history = history
+        self._entries = {}
+        self._failing = set()
+
+    def __repr__(self):
+        return ("<{0.__class__.__name__} {1} addresses ({2} failing) "
+                "between {0._minimum}s and {0._maximum}s>".format(
+                    self, len(self._entries), len(self._failing)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _clamp(self, interval):
+        """Restrict an interval to the configured bounds."""
+        return min(self._maximum, max(self._minimum, interval))
+
+    def _entry(self, address):
+        """Get the entry for an address, creating it if needs be."""
+        if address not in self._entries:
+            self._entries[address] = self._Entry(
+                self._minimum, 0.0, None,
+                collections.deque(maxlen=self._history))
+        return self._entries[address]
+
+    def interval(self, address):
+        """Get the current poll interval for an address in seconds."""
+        return self._entry(address).interval
+
+    def claim(self, address):
+        """Check if an address is due to be polled.
+
+        If it is due then its next due time is provisionally pushed back by
+        its current interval so that it isn't claimed again whilst the poll
+        is still in progress.
+
+        :param serverstf.cache.Address address: the address to check.
+
+        :return: ``True`` if the address should be polled now.
+        """
+        entry = self._entry(address)
+        now = self._loop.time()
+        if entry.due > now:
+            return False
+        self._entries[address] = entry._replace(due=now + entry.interval)
+        return True
+
+    def retries(self):
+        """Claim the failing addresses that are due to be retried.
+
+        :return: a list of the claimed :class:`serverstf.cache.Address`es.
+        """
+        return [address for address in list(self._failing)
+                if self.claim(address)]
+
+    def forget(self, address):
+        """Forget an address's interval and history."""
+        self._entries.pop(address, None)
+        self._failing.discard(address)
+
+    def retain(self, addresses):
+        """Forget every address that isn't given unless it's failing.
+
+        :param set addresses: the addresses to remember.
+        """
+        for address in set(self._entries) - addresses - self._failing:
+            del self._entries[address]
+
+    def wait(self):
+        """Get the time until the next address becomes due.
+
+        :return: the number of seconds until the earliest due time, no
+            shorter than one second and no longer than the minimum
+            interval so that newly added servers are picked up promptly.
+        """
+        now = self._loop.time()
+        earliest = min((entry.due for entry in self._entries.values()),
+                       default=now + self._minimum)
+        return min(self._minimum, max(1.0, earliest - now))
+
+    def observe(self, status):
+        """Record a successful poll.
+
+        :param serverstf.cache.Status status: the polled status.
+        """
+        entry = self._entry(status.address)
+        fingerprint = (
+            status.name,
+            status.map,
+            status.players.current,
+            status.players.bots,
+            status.players.max,
+            frozenset(status.tags),
+        )
+        changed = fingerprint != entry.fingerprint
+        entry.changes.append(changed)
+        if changed:
+            interval = entry.interval / 2
+        elif (len(entry.changes) == entry.changes.maxlen
+              and not any(entry.changes)):
+            interval = entry.interval * 2
+        else:
+            interval = entry.interval
+        interval = self._clamp(interval)
+        self._entries[status.address] = entry._replace(
+            interval=interval,
+            due=self._loop.time() + interval,
+            fingerprint=fingerprint,
+        )
+        self._failing.discard(status.address)
+
+    def fail(self, address, failures=None):
+        """Record a failed poll.
+
+        :param serverstf.cache.Address address: the address of the server
+            that couldn't be polled.
+        :param int failures: the number of consecutive failures for the
+            server as recorded in the cache, if known.
+        """
+        entry = self._entry(address)
+        interval = entry.interval * 2
+        if failures:
+            # Cap the exponent; anything this large is clamped anyway.
+            interval = max(interval, self._minimum * 2 ** min(failures, 32))
+        interval = self._clamp(interval)
+        self._entries[address] = entry._replace(
+            interval=interval, due=self._loop.time() + interval)
+        self._failing.add(address)
+
+
+#: The maximum number of addresses to read or statuses to write at once
+BATCH_SIZE = 64
+
+
+def _interesting_addresses(cache):
+    """Expose a cache's interest queue as a coroutine function.
+
+    :return: a coroutine function which returns a list of due
+        :class:`serverstf.cache.Address`es each time it's called. The list
+        will be empty if there are no due addresses.
+    """
+    return functools.partial(cache.interesting_many, BATCH_SIZE)
+
+
+def _all_addresses(cache):
+    """Expose every live address in a cache as a coroutine function.
+
+    :return: a coroutine function which returns a list of
+        :class:`serverstf.cache.Address`es each time it's called. The list
+        will be empty once all addresses have been exhausted.
+    """
+    cursor = 0
+
+    @asyncio.coroutine
+    def next_():  # pylint: disable=missing-docstring
+        nonlocal cursor
+        while cursor is not None:
+            cursor, addresses = yield from cache.scan(
+                cursor, BATCH_SIZE, live=True)
+            if addresses:
+                return addresses
+        return []
+
+    return next_
+
+
+@asyncio.coroutine
+def _commit(cache, statuses):
+    """Continually write polled statuses to the cache.
+
+    Statuses are taken from the queue and written with
+    :meth:`serverstf.cache.AsyncCache.set_many` in batches of up to
+    :data:`BATCH_SIZE`. Whilst one batch is being written the next one
+    accumulates in the queue. Failure to write a batch is logged but
+    otherwise ignored.
+
+    :param serverstf.cache.AsyncCache cache: the cache to write to.
+    :param asyncio.Queue statuses: a queue of
+        :class:`serverstf.cache.Status`es to write.
     """
     while True:
+        batch = [(yield from statuses.get())]
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(statuses.get_nowait())
+            except asyncio.QueueEmpty:
+                break
         try:
-            with cache.interesting_context() as address:
-                yield address
-        except serverstf.cache.EmptyQueueError:
-            return
+            yield from cache.set_many(batch)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Couldn't commit %i statuses", len(batch))
+
+
+@asyncio.coroutine
+def _sweep(r_cache, scheduler, intervals, all_):
+    """Submit addresses from the cache to be polled.
 
+    This reads every address from either the interest queue or the cache's
+    live servers once. When polling all servers only the addresses that are
+    due according to the given :class:`Intervals` are submitted. Failing
+    servers, which aren't live, are retried once they're due and every
+    other address that wasn't read is forgotten by the intervals.
 
-def _watch(r_cache, w_cache, geoip, all_):
+    :param serverstf.cache.AsyncCache r_cache: the cache to read addresses
+        from.
+    :param Scheduler scheduler: the scheduler to submit addresses to.
+    :param Intervals intervals: the poll intervals for each address.
+    :param bool all_: whether to read every live server in the cache
+        rather than the interest queue.
+
+    :return: the number of addresses submitted.
+    """
+    if all_:
+        next_addresses = _all_addresses(r_cache)
+    else:
+        next_addresses = _interesting_addresses(r_cache)
+    polled = 0
+    swept = set()
+    while True:
+        addresses = yield from next_addresses()
+        if not addresses:
+            break
+        for address in addresses:
+            if all_:
+                swept.add(address)
+            if not all_ or intervals.claim(address):
+                polled += 1
+                yield from scheduler.submit(address)
+    if all_:
+        for address in intervals.retries():
+            polled += 1
+            yield from scheduler.submit(address)
+        intervals.retain(swept)
+    return polled
+
+
+@asyncio.coroutine
+def _watch(r_cache, w_cache, geoip, args):
     """Poll servers in the cache.
 
     This will poll servers in the cache updating their statuses as it goes.
     Either the interest queue or entire cache is used to determining which
     servers to poll.
 
-    Two separate caches using separate connections must be provided; one for
-    reading addresses and one for writing the updates. This is to work around
-    the fact that publishing updates to a cache creates a MULTI transaction
-    which can interfere with the operations to read addresses from the cache.
+    Polls are run by a :class:`Scheduler` which bounds how many servers are
+    polled at once and coalesces duplicate addresses. All polls share a
+    single :class:`serverstf.a2s.Querier`. Addresses are read from the cache
+    in batches, but only when there is room in the scheduler's backlog.
 
-    :param serverstf.cache.Cache r_cache: the server status cache to read
+    Two separate caches using separate connections must be provided; one for
+    reading addresses and one for writing the updates. This is so that large
+    batches of writes don't delay reading the next addresses to poll. Writes
+    are batched by a single :func:`_commit` task. Failed polls are recorded
+    in the cache immediately so that dead servers can be reaped; see
+    :func:`_reap`.
+
+    When polling all servers only the live servers are read from the cache
+    and each is only polled once it's due according to an
+    :class:`Intervals`. Sweeps of the cache are paced by the earliest due
+    time. In either mode the players and rules responses are reused
+    between polls according to a :class:`Responses`, which is expired
+    after every sweep. Servers that the cache reports have been evicted
+    when they fail are forgotten by both.
+
+    :param serverstf.cache.AsyncCache r_cache: the server status cache to read
         addresses from.
-    :param serverstf.cache.Cache w_cache: the server status cache to write
-        updates to.
+    :param serverstf.cache.AsyncCache w_cache: the server status cache to
+        write updates to.
     :param geoip2.database.Reader geoip: the MaxMind GeoIP2 database used to
         determine the geographic location of the servers.
-    :param bool all_: if ``True`` then every server in the cache will be
-        polled. Otherwise only servers which exist in the internet queue
-        will be.
+    :param args: the parsed command line arguments; see
+        :func:`_poller_main`. If ``--all`` is given then every server in the
+        cache will be polled. Otherwise only servers which exist in the
+        interest queue will be.
     """
-    log.info("Watching %s; all: %s", r_cache, all_)
+    log.info("Watching %s; all: %s", r_cache, args.all)
     log.info("Writing to %s", w_cache)
+    loop = r_cache.loop
     tagger = serverstf.tags.Tagger.scan(__package__)
-    while True:
-        if all_:
-            addresses = r_cache.all_iterator()
+    statuses = asyncio.Queue(loop=loop)
+    intervals = Intervals(loop=loop,
+                          minimum=args.min_interval,
+                          maximum=args.max_interval)
+    responses = Responses(loop=loop,
+                          players_interval=args.players_interval,
+                          rules_interval=args.rules_interval)
+
+    @asyncio.coroutine
+    def poll_and_queue(address):  # pylint: disable=missing-docstring
+        try:
+            status = yield from poll(
+                querier, tagger, geoip, address, responses)
+        except PollError as exc:
+            log.error("Couldn't poll %s: %s", address, exc)
+        except asyncio.CancelledError:
+            raise
+        except Exception:  # pylint: disable=broad-except
+            # E.g. the address is missing from the GeoIP database or a tag
+            # implementation is broken. Nothing retrieves the scheduler's
+            # task results, so these must be logged here.
+            log.exception("Unexpected error polling %s", address)
         else:
-            addresses = _interest_queue_iterator(r_cache)
-        for address in addresses:
+            if args.all:
+                intervals.observe(status)
+            statuses.put_nowait(status)
+            return
+        try:
+            failures = yield from w_cache.fail(address)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Couldn't record failure for %s", address)
+            failures = 0
+        if failures is None:
+            log.info("Forgetting %s as it's no longer cached", address)
+            intervals.forget(address)
+            responses.forget(address)
+        elif args.all:
+            intervals.fail(address, failures)
+
+    scheduler = Scheduler(
+        poll_and_queue,
+        SchedulerLimits(
+            concurrency=args.concurrency,
+            subnet_concurrency=args.subnet_concurrency,
+            subnet_prefix=24,
+            backlog=None,
+        ),
+        loop=loop,
+    )
+    querier = yield from serverstf.a2s.Querier.create(loop)
+    committer = asyncio.Task(_commit(w_cache, statuses), loop=loop)
+    try:
+        with querier:
+            while True:
+                polled = yield from _sweep(
+                    r_cache, scheduler, intervals, args.all)
+                responses.expire()
+                if args.all:
+                    log.debug("Swept cache; polled %i; %r; %r",
+                              polled, intervals, responses)
+                    yield from asyncio.sleep(intervals.wait(), loop=loop)
+                elif not polled:
+                    yield from asyncio.sleep(1, loop=loop)
+    finally:
+        committer.cancel()
+
+
+@asyncio.coroutine
+def _poller_async_main(args, loop, geoip):
+    """Connect to the cache and continuously poll servers.
+
+    See :func:`_poller_main`.
+    """
+    r_cache_context = yield from serverstf.cache.AsyncCache.connect(
+        args.redis, loop, pool_size=args.redis_pool_size)
+    with r_cache_context as r_cache:
+        w_cache_context = yield from serverstf.cache.AsyncCache.connect(
+            args.redis, loop, pool_size=args.redis_pool_size)
+        with w_cache_context as w_cache:
+            yield from _watch(r_cache, w_cache, geoip, args)
+
+
+@asyncio.coroutine
+def _reap(cache, dead_period, interval):
+    """Continually evict dead servers from the cache.
+
+    A server is dead if every poll of it has failed for longer than the
+    dead period. Dead servers are found with
+    :meth:`serverstf.cache.AsyncCache.dead` and removed with
+    :meth:`serverstf.cache.AsyncCache.evict`. Failure to evict a server is
+    logged but otherwise ignored.
+
+    :param serverstf.cache.AsyncCache cache: the cache to reap.
+    :param float dead_period: the number of seconds a server must have been
+        failing for to be evicted.
+    :param float interval: the number of seconds to wait between looking
+        for dead servers once none are left or some couldn't be evicted.
+    """
+    log.info("Reaping servers dead for %is from %s", dead_period, cache)
+    while True:
+        dead = yield from cache.dead(time.time() - dead_period, BATCH_SIZE)
+        evicted = 0
+        for address in dead:
             try:
-                status = poll(tagger, geoip, address)
-            except PollError as exc:
-                log.error("Couldn't poll %s: %s", address, exc)
+                yield from cache.evict(address)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Couldn't evict %s", address)
             else:
-                w_cache.set(status)
+                evicted += 1
+        # Only carry straight on with the next batch if this one was full
+        # and wholly evicted, otherwise the same batch would be retried
+        # without pause.
+        if len(dead) < BATCH_SIZE or evicted < len(dead):
+            yield from asyncio.sleep(interval, loop=cache.loop)
+
+
+@asyncio.coroutine
+def _reaper_async_main(args, loop):
+    """Connect to the cache and continuously reap dead servers.
+
+    See :func:`_reaper_main`.
+    """
+    cache_context = yield from serverstf.cache.AsyncCache.connect(
+        args.redis, loop, pool_size=args.redis_pool_size)
+    with cache_context as cache:
+        yield from _reap(cache, args.dead_period, args.interval)
+
+
+@asyncio.coroutine
+def _poll_once(geoip, address):
+    """Poll a single server using a temporary querier.
+
+    :return: a :class:`serverstf.cache.Status` for the server.
+    """
+    tagger = serverstf.tags.Tagger.scan(__package__)
+    querier = yield from serverstf.a2s.Querier.create(
+        asyncio.get_event_loop())
+    with querier:
+        return (yield from poll(querier, tagger, geoip, address))
 
 
 @serverstf.cli.subcommand("poller")
 @serverstf.cli.geoip
 @serverstf.cli.redis
+@serverstf.cli.redis_pool
 @serverstf.cli.argument(
     "--all",
     action="store_true",
-    help=("When set the poller will poll all servers "
+    help=("When set the poller will poll all live servers "
           "in the cache, not only those in the interest queue."),
 )
+@serverstf.cli.argument(
+    "--concurrency",
+    type=int,
+    default=256,
+    help="The maximum number of servers to poll at once. Default is 256.",
+)
+@serverstf.cli.argument(
+    "--subnet-concurrency",
+    type=int,
+    default=8,
+    help=("The maximum number of servers within the same /24 "
+          "subnet to poll at once. Default is 8."),
+)
+@serverstf.cli.argument(
+    "--min-interval",
+    type=float,
+    default=15.0,
+    help=("The shortest time in seconds between polls of a server when "
+          "polling all servers. Default is 15."),
+)
+@serverstf.cli.argument(
+    "--max-interval",
+    type=float,
+    default=900.0,
+    help=("The longest time in seconds between polls of a server when "
+          "polling all servers. Default is 900."),
+)
+@serverstf.cli.argument(
+    "--players-interval",
+    type=float,
+    default=60.0,
+    help=("The number of seconds to reuse a server's player list for "
+          "before querying it again. Default is 60."),
+)
+@serverstf.cli.argument(
+    "--rules-interval",
+    type=float,
+    default=600.0,
+    help=("The number of seconds to reuse a server's rules for before "
+          "querying them again, unless the map changes. Default is 600."),
+)
 def _poller_main(args):
     """Continuously poll servers from the cache.
 
     Depending on whether ``--all`` was specified or not this will continuously
     poll servers from the interest queue or the cache in general. The updated
-    status of each server is written to the cache.
+    status of each server is written to the cache. When polling all servers
+    each one is polled at an adaptive interval between ``--min-interval``
+    and ``--max-interval``. Only servers which aren't failing are read from
+    the cache. Those which fail whilst this poller is running are retried
+    at its back off interval until they recover or are reaped. Server info
+    is queried on every poll, whereas the players and rules are only
+    queried every ``--players-interval`` and ``--rules-interval``
+    respectively, or when the map changes.
 
     :raises serverstf.FatalError: if the GeoIP database cannot be loaded.
     """
@@ -196,14 +922,44 @@ def _poller_main(args):
     except maxminddb.InvalidDatabaseError as exc:
         raise serverstf.FatalError(exc)
     else:
-        with serverstf.cache.Cache.connect(args.redis, loop) as r_cache:
-            with serverstf.cache.Cache.connect(args.redis, loop) as w_cache:
-                _watch(r_cache, w_cache, geoip, args.all)
+        loop.run_until_complete(_poller_async_main(args, loop, geoip))
     finally:
         geoip.close()
     log.info("Stopping poller")
 
 
+@serverstf.cli.subcommand("reaper")
+@serverstf.cli.redis
+@serverstf.cli.redis_pool
+@serverstf.cli.argument(
+    "--dead-period",
+    type=float,
+    default=86400.0,
+    help=("The number of seconds a server must have been failing to "
+          "respond for before it's evicted. Default is one day."),
+)
+@serverstf.cli.argument(
+    "--interval",
+    type=float,
+    default=60.0,
+    help=("The number of seconds between checks for "
+          "dead servers. Default is 60."),
+)
+def _reaper_main(args):
+    """Continuously evict dead servers from the cache.
+
+    Servers that have failed to respond to polls for longer than the
+    ``--dead-period`` are removed from the cache, including the tag indexes,
+    ranks and cached search results. If a server is still listed by the
+    master server it will be added back by the synchroniser, but then only
+    polled again at the poller's back off interval.
+    """
+    log.info("Starting reaper")
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_reaper_async_main(args, loop))
+    log.info("Stopping reaper")
+
+
 @serverstf.cli.subcommand("poll")
 @serverstf.cli.argument(
     "address",
@@ -218,9 +974,9 @@ def _poll_main(args):
     is *not* written to the cache.
     """
     geoip = geoip2.database.Reader(str(args.geoip))
-    tagger = serverstf.tags.Tagger.scan(__package__)
+    loop = asyncio.get_event_loop()
     try:
-        status = poll(tagger, geoip, args.address)
+        status = loop.run_until_complete(_poll_once(geoip, args.address))
     except PollError as exc:
         raise serverstf.FatalError from exc
     else:
@@ -1,6 +1,7 @@
 """Websocket service to access server statuses."""
 
 import asyncio
+import collections
 import functools
 import ipaddress
 import itertools
@@ -25,6 +26,10 @@ class MessageError(WebsocketError):
     """Raised for message validation failures."""
 
 
+class SlowConsumerError(WebsocketError):
+    """Raised when a client fails to keep up with the messages sent to it."""
+
+
 def validate(schema):
     """Validate message entities against a schema.
 
@@ -34,9 +39,12 @@ def validate(schema):
     schema. If the entity is valid then the wrapped function will be called
     being passed the validated entity as the sole argument.
 
+    The schema is compiled once when the decorator is applied rather than
+    for every message. The compiled schema is the ``schema`` attribute of
+    the decorated function, which is looked up for every message.
+
     :param schema: a :mod:`voluptuous` schema specification.
     """
-
     def decorator(function):  # pylint: disable=missing-docstring
         if not asyncio.iscoroutinefunction(function):
             raise TypeError(
@@ -46,26 +54,650 @@ def validate(schema):
         @functools.wraps(function)
         def wrapper(self, entity):  # pylint: disable=missing-docstring
             try:
-                validated_entity = voluptuous.Schema(schema)(entity)
+                validated_entity = wrapper.schema(entity)
             except voluptuous.Invalid as exc:
                 raise MessageError("Entity: {}".format(exc)) from exc
             yield from function(self, validated_entity)
 
+        wrapper.schema = voluptuous.Schema(schema)
         return wrapper
 
     return decorator
 
 
+#: Maximum number of addresses in ``subscribe-many`` and
+#: ``unsubscribe-many`` messages
+_MAX_BATCH_SIZE = 1000
+
+
+#: Default number of servers in each page of ``query`` results
+_PAGE_SIZE = 50
+
+#: Maximum number of servers in each page of ``query`` results
+_MAX_PAGE_SIZE = 200
+
+
+#: Status entity fields to send when a status hash field changes
+_DELTA_FIELDS = {
+    "name": {"name"},
+    "map": {"map"},
+    "players": {"players"},
+    "tags": {"tags"},
+    "country": {"country", "latitude", "longitude"},
+    "latitude": {"country", "latitude", "longitude"},
+    "longitude": {"country", "latitude", "longitude"},
+}
+
+
 def address_entity(value):
     """Convert a dictionary to a :class:`serverstf.cache.Address`.
 
     The dictionary must have an ``ip`` and ``port`` field which are a
-    string and integer respectively.
+    string and integer respectively. The returned address is interned so
+    it's the same instance as those decoded by the cache. The compiled
+    schema is the ``schema`` attribute of this function.
+    """
+    return serverstf.cache.Address.intern(
+        serverstf.cache.Address(**address_entity.schema(value)))
+
+
+address_entity.schema = voluptuous.Schema({
+    voluptuous.Required("ip"): str,
+    voluptuous.Required("port"): int,
+})
+
+
+def encode_message(type_, entity):
+    """Encode a message envelope.
+
+    :param str type_: the message type.
+    :param entity: the JSON-encodable message entity.
+
+    :return: the JSON encoded envelope as a string.
+    """
+    return json.dumps({"type": str(type_), "entity": entity})
+
+
+def decode_message(raw_message):
+    """Decode a message envelope.
+
+    :param str raw_message: the JSON encoded envelope.
+
+    :raises MessageError: if the message isn't JSON or the envelope is
+        invalid, e.g. missing fields or of the wrong type.
+    :return: the envelope as a dictionary with ``type`` and ``entity``
+        fields.
+
+    The compiled envelope schema is the ``schema`` attribute of this
+    function.
+    """
+    try:
+        message = json.loads(raw_message)
+    except ValueError as exc:
+        raise MessageError("JSON: {}".format(exc)) from exc
+    try:
+        decode_message.schema(message)
+    except voluptuous.Invalid as exc:
+        raise MessageError("Envelope: {}".format(exc)) from exc
+    return message
+
+
+decode_message.schema = voluptuous.Schema({
+    voluptuous.Required("type"): str,
+    voluptuous.Required("entity"): lambda x: x,
+})
+
+
+def status_entity(status):
+    """Convert a :class:`serverstf.cache.Status` to a message entity.
+
+    See :meth:`Client._send_status` for a description of the entity.
+    """
+    entity = {
+        "ip": str(status.address.ip),
+        "port": status.address.port,
+        "sequence": status.sequence,
+        "name": status.name or "",
+        "map": status.map or "",
+        "tags": list(status.tags),
+        "players": {
+            "current": status.players.current,
+            "max": status.players.max,
+            "bots": status.players.bots,
+            "scores": list([n, s, d.total_seconds()]
+                           for n, s, d in status.players),
+        },
+        "country": None,
+        "latitude": None,
+        "longitude": None,
+    }
+    if (status.country is not None
+            and status.latitude is not None
+            and status.longitude is not None):
+        entity["country"] = status.country
+        entity["latitude"] = status.latitude
+        entity["longitude"] = status.longitude
+    return entity
+
+
+class Snapshots:
+    """Per-process cache of encoded server status messages.
+
+    When a server's status changes every client subscribed to it needs to
+    be sent the same message. Rather than each client reading the status
+    from the cache and encoding it separately, they all ask this object for
+    the message. The status is read once and each message is encoded once,
+    with the resulting string being shared by all the clients.
+
+    Snapshots must be registered as a :class:`serverstf.cache.Multiplexer`
+    listener so that they're invalidated as server statuses change. Only
+    the statuses of servers being watched by the multiplexer are cached.
+
+    If the cache has a :class:`serverstf.cache.LocalCache` then statuses
+    are invalidated in it too. The local cache is otherwise invalidated by
+    its own notifier which may receive the notification after the
+    multiplexer does. The snapshot would then be read from the stale local
+    status and would remain stale until the server next changes.
+
+    :param serverstf.cache.AsyncCache cache: the cache to read statuses
+        from.
+    :param serverstf.cache.Multiplexer multiplexer: the multiplexer used
+        by clients to watch for status updates.
+    :param int size: the maximum number of servers to cache the statuses
+        of. When exceeded the least recently used are discarded.
+    """
+
+    def __init__(self, cache, multiplexer, size=10000):
+        self._cache = cache
+        self._multiplexer = multiplexer
+        self._size = size
+        self._entries = collections.OrderedDict()
+        multiplexer.listen(self.invalidate)
+
+    def __repr__(self):
+        return "<{0.__class__.__name__} of {1} servers>".format(
+            self, len(self._entries))
+
+    def invalidate(self, notification):
+        """Discard the cached messages for the server of a notification.
+
+        :param serverstf.cache.Notification notification: the notification
+            of a status change.
+        """
+        if notification.type == serverstf.cache.Notifier.SERVER:
+            if self._cache.local_cache:
+                self._cache.local_cache.invalidate(notification.address)
+            self._entries.pop(notification.address, None)
+
+    def _discard_failed(self, address, entry, future):
+        """Discard an entry if reading its status failed."""
+        if (not future.cancelled() and future.exception()
+                and self._entries.get(address) is entry):
+            del self._entries[address]
+
+    def _remember(self, address, entry):
+        """Cache an entry if its server is being watched.
+
+        :return: the given entry.
+        """
+        if self._multiplexer.watching(
+                serverstf.cache.Notifier.SERVER, address):
+            self._entries[address] = entry
+            entry[0].add_done_callback(
+                functools.partial(self._discard_failed, address, entry))
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def _entry(self, address):
+        """Get the cache entry for an address.
+
+        :return: a tuple containing a future for the status entity and a
+            dictionary of encoded messages.
+        """
+        entry = self._entries.get(address)
+        if entry is not None:
+            self._entries.move_to_end(address)
+            return entry
+        entity = asyncio.Task(self._read(address), loop=self._cache.loop)
+        return self._remember(address, (entity, {}))
+
+    def _entries_many(self, addresses):
+        """Get the cache entries for many addresses.
+
+        The statuses of any addresses which don't have entries are all
+        read from the cache at once.
+
+        :return: a dictionary mapping each address to its entry. See
+            :meth:`_entry`.
+        """
+        entries = {}
+        missing = {}
+        for address in addresses:
+            entry = self._entries.get(address)
+            if entry is not None:
+                self._entries.move_to_end(address)
+                entries[address] = entry
+            elif address not in missing:
+                missing[address] = asyncio.Future(loop=self._cache.loop)
+        if missing:
+            read = asyncio.Task(
+                self._read_many(missing.keys()), loop=self._cache.loop)
+            read.add_done_callback(
+                functools.partial(self._resolve_many, missing))
+            for address, entity in missing.items():
+                entries[address] = self._remember(address, (entity, {}))
+        return entries
+
+    @staticmethod
+    def _resolve_many(entities, future):
+        """Resolve entity futures from the result of reading many."""
+        for address, entity in entities.items():
+            if entity.done():
+                continue
+            if future.cancelled():
+                entity.cancel()
+            elif future.exception():
+                entity.set_exception(future.exception())
+            else:
+                entity.set_result(future.result()[address])
+
+    @asyncio.coroutine
+    def _read(self, address):
+        """Read a status from the cache and convert it to an entity."""
+        return status_entity((yield from self._cache.get(address)))
+
+    @asyncio.coroutine
+    def _read_many(self, addresses):
+        """Read many statuses from the cache and convert them to entities.
+
+        :return: a dictionary mapping addresses to entities.
+        """
+        statuses = yield from self._cache.get_many(addresses)
+        return {address: status_entity(status)
+                for address, status in statuses.items()}
+
+    @asyncio.coroutine
+    def status(self, address):
+        """Get a ``status`` message for a server.
+
+        :param serverstf.cache.Address address: the address of the server.
+
+        :return: the encoded message as a string.
+        """
+        entity, messages = self._entry(address)
+        if None not in messages:
+            entity = yield from asyncio.shield(entity)
+            messages.setdefault(None, encode_message("status", entity))
+        return messages[None]
+
+    @asyncio.coroutine
+    def delta(self, address, fields, sequence):
+        """Get a ``status-delta`` message for a server.
+
+        :param serverstf.cache.Address address: the address of the server.
+        :param fields: a set of changed status hash fields.
+        :param int sequence: the sequence number of the change.
+
+        :return: the encoded message as a string.
+        """
+        entity, messages = self._entry(address)
+        key = (frozenset(fields), sequence)
+        if key not in messages:
+            entity = yield from asyncio.shield(entity)
+            delta = {"ip", "port", "sequence"}
+            for field in fields:
+                delta.update(_DELTA_FIELDS.get(field, ()))
+            entity = {field: value for field, value
+                      in entity.items() if field in delta}
+            if sequence is not None:
+                entity["sequence"] = sequence
+            messages.setdefault(key, encode_message("status-delta", entity))
+        return messages[key]
+
+    @asyncio.coroutine
+    def statuses(self, addresses):
+        """Get a ``statuses`` message for many servers.
+
+        :param addresses: a sequence of server addresses.
+
+        :return: the encoded message as a string.
+        """
+        entries = self._entries_many(addresses)
+        entities = []
+        for address in addresses:
+            entities.append((yield from asyncio.shield(entries[address][0])))
+        return encode_message("statuses", entities)
+
+
+class _LiveQuery:  # pylint: disable=too-few-public-methods
+    """The state of a single :class:`LiveQueries` query."""
+
+    def __init__(self, include, exclude):
+        self.include = include
+        self.exclude = exclude
+        self.listeners = set()
+        self.loaded = None
+        self.results = None
+        self.pending = []
+
+
+class LiveQueries:
+    """Per-process engine for keeping tag query results up to date.
+
+    Each distinct query (as identified by its included and excluded tags)
+    has its matching addresses held in memory. Queries are shared between
+    all the clients that have subscribed to them.
+
+    The engine watches the channels of every tag that's included or
+    excluded by an active query. Tag notifications carry the full set of
+    the server's tags after the change, so whether the server still
+    matches each affected query can be determined without reading from
+    the cache. When a server starts matching a query a ``match`` message
+    is given to the query's listeners; when it stops matching an
+    ``unmatch`` message is given instead. The entity of both is an object
+    with ``ip`` and ``port`` fields. Each message is encoded once for all
+    listeners.
+
+    :param serverstf.cache.AsyncCache cache: the cache to load the initial
+        results of queries from.
+    :param serverstf.cache.Multiplexer multiplexer: the multiplexer to
+        watch tags with.
+    """
+
+    def __init__(self, cache, multiplexer):
+        self._cache = cache
+        self._notifier = multiplexer.notifier()
+        self._queries = {}
+        self._tags = {}
+        self._dispatcher = asyncio.Task(self._dispatch(), loop=cache.loop)
+
+    def __repr__(self):
+        return "<{0.__class__.__name__} of {1} queries>".format(
+            self, len(self._queries))
+
+    @asyncio.coroutine
+    def close(self):
+        """Stop maintaining queries."""
+        self._dispatcher.cancel()
+        yield from self._notifier.close()
+
+    @asyncio.coroutine
+    def subscribe(self, listener, include, exclude):
+        """Subscribe to changes to the results of a query.
+
+        If the query isn't already active then its initial results are
+        loaded from the cache. This waits for them to be loaded.
+
+        :param listener: a callable which accepts an address and an encoded
+            ``match`` or ``unmatch`` message.
+        :param include: a set of tags that servers must have.
+        :param exclude: a set of tags that servers must not have.
+
+        :return: a key which identifies the query to :meth:`unsubscribe`.
+        """
+        key = (frozenset(include), frozenset(exclude))
+        query = self._queries.get(key)
+        if query is None:
+            query = self._queries[key] = _LiveQuery(*key)
+            query.loaded = asyncio.Task(
+                self._load(key, query), loop=self._cache.loop)
+        query.listeners.add(listener)
+        try:
+            yield from asyncio.shield(query.loaded)
+        except BaseException:
+            yield from self.unsubscribe(listener, key)
+            raise
+        return key
+
+    @asyncio.coroutine
+    def _load(self, key, query):
+        """Watch the tags of a new query and load its initial results.
+
+        All the query's listeners may unsubscribe whilst it's loading. So
+        after each step this checks that the query is still active before
+        continuing, otherwise tags would be watched on behalf of a query
+        that no longer exists.
+        """
+        for tag in query.include | query.exclude:
+            if self._queries.get(key) is not query:
+                return
+            keys = self._tags.setdefault(tag, set())
+            keys.add(key)
+            if len(keys) == 1:
+                yield from self._notifier.watch_tag(tag)
+        if self._queries.get(key) is not query:
+            return
+        query.results = yield from self._cache.search(
+            include=query.include, exclude=query.exclude)
+        pending = query.pending
+        query.pending = None
+        for notification in pending:
+            self._apply(query, notification)
+        log.debug("Loaded query %s with %i results", key, len(query.results))
+
+    @asyncio.coroutine
+    def unsubscribe(self, listener, key):
+        """Unsubscribe from changes to the results of a query.
+
+        When a query has no more listeners it stops being maintained.
+
+        :param listener: the listener given to :meth:`subscribe`.
+        :param key: the key returned by :meth:`subscribe`.
+        """
+        query = self._queries.get(key)
+        if query is None:
+            return
+        query.listeners.discard(listener)
+        if query.listeners:
+            return
+        del self._queries[key]
+        for tag in query.include | query.exclude:
+            keys = self._tags.get(tag, set())
+            keys.discard(key)
+            if not keys and tag in self._tags:
+                del self._tags[tag]
+                yield from self._notifier.unwatch_tag(tag)
+
+    def _apply(self, query, notification):
+        """Update the results of a query from a tag notification."""
+        address = notification.address
+        matches = (bool(query.include)
+                   and query.include <= notification.tags
+                   and not query.exclude & notification.tags)
+        if matches == (address in query.results):
+            return
+        if matches:
+            query.results.add(address)
+        else:
+            query.results.discard(address)
+        frame = encode_message("match" if matches else "unmatch",
+                               {"ip": str(address.ip), "port": address.port})
+        for listener in list(query.listeners):
+            try:
+                listener(address, frame)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Error in query listener %r", listener)
+
+    @asyncio.coroutine
+    def _dispatch(self):
+        """Continually update queries from tag notifications.
+
+        Notifications for queries which are still loading their initial
+        results are held back until the results are loaded.
+        """
+        while True:
+            notification = yield from self._notifier.watch()
+            if (notification.type != serverstf.cache.Notifier.TAG
+                    or notification.tags is None):
+                continue
+            for key in list(self._tags.get(notification.tag, ())):
+                query = self._queries.get(key)
+                if query is None:
+                    continue
+                if query.results is None:
+                    query.pending.append(notification)
+                else:
+                    self._apply(query, notification)
+
+
+OutboxPolicy = collections.namedtuple(
+    "OutboxPolicy",
+    (
+        "limit",
+        "patience",
+    )
+)
+OutboxPolicy.__doc__ = """\
+Limits on how far behind an :class:`Outbox`'s client may fall.
+
+:ivar int limit: the maximum number of messages that can be waiting.
+:ivar float patience: the number of seconds a client may remain behind
+    before it's considered a slow consumer.
+"""
+
+
+class Outbox:
+    """Bounded queue of encoded messages waiting to be sent to a client.
+
+    Messages may be put with a key in which case they're coalesced: if a
+    message with the same key is already waiting to be sent then it's
+    replaced by the new one, keeping its place in the queue. This way a
+    client that falls behind only ever has the latest message for each
+    server waiting for it.
+
+    If the outbox is full then new keyed messages are dropped. These are
+    status updates and query changes which will be superseded by the next
+    one for the same key. Messages without a key, such as replies to
+    requests, can't be recovered if dropped so they're added beyond the
+    limit, but only until the outbox holds twice the limit. Should the
+    outbox overflow that, or stay full (or at least half full) for longer
+    than the configured patience, then the client is considered to be a
+    slow consumer and :exc:`SlowConsumerError` is raised when trying to
+    put any more messages.
+
+    :param OutboxPolicy policy: the limit and patience for the outbox.
+    :param asyncio.AbstractEventLoop loop: the event loop the outbox is
+        consumed within.
+
+    :ivar collections.Counter stats: the number of messages ``dropped``
+        because the outbox was full and the number ``coalesced`` with a
+        waiting message with the same key.
     """
-    return serverstf.cache.Address(**voluptuous.Schema({
-        voluptuous.Required("ip"): str,
-        voluptuous.Required("port"): int,
-    })(value))
+
+    def __init__(self, policy, *, loop):
+        self._policy = policy
+        self._loop = loop
+        self._frames = collections.OrderedDict()
+        self._ready = asyncio.Event(loop=loop)
+        self._behind_since = None
+        self._error = None
+        self.stats = collections.Counter()
+
+    def __repr__(self):
+        return ("<{0.__class__.__name__} {1}/{0._policy.limit} "
+                "dropped={0.dropped} coalesced={0.coalesced}>".format(
+                    self, len(self)))
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    @property
+    def dropped(self):
+        """Get the number of messages dropped."""
+        return self.stats["dropped"]
+
+    @property
+    def coalesced(self):
+        """Get the number of messages coalesced."""
+        return self.stats["coalesced"]
+
+    def put(self, frame, key=None):
+        """Add a message to the outbox.
+
+        :param str frame: the encoded message.
+        :param key: an optional hashable key used to coalesce the message
+            with any already waiting messages that have the same key. Only
+            messages with a key are dropped when the outbox is full.
+
+        :raises SlowConsumerError: if the outbox has been full for longer
+            than the configured patience or a message without a key would
+            take it past twice its limit. Once raised, :meth:`get` will
+            also raise it.
+        """
+        if self._error:
+            raise self._error
+        if key is not None and key in self._frames:
+            self._frames[key] = frame
+            self.stats["coalesced"] += 1
+            return
+        if len(self._frames) >= self._policy.limit:
+            now = self._loop.time()
+            if self._behind_since is None:
+                self._behind_since = now
+            elif now - self._behind_since > self._policy.patience:
+                raise self._fail("Outbox has been behind for {:.1f} "
+                                 "seconds".format(now - self._behind_since))
+            if key is not None:
+                self.stats["dropped"] += 1
+                return
+            if len(self._frames) >= 2 * self._policy.limit:
+                raise self._fail("Outbox overflowed with {} "
+                                 "messages".format(len(self._frames)))
+        if key is None:
+            key = object()
+        self._frames[key] = frame
+        self._ready.set()
+
+    def _fail(self, message):
+        """Mark the client as a slow consumer.
+
+        :param str message: the reason the client is a slow consumer.
+
+        :return: the :exc:`SlowConsumerError` to raise.
+        """
+        self._error = SlowConsumerError(message)
+        self._ready.set()
+        return self._error
+
+    @asyncio.coroutine
+    def get(self):
+        """Remove and return the oldest message in the outbox.
+
+        If the outbox is empty then this will wait for a message to be put.
+
+        :raises SlowConsumerError: if the client has been found to be a slow
+            consumer by :meth:`put`.
+        """
+        while not self._frames and not self._error:
+            self._ready.clear()
+            yield from self._ready.wait()
+        if self._error:
+            raise self._error
+        _, frame = self._frames.popitem(last=False)
+        if len(self._frames) < self._policy.limit // 2:
+            self._behind_since = None
+        return frame
+
+
+Shared = collections.namedtuple(
+    "Shared",
+    (
+        "cache",
+        "snapshots",
+        "queries",
+    )
+)
+Shared.__doc__ = """\
+State shared between all the clients of a :class:`Service`.
+
+:ivar cache: the :class:`serverstf.cache.AsyncCache` statuses are read from.
+:ivar snapshots: the :class:`Snapshots` of recently sent statuses.
+:ivar queries: the :class:`LiveQueries` that clients subscribe to.
+"""
 
 
 class Client:
@@ -91,24 +723,51 @@ class Client:
     Communication between the server (that's us) and the client is very much
     fire and forget. It is not possible to have a request-reply model due
     to the fact that status updates may happen at any time.
+
+    Messages waiting to be sent are held in an :class:`Outbox` so that a
+    client that can't keep up doesn't cause them to accumulate without
+    bound. Status updates are coalesced by server address.
+
+    :param websocket: the client's websocket connection.
+    :param Shared shared: the state shared with the service's other clients.
+    :param serverstf.cache.MultiplexedNotifier notifier: the client's own
+        notifier.
+    :param Outbox outbox: the client's outbox.
     """
 
-    def __init__(self, websocket, cache, notifier):
+    def __init__(self, websocket, shared, notifier, outbox):
         self._websocket = websocket
-        self._cache = cache
+        self._cache = shared.cache
         self._notifier = notifier
-        self._send_queue = asyncio.Queue()
-        self._include = set()
-        self._exclude = set()
+        self._snapshots = shared.snapshots
+        self._queries = shared.queries
+        self._query = None
+        self._outbox = outbox
+
+    @asyncio.coroutine
+    def close(self):
+        """Stop receiving changes to the client's query, if any."""
+        if self._query is not None:
+            yield from self._queries.unsubscribe(
+                self._on_query_change, self._query)
+            self._query = None
 
     @asyncio.coroutine
     def send(self, type_, entity):
         """Enqueue a message to be sent to peer."""
-        message = {"type": str(type_), "entity": entity}
-        yield from self._send_queue.put(json.dumps(message))
+        yield from self._send_frame(encode_message(type_, entity))
 
     @asyncio.coroutine
-    def _send_status(self, address):
+    def _send_frame(self, frame, key=None):
+        """Enqueue an already encoded message to be sent to the peer.
+
+        :param key: an optional key to coalesce the message by. See
+            :meth:`Outbox.put`.
+        """
+        self._outbox.put(frame, key)
+
+    @asyncio.coroutine
+    def _send_status(self, address, fields=None, sequence=None):
         """Send a server status update.
 
         This will send a ``status`` type message to the client which contains
@@ -122,6 +781,10 @@ class Client:
         ``port``
             Port number of server as a number.
 
+        ``sequence``
+            The status sequence number. This is incremented each time the
+            server's status changes.
+
         ``name``
             Server name as a string. Note that this may contain unprintable
             characters.
@@ -165,32 +828,35 @@ class Client:
 
         The location is considered to be conclusively known if all location
         fields are not ``None``.
+
+        If ``fields`` is given then a ``status-delta`` message is sent
+        instead. Its entity is the same as for ``status`` messages except
+        that only the ``ip``, ``port`` and ``sequence`` fields are always
+        present. Otherwise only the fields affected by the changed status
+        hash fields are included. If a client sees a gap in the sequence
+        numbers it should send a ``resync`` message.
+
+        :param serverstf.cache.Address address: the address of the server.
+        :param fields: an optional set of changed status hash fields as
+            given by :attr:`serverstf.cache.Notification.fields`.
+        :param int sequence: the sequence number the changed fields
+            correspond to. This overrides the status's own sequence number
+            for ``status-delta`` messages, which may be more recent.
+
+        The messages themselves come from the shared :class:`Snapshots` so
+        that they are only encoded once regardless of how many clients
+        they're sent to.
+
+        If a message for the server is still waiting to be sent then it is
+        replaced by a full ``status`` message, as a ``status-delta`` alone
+        would lose the changes from the message it replaced.
         """
-        status = yield from self._cache.get(address)
-        entity = {
-            "ip": str(status.address.ip),
-            "port": status.address.port,
-            "name": status.name or "",
-            "map": status.map or "",
-            "tags": list(status.tags),
-            "players": {
-                "current": status.players.current,
-                "max": status.players.max,
-                "bots": status.players.bots,
-                "scores": list([n, s, d.total_seconds()]
-                               for n, s, d in status.players),
-            },
-            "country": None,
-            "latitude": None,
-            "longitude": None,
-        }
-        if (status.country is not None
-                and status.latitude is not None
-                and status.longitude is not None):
-            entity["country"] = status.country
-            entity["latitude"] = status.latitude
-            entity["longitude"] = status.longitude
-        yield from self.send("status", entity)
+        key = ("status", address)
+        if fields is None or key in self._outbox:
+            frame = yield from self._snapshots.status(address)
+        else:
+            frame = yield from self._snapshots.delta(address, fields, sequence)
+        yield from self._send_frame(frame, key)
 
     @validate(address_entity)
     @asyncio.coroutine
@@ -205,6 +871,47 @@ class Client:
         yield from self._notifier.watch_server(address)
         yield from self._send_status(address)
 
+    @validate(voluptuous.All(
+        voluptuous.Length(max=_MAX_BATCH_SIZE), [address_entity]))
+    @asyncio.coroutine
+    def _handle_subscribe_many(self, addresses):
+        """Handle ``subscribe-many`` messages.
+
+        The entity is an array of addresses, each in the same form as for
+        ``subscribe`` messages. All the servers are watched at once and
+        their initial statuses are sent as a single ``statuses`` message.
+        The entity of which is an array of ``status`` message entities in
+        the same order as the addresses.
+        """
+        addresses = list(collections.OrderedDict.fromkeys(addresses))
+        log.info("New subscriptions to %i addresses", len(addresses))
+        yield from self._notifier.watch_servers(addresses)
+        if addresses:
+            yield from self._send_frame(
+                (yield from self._snapshots.statuses(addresses)))
+
+    @validate(voluptuous.All(
+        voluptuous.Length(max=_MAX_BATCH_SIZE), [address_entity]))
+    @asyncio.coroutine
+    def _handle_unsubscribe_many(self, addresses):
+        """Handle ``unsubscribe-many`` messages.
+
+        Stop watching all the addresses in the entity array.
+        """
+        log.info("Unsubscribing from %i addresses", len(addresses))
+        yield from self._notifier.unwatch_servers(addresses)
+
+    @validate(address_entity)
+    @asyncio.coroutine
+    def _handle_resync(self, address):
+        """Handle ``resync`` messages.
+
+        Clients send these when they detect a gap in the sequence numbers
+        of ``status-delta`` messages. A full ``status`` is sent in response.
+        """
+        log.debug("Resynchronising %s", address)
+        yield from self._send_status(address)
+
     @validate(address_entity)
     @asyncio.coroutine
     def _handle_unsubscribe(self, address):
@@ -215,21 +922,39 @@ class Client:
         log.info("Unsubscribing from address %s", address)
         yield from self._notifier.unwatch_server(address)
 
-    @asyncio.coroutine
-    def _send_match(self, address):
-        """Notify the client that a server matches its query.
+    def _on_query_change(self, address, frame):
+        """Notify the client that a server matches its query or not.
 
-        This sends a message with type ``type``. The accompanying entity
-        is an object with two fields: ``ip`` and ``port``. The ``ip`` is the
+        This is a :class:`LiveQueries` listener. The frame is either a
+        ``match`` or ``unmatch`` message. The accompanying entity is an
+        object with two fields: ``ip`` and ``port``. The ``ip`` is the
         dot-decimal IP address of the given ``address`` and the ``port`` is
         just port number as is.
+
+        Only the latest of these messages for each server is kept if the
+        client falls behind.
         """
-        yield from self.send(
-            "match", {"ip": str(address.ip), "port": address.port})
+        try:
+            self._outbox.put(frame, ("match", address))
+        except SlowConsumerError:
+            # The outbox remembers the error and will raise it for the
+            # writer, which disconnects the client.
+            pass
 
     @validate({
         voluptuous.Required("include"): [str],
         voluptuous.Required("exclude"): [str],
+        voluptuous.Optional("sort", default=None): voluptuous.Any(
+            None, *serverstf.cache.AsyncCache.SORT_KEYS),
+        voluptuous.Optional("limit", default=_PAGE_SIZE): voluptuous.All(
+            int, voluptuous.Range(min=1, max=_MAX_PAGE_SIZE)),
+        voluptuous.Optional("cursor", default=None): voluptuous.Any(
+            None, voluptuous.All(voluptuous.Coerce(int),
+                                 voluptuous.Range(min=0))),
+        voluptuous.Optional("origin", default=None): voluptuous.Any(None, {
+            voluptuous.Required("latitude"): voluptuous.Coerce(float),
+            voluptuous.Required("longitude"): voluptuous.Coerce(float),
+        }),
     })
     @asyncio.coroutine
     def _handle_query(self, entity):
@@ -237,64 +962,110 @@ class Client:
 
         The message entity should have two fields: ``include`` and
         ``exclude``; both of which should be an array of tags as strings.
-        These tags are used to query the cache to find matching servers. For
-        each matching address a ``match`` message is sent.
-
-        In addition to this we begin listening to changes to the included
-        tags so that we can detect when a new server has the tag applied and
-        send the appropriate ``match`` message to notify the client.
+        These tags are used to query the cache to find matching servers.
+
+        Matching servers are sent a page at a time as ``matches`` messages.
+        The size of each page is determined by the optional ``limit`` field
+        which defaults to 50. The servers can be ordered by giving a
+        ``sort`` field which is one of ``players``, ``free`` or ``latency``.
+        Sorting by latency requires an ``origin`` object with ``latitude``
+        and ``longitude`` fields. See :meth:`serverstf.cache.AsyncCache.query`
+        for details on the sort orders.
+
+        The ``matches`` message entity is an object with three fields:
+
+        ``servers``
+            An array of objects with ``ip`` and ``port`` fields for each
+            matching server on the page.
+
+        ``total``
+            The total number of matching servers.
+
+        ``cursor``
+            An opaque string which can be passed as the ``cursor`` field of
+            a subsequent ``query`` message with the same tags and sort order
+            to get the next page. This is ``null`` if there are no more
+            pages.
+
+        Queries without a cursor replace the client's current query. The
+        client is subscribed to the query's results with the shared
+        :class:`LiveQueries` so that when a server starts or stops matching
+        the query a ``match`` or ``unmatch`` message is sent.
         """
         include = set(entity["include"])
         exclude = set(entity["exclude"])
-        for old_tag in self._include - include:
-            yield from self._notifier.unwatch_tag(old_tag)
-        self._include = include
-        self._exclude = exclude
-        for tag in include:
-            yield from self._notifier.watch_tag(tag)
-        addresses = yield from self._cache.search(
-            include=self._include, exclude=self._exclude)
-        for address in addresses:
-            yield from self._send_match(address)
+        origin = entity["origin"]
+        if origin is not None:
+            origin = (origin["latitude"], origin["longitude"])
+        if entity["sort"] == "latency" and origin is None:
+            raise MessageError("Sorting by latency requires an origin")
+        if entity["cursor"] is None:
+            yield from self.close()
+            self._query = yield from self._queries.subscribe(
+                self._on_query_change, include, exclude)
+        offset = entity["cursor"] or 0
+        total, addresses = yield from self._cache.query(
+            include=include,
+            exclude=exclude,
+            sort=entity["sort"],
+            offset=offset,
+            limit=entity["limit"],
+            origin=origin,
+        )
+        cursor = offset + len(addresses)
+        yield from self.send("matches", {
+            "servers": [{"ip": str(address.ip), "port": address.port}
+                        for address in addresses],
+            "total": total,
+            "cursor": str(cursor) if addresses and cursor < total else None,
+        })
+
+    @classmethod
+    def handler(cls, type_):
+        """Get the method that handles a type of message.
+
+        Message type handler methods should be named with the message type
+        prefixed by ``_handle_``. Message types separate words with hyphens
+        which are replaced by underscores in the method name. For example,
+        ``subscribe-many`` messages are handled by
+        :meth:`_handle_subscribe_many`. Message types which contain
+        underscores themselves are never handled.
+
+        Method handlers must be coroutine functions.
+
+        :param str type_: the message type.
+
+        :return: the handler function or ``None`` if there isn't one.
+        """
+        if "_" in type_:
+            return None
+        handler = getattr(cls, "_handle_" + type_.replace("-", "_"), None)
+        if not handler or not asyncio.iscoroutinefunction(handler):
+            return None
+        return handler
 
     @asyncio.coroutine
     def _dispatch(self, raw_message):
         """Handle a JSON encoded message.
 
-        This will decode the message as JSON and validate the envelope to
-        ensure it has the necessary fields. If the envelope is valid then
-        a method is looked up that is capable of dealing with the given
-        message type.
-
-        Message type handler methods should be named with the message type
-        prefixed by ``_handle_``. For example, the handler for messages of
-        type ``foo`` would be handled by :meth:`_handle_foo`.
+        This will decode the message with :func:`decode_message`. If the
+        envelope is valid then a method is looked up that is capable of
+        dealing with the given message type.
 
-        If a handler method exists for the message type then it will be
-        called with the message entity passed in as the sole argument.
-
-        Method handlers must be coroutine functions.
+        The handler method is found by :meth:`handler`. If one exists for
+        the message type then it will be called with the message entity
+        passed in as the sole argument.
 
         :raises MessageError: if the message isn't JSON, the envelope
             is invalid (e.g. missing fields or wrong type) or there is no
             handler method for the given message type.
         """
-        try:
-            message = json.loads(raw_message)
-        except ValueError as exc:
-            raise MessageError("JSON: {}".format(exc)) from exc
-        try:
-            voluptuous.Schema({
-                voluptuous.Required("type"): str,
-                voluptuous.Required("entity"): lambda x: x,
-            })(message)
-        except voluptuous.Invalid as exc:
-            raise MessageError("Envelope: {}".format(exc)) from exc
-        handler = getattr(self, "_handle_" + message["type"], None)
-        if not handler or not asyncio.iscoroutinefunction(handler):
+        message = decode_message(raw_message)
+        handler = self.handler(message["type"])
+        if not handler:
             raise MessageError(
                 "Unknown message type: {}".format(message["type"]))
-        yield from handler(message["entity"])
+        yield from handler(self, message["entity"])
 
     @asyncio.coroutine
     def _read(self):
@@ -318,24 +1089,20 @@ class Client:
 
     @asyncio.coroutine
     def _write(self):
-        """Continually flush the send queue."""
+        """Continually flush the outbox."""
         while True:
-            message = yield from self._send_queue.get()
+            message = yield from self._outbox.get()
             yield from self._websocket.send(message)
 
     @asyncio.coroutine
     def _watch_notifications(self):
         """Continually watch for server status updates."""
         while True:
-            update, address = yield from self._notifier.watch()
-            if update == self._notifier.SERVER:
-                yield from self._send_status(address)
-            elif update == self._notifier.TAG:
-                status = yield from self._cache.get(address)
-                if (status.tags <= self._include
-                        and not status.tags & self._exclude):
-                    yield from self._send_match(address)
-
+            notification = yield from self._notifier.watch()
+            address = notification.address
+            if notification.type == self._notifier.SERVER:
+                yield from self._send_status(
+                    address, notification.fields, notification.sequence)
 
     @asyncio.coroutine
     def process(self):
@@ -346,6 +1113,9 @@ class Client:
         will run until one of them exits (either due to an error or the
         peer disconnecting), at which point all outstanding tasks are
         cancelled and this coroutine returns.
+
+        Clients which fail to keep up with the messages sent to them are
+        disconnected.
         """
         log.debug("Handling new socket %s", self._websocket)
         done, pending = yield from asyncio.wait([
@@ -362,6 +1132,9 @@ class Client:
                 # The task hasn't had chance to cancel yet but that doesn't
                 # really matter.
                 pass
+            except SlowConsumerError as exc:
+                log.warning("Disconnecting slow client %s: %s",
+                            self._websocket, exc)
             except Exception:  # pylint: disable=broad-except
                 log.exception("Error handling %s "
                               "in task %s", self._websocket, task)
@@ -373,20 +1146,71 @@ class Service:
     This service spawns individual handlers for each client that connects.
     Clients must connect from the path that service is configured for.
     Otherwise the connection is closed immediately.
+
+    All clients share a single :class:`serverstf.cache.Multiplexer` so that
+    the number of Redis connections doesn't depend on the number of
+    clients.
+
+    Each client gets its own :class:`Outbox` with the given limit and
+    patience. The service keeps track of the outboxes of connected
+    clients so that queue depths and drop counts can be reported.
+
+    :param int outbox_limit: the maximum number of messages that may be
+        waiting to be sent to each client.
+    :param float outbox_patience: the number of seconds a client may be
+        behind before it's disconnected.
     """
 
-    def __init__(self, path, cache):
+    def __init__(self, path, cache, multiplexer, *,
+                 outbox_limit=512, outbox_patience=30.0):
         self._path = path
-        self._cache = cache
+        self._multiplexer = multiplexer
+        self._shared = Shared(cache,
+                              Snapshots(cache, multiplexer),
+                              LiveQueries(cache, multiplexer))
+        self._outbox_policy = OutboxPolicy(outbox_limit, outbox_patience)
+        self._outboxes = set()
+        self._stats = collections.Counter()
+
+    def __repr__(self):
+        return ("<{0.__class__.__name__} clients={1} queued={2} "
+                "max-queued={3} dropped={4} coalesced={5}>".format(
+                    self,
+                    len(self._outboxes),
+                    sum(len(outbox) for outbox in self._outboxes),
+                    max((len(outbox) for outbox in self._outboxes),
+                        default=0),
+                    self.dropped,
+                    self.coalesced,
+                ))
+
+    @asyncio.coroutine
+    def close(self):
+        """Stop maintaining the results of client queries."""
+        yield from self._shared.queries.close()
+
+    @property
+    def dropped(self):
+        """Total number of messages dropped for all clients."""
+        return self._stats["dropped"] + sum(
+            outbox.dropped for outbox in self._outboxes)
+
+    @property
+    def coalesced(self):
+        """Total number of messages coalesced for all clients."""
+        return self._stats["coalesced"] + sum(
+            outbox.coalesced for outbox in self._outboxes)
 
     @asyncio.coroutine
     def __call__(self, websocket, path):
         """Handle a new socket connection.
 
         This spawns a :class:`Client` to handle the new connection. This
-        handler will have a dedicated :class:`serverstf.cache.Notifier`
-        created for it. When the client completes (either due to graceful
-        disconnect or error) the notifier will be cleaned up.
+        handler will have a dedicated
+        :class:`serverstf.cache.MultiplexedNotifier` created for it. When the
+        client completes (either due to graceful disconnect or error) the
+        notifier will be cleaned up and the client unsubscribed from its
+        query.
 
         If the socket connects on a path other than ``/`` then it is
         immediately disconnected.
@@ -394,12 +1218,17 @@ class Service:
         if path != self._path:
             log.error("Client connected on path %s; dropping connection", path)
             return
-        notifier = yield from self._cache.notifier()
-        client = Client(websocket, self._cache, notifier)
+        notifier = self._multiplexer.notifier()
+        outbox = Outbox(self._outbox_policy, loop=self._shared.cache.loop)
+        client = Client(websocket, self._shared, notifier, outbox)
+        self._outboxes.add(outbox)
         try:
             yield from client.process()
         finally:
-            notifier.close()
+            yield from notifier.close()
+            yield from client.close()
+            self._outboxes.discard(outbox)
+            self._stats.update(outbox.stats)
         log.debug("Connection closed")
 
 
@@ -410,26 +1239,48 @@ def _websocket_async_main(args, loop):
     This will connect to the cache identified by the command line arguments
     and start websocket server to host a :class:`Service` instance. It will
     then let the socket server run indefinately.
+
+    Client outbox depths and drop counts are logged every minute, as are
+    the local status cache's hit and miss counts if it is enabled.
     """
     log.info(
         "Starting websocket server on %s:%i", args.bind_host, args.bind_port)
-    cache_context = \
-        yield from serverstf.cache.AsyncCache.connect(args.redis, loop)
+    cache_context = yield from serverstf.cache.AsyncCache.connect(
+        args.redis, loop, pool_size=args.redis_pool_size)
     with cache_context as cache:
-        yield from websockets.serve(
-            Service(args.path, cache),
-            host=str(args.bind_host),
-            port=args.bind_port,
-            loop=loop,
+        if args.local_cache_size:
+            yield from cache.cache_locally(args.local_cache_size)
+        multiplexer = serverstf.cache.Multiplexer(
+            (yield from cache.notifier()), loop)
+        service = Service(
+            args.path,
+            cache,
+            multiplexer,
+            outbox_limit=args.outbox_limit,
+            outbox_patience=args.outbox_patience,
         )
-        # Surely this isn't the correct way to do this!?
-        while True:
-            yield from asyncio.sleep(1)
+        try:
+            yield from websockets.serve(
+                service,
+                host=str(args.bind_host),
+                port=args.bind_port,
+                loop=loop,
+            )
+            # Surely this isn't the correct way to do this!?
+            while True:
+                yield from asyncio.sleep(60)
+                log.info("Service: %s", service)
+                if cache.local_cache:
+                    log.info("Local cache: %s", cache.local_cache)
+        finally:
+            yield from service.close()
+            multiplexer.close()
     log.info("Stopping websocket server")
 
 
 @serverstf.cli.subcommand("websocket")
 @serverstf.cli.redis
+@serverstf.cli.redis_pool
 @serverstf.cli.argument(
     "--bind-host",
     type=ipaddress.IPv4Address,
@@ -451,6 +1302,27 @@ def _websocket_async_main(args, loop):
         "Connections from other paths are discarded."
     ),
 )
+@serverstf.cli.argument(
+    "--local-cache-size",
+    type=int,
+    default=0,
+    help=("The number of server statuses to cache in memory. "
+          "Defaults to zero which disables the local cache."),
+)
+@serverstf.cli.argument(
+    "--outbox-limit",
+    type=int,
+    default=512,
+    help=("The maximum number of messages that may be waiting to be "
+          "sent to each client. Further messages are dropped."),
+)
+@serverstf.cli.argument(
+    "--outbox-patience",
+    type=float,
+    default=30.0,
+    help=("The number of seconds a client's outbox may remain full "
+          "before the client is disconnected."),
+)
 def _websocket_main(args):
     """Start a websocket server."""
     loop = asyncio.get_event_loop()